@@ -7,15 +7,18 @@ Define the REST API for JWT authentication
 
 
 import asyncio
+import collections
 import logging
 import functools
 import inspect
+import time
 import aiohttp.web
 import aiohttp_swagger
 import aiohttp_cors
 import api_middlewares
 import resources
 import services
+import services.swagger_spec
 
 
 class ApiFactory(object):
@@ -26,13 +29,41 @@ class ApiFactory(object):
     def __init__(self, loop=None, config=None):
         """ Create the aiohttp application """
 
+        started = time.monotonic()
         self.logger = logging.getLogger(self.__class__.__name__)
         self.loop = loop if loop is not None else asyncio.get_event_loop()
         self.config = config
 
         swagger_url = self.prefix_context_path("/doc")
 
-        self.app = aiohttp.web.Application(loop=loop, middlewares=[functools.partial(api_middlewares.rest_error_middleware, logger=self.logger)])
+        # Compression is the outer middleware so it sees responses once rest_error_middleware handled them
+        # Admission control is the inner one so its rejections are turned into JSON errors
+        middlewares = [functools.partial(api_middlewares.rest_error_middleware, logger=self.logger)]
+        if self.config.rest_max_in_flight > 0:
+            middlewares.append(
+                functools.partial(
+                    api_middlewares.admission_control_middleware,
+                    classify=self.route_class,
+                    limiters={
+                        x: services.ConcurrencyLimiter(y, max_queue=self.config.rest_max_queue, max_wait=self.config.rest_max_wait) for x, y in self.route_class_limits().items()
+                    },
+                    client_buckets=services.ClientTokenBuckets(self.config.rest_client_rate, burst=self.config.rest_client_burst) if self.config.rest_client_rate > 0 else None,
+                    logger=self.logger,
+                )
+            )
+        if self.config.compress_min_size > 0:
+            middlewares.insert(
+                0,
+                functools.partial(
+                    api_middlewares.compression_middleware,
+                    cache=collections.OrderedDict(),
+                    min_size=self.config.compress_min_size,
+                    cache_size=self.config.compress_cache_size,
+                    logger=self.logger,
+                ),
+            )
+
+        self.app = aiohttp.web.Application(loop=loop, middlewares=middlewares)
         self.app.factory = self
 
         self.app.router.add_route("GET", "/", lambda x: aiohttp.web.HTTPFound(swagger_url))
@@ -44,9 +75,23 @@ class ApiFactory(object):
             self.prefix_context_path("/appointments/{user_type}/{control_type}/{vehicle_type}/{organism}/{site}/{start_date}/{end_date}"),
             resources.RestAppointments().get,
         )
+        self.app.router.add_route("GET", self.prefix_context_path("/appointments/export"), resources.RestExport().get)
         self.app.router.add_route("GET", self.prefix_context_path("/sites"), resources.RestSites().get)
         self.app.router.add_route("GET", self.prefix_context_path("/vehicles"), resources.RestVehicles().get)
-        self.app.router.add_route("GET", self.prefix_context_path("/appointments/ws"), resources.WsAppointments().get)
+        self.app.router.add_route("GET", self.prefix_context_path("/capabilities"), resources.RestCapabilities().get)
+        self.app.router.add_route("GET", self.prefix_context_path("/freshness"), resources.RestFreshness().get)
+        self.app.router.add_route("GET", self.prefix_context_path("/heatmap/{granularity}"), resources.RestHeatmap().get)
+        if self.config.enable_profiling:
+            self.app.router.add_route("GET", self.prefix_context_path("/admin/profile"), resources.RestProfile().get)
+        if self.config.history_db:
+            self.app.router.add_route("GET", self.prefix_context_path("/history/appearances"), resources.RestHistoryAppearances().get)
+        if self.config.webhooks_file:
+            self.app.router.add_route("POST", self.prefix_context_path("/webhooks"), resources.RestWebhooks().post)
+            self.app.router.add_route("GET", self.prefix_context_path("/webhooks/{webhook_id}"), resources.RestWebhooks().get)
+            self.app.router.add_route("DELETE", self.prefix_context_path("/webhooks/{webhook_id}"), resources.RestWebhooks().delete)
+        self.app.router.add_route("GET", self.prefix_context_path("/appointments/ws"), resources.WsAppointments(
+                connect_rate=self.config.ws_connect_rate, connect_burst=self.config.ws_connect_burst, connect_queue=self.config.ws_connect_queue, compress=self.config.ws_compress
+            ).get)
 
         # Setup Swagger
         # bundle_params and schemes are a GitHub patch not released
@@ -55,18 +100,23 @@ class ApiFactory(object):
         kwargs = {}
         if "bundle_params" in setup_swagger_sign.parameters:
             kwargs["bundle_params"] = {"layout": "BaseLayout", "defaultModelExpandDepth": 5}
+        doc_kwargs = {
+            "description": "API for finding appointments timeslots for SNCT vehicule inspection",
+            "title": "SNCT Appointments API",
+            "api_version": "1.0",
+            "contact": "acecile@letz-it.lu",
+        }
         if "schemes" in setup_swagger_sign.parameters:
-            kwargs["schemes"] = self.config.swagger_ui_schemes
-
-        aiohttp_swagger.setup_swagger(
-            app=self.app,
-            description="API for finding appointments timeslots for SNCT vehicule inspection",
-            title="SNCT Appointments API",
-            api_version="1.0",
-            contact="acecile@letz-it.lu",
-            swagger_url=swagger_url,
-            **kwargs
-        )
+            doc_kwargs["schemes"] = list(self.config.swagger_ui_schemes)
+        # Parsing handlers YAML docstrings is most of startup time, so spec is built on first /doc hit
+        # (or loaded from --swagger-cache) unless this aiohttp_swagger cannot take a prebuilt spec
+        self.swagger_spec = None
+        if "swagger_info" in setup_swagger_sign.parameters and "swagger_def_decor" in setup_swagger_sign.parameters:
+            self.swagger_spec = services.swagger_spec.SwaggerSpecCache(self.app, path=self.config.swagger_cache, **doc_kwargs)
+            kwargs["swagger_info"] = {}
+            kwargs["swagger_def_decor"] = self.swagger_spec.handler
+
+        aiohttp_swagger.setup_swagger(app=self.app, swagger_url=swagger_url, **doc_kwargs, **kwargs)
 
         # Setup CORS
         if self.config.allow_origin:
@@ -82,12 +132,25 @@ class ApiFactory(object):
         self.print_routes()
 
         # Setup services
+        self.app.on_startup.append(self.setup_loop_lag_monitor)
+        self.app.on_shutdown.append(self.close_loop_lag_monitor)
+        self.app["profiler"] = services.LoopProfiler() if self.config.enable_profiling else None
         self.app.on_startup.append(self.setup_appointment_dispatcher)
-        self.app.on_startup.append(self.setup_snct_appointment_scrapper)
-        self.app.on_shutdown.append(self.close_snct_appointment_scrapper)
+        self.app.on_startup.append(self.setup_slot_history)
+        if self.config.shard_socket:
+            self.app.on_startup.append(self.setup_shard_coordinator)
+            self.app.on_shutdown.append(self.close_shard_coordinator)
+        else:
+            self.app.on_startup.append(self.setup_snct_appointment_scrapper)
+            self.app.on_shutdown.append(self.close_snct_appointment_scrapper)
+        self.app.on_shutdown.append(self.close_slot_history)
+        self.app.on_startup.append(self.setup_webhooks)
+        self.app.on_shutdown.append(self.close_webhooks)
         self.app.on_startup.append(self.setup_ws_stream_coros)
         self.app.on_shutdown.append(self.close_ws_stream_coros)
 
+        self.logger.info("Application created in %.1f ms", (time.monotonic() - started) * 1000)
+
     def url_for(self, name):
         """ Get relative URL for a given route named """
         return self.app.router.named_resources()[name].url()
@@ -104,6 +167,38 @@ class ApiFactory(object):
         """ Construct a relative URL with context path """
         return self.route_join(self.config.context_path, *args)
 
+    # Path prefixes (after context path) and their admission control class, first match wins, None means not limited
+    ROUTE_CLASSES = [
+        ("/appointments/ws", None),
+        ("/appointments/export", "export"),
+        ("/appointments", "appointments"),
+        ("/heatmap", "appointments"),
+        ("/sites", "catalog"),
+        ("/vehicles", "catalog"),
+        ("/capabilities", "catalog"),
+        ("/freshness", "catalog"),
+        ("/history", "history"),
+        ("/webhooks", "webhooks"),
+    ]
+
+    def route_class(self, request):
+        """ Return admission control class of request route, None if not limited """
+
+        for prefix, route_class in self.ROUTE_CLASSES:
+            if request.path.startswith(self.prefix_context_path(prefix)):
+                return route_class
+        return None
+
+    def route_class_limits(self):
+        """ Return {route_class: max_in_flight}, --rest-max-in-flight unless overridden by --rest-class-limit """
+
+        limits = {x[1]: self.config.rest_max_in_flight for x in self.ROUTE_CLASSES if x[1] is not None}
+        for item in self.config.rest_class_limit:
+            route_class, _, limit = item.partition("=")
+            assert route_class in limits and limit.isdigit() and int(limit) > 0, "--rest-class-limit must be like CLASS=N with CLASS one of %s" % ", ".join(sorted(limits))
+            limits[route_class] = int(limit)
+        return limits
+
     def print_routes(self):
         """ Log all configured routes """
 
@@ -120,20 +215,77 @@ class ApiFactory(object):
 
             self.logger.info("Route has been setup %s at %s", route.method, url)
 
+    async def setup_loop_lag_monitor(self, app):
+        """ Warn about synchronous steps blocking the event loop """
+
+        app["loop_monitor"] = None
+        if self.config.loop_lag_threshold > 0:
+            app["loop_monitor"] = services.LoopLagMonitor(threshold=self.config.loop_lag_threshold)
+            app["loop_monitor"].start()
+            self.logger.info("Event loop is %s, lag monitor threshold is %.3fs", self.loop.__class__.__name__, self.config.loop_lag_threshold)
+
+    @staticmethod
+    async def close_loop_lag_monitor(app):
+        """ Stop event loop lag monitor """
+
+        if app["loop_monitor"] is not None:
+            await app["loop_monitor"].stop()
+
     async def setup_appointment_dispatcher(self, app):
         """ Class receiving updates from SNCT scrapper and dispatching appointments to clients """
 
-        app["apptm_disp"] = services.AppointmentDispatcher()
+        app["offload_executor"] = services.offload.create_executor(self.config.offload, workers=self.config.offload_workers)
+        app["apptm_disp"] = services.AppointmentDispatcher(
+            demand_window=self.config.demand_window,
+            history_size=self.config.ws_history_size,
+            executor=app["offload_executor"],
+            offload_chunk_size=self.config.offload_chunk_size,
+            freshness_target=self.config.freshness_target,
+            freshness_objective=self.config.freshness_objective,
+        )
+
+    async def setup_slot_history(self, app):
+        """ Record slots appearing and vanishing if a history database is configured """
+
+        app["slot_history"] = None
+        if self.config.history_db:
+            app["slot_history"] = services.SlotHistoryStore(self.config.history_db)
+            await app["slot_history"].start()
+            app["apptm_disp"].add_change_listener(app["slot_history"].change_listener)
 
     @staticmethod
-    async def setup_snct_appointment_scrapper(app):
+    async def close_slot_history(app):
+        """ Flush and close slot history database """
+
+        if app["slot_history"] is not None:
+            await app["slot_history"].close()
+
+    async def setup_snct_appointment_scrapper(self, app):
         """ Initialize SNCT website scrapper and do mandatory pre-start calls """
 
         app["snct_scrapper"] = services.SnctAppointmentScrapper(
             site_handler=app["apptm_disp"].site_handler,
             vehicle_handler=app["apptm_disp"].vehicle_handler,
             appointment_handler=app["apptm_disp"].appointment_handler,
+            demand_handler=app["apptm_disp"].is_key_in_demand,
+            idle_refresh_interval=self.config.idle_refresh_interval,
+            profiler=app["profiler"],
+            executor=app["offload_executor"],
+            offload_chunk_size=self.config.offload_chunk_size,
+            burst_neighbours=self.config.burst_neighbours,
+            burst_budget=self.config.burst_budget,
+            burst_delay=self.config.burst_delay,
+            providers=[services.PROVIDERS[x]() for x in self.config.providers],
+            priority_handler=app["apptm_disp"].key_priority,
+            requests_per_second=self.config.requests_per_second,
+            catalog_refresh_interval=self.config.catalog_refresh_interval,
+            capability_handler=app["apptm_disp"].capability_handler,
+            unsupported_recheck_interval=self.config.unsupported_recheck_interval,
+            clock=app["apptm_disp"].clock,
+            recorder=services.TrafficRecorder(self.config.record_traffic) if self.config.record_traffic else None,
         )
+        app["apptm_disp"].refresh_requester = app["snct_scrapper"].request_refresh
+        app["apptm_disp"].add_change_listener(app["snct_scrapper"].change_listener)
 
         await app["snct_scrapper"].refresh_sites()
         await app["snct_scrapper"].refresh_vehicles()
@@ -152,6 +304,47 @@ class ApiFactory(object):
 
         await asyncio.shield(app["snct_scrapper"].close())
         app.refresh_appointments_task.cancel()
+        if app["offload_executor"] is not None:
+            app["offload_executor"].shutdown(wait=False)
+
+    async def setup_shard_coordinator(self, app):
+        """ Let scrapper_node.py processes poll shards of keys and publish results here instead of scrapping locally """
+
+        coordinator = services.ShardCoordinator(app["apptm_disp"], node_timeout=self.config.shard_node_timeout)
+        app["apptm_disp"].refresh_requester = coordinator.request_refresh
+        app["shard_coordinator"] = services.ShardCoordinatorServer(coordinator, self.config.shard_socket)
+        await app["shard_coordinator"].start()
+
+    @staticmethod
+    async def close_shard_coordinator(app):
+        """ Stop listening for scrapper nodes """
+
+        await app["shard_coordinator"].close()
+        if app["offload_executor"] is not None:
+            app["offload_executor"].shutdown(wait=False)
+
+    async def setup_webhooks(self, app):
+        """ Load persisted webhooks and start delivering to them if a webhooks file is configured """
+
+        app["webhooks"] = None
+        if self.config.webhooks_file:
+            app["webhooks"] = services.WebhookDelivery(
+                app["apptm_disp"],
+                path=self.config.webhooks_file,
+                concurrency=self.config.webhook_concurrency,
+                max_attempts=self.config.webhook_max_attempts,
+                max_subscriptions=self.config.webhook_max_subscriptions,
+                max_criterias=self.config.webhook_max_criterias,
+                allow_private=self.config.webhook_allow_private,
+            )
+            await app["webhooks"].start()
+
+    @staticmethod
+    async def close_webhooks(app):
+        """ Stop webhooks delivery """
+
+        if app["webhooks"] is not None:
+            await app["webhooks"].close()
 
     @staticmethod
     async def setup_ws_stream_coros(app):
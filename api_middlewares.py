@@ -4,9 +4,24 @@
 # pylint: disable=line-too-long
 
 
+import gzip
 import logging
 import functools
+import collections
 import aiohttp
+import json_codec
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Preferred first
+COMPRESSION_ENCODERS = collections.OrderedDict()
+if brotli is not None:
+    COMPRESSION_ENCODERS["br"] = functools.partial(brotli.compress, quality=5)  # pylint: disable=no-member
+COMPRESSION_ENCODERS["gzip"] = functools.partial(gzip.compress, compresslevel=6)
 
 
 async def rest_error_middleware(_, handler, logger=None):
@@ -49,10 +64,111 @@ async def rest_error_middleware(_, handler, logger=None):
             if isinstance(logger, logging.Logger):
                 logger.log(log_level, "Error handling request: %s: %s" % (exc.__class__.__name__, exc), exc_info=with_exception)
 
+            # Keep hints given to client about when to retry
+            headers = {}
+            if isinstance(exc, aiohttp.web_exceptions.HTTPException) and "Retry-After" in exc.headers:  # pylint: disable=no-member
+                headers["Retry-After"] = exc.headers["Retry-After"]  # pylint: disable=no-member
+
             rest_error = {"message": message, "status": status}
-            response = aiohttp.web.json_response(rest_error, status=status)
+            response = json_codec.json_response(rest_error, status=status, headers=headers)
 
         finally:
             return response  # pylint: disable=lost-exception
 
     return functools.partial(return_rest_error_response, logger=logger)
+
+
+def accepted_encoding(accept_encoding):
+    """ Return preferred encoding we support among Accept-Encoding header value, None if none """
+
+    accepted = set()
+    for item in accept_encoding.lower().split(","):
+        encoding, _, params = item.strip().partition(";")
+        if params.replace(" ", "") in ["q=0", "q=0.0", "q=0.00", "q=0.000"]:
+            continue
+        accepted.add(encoding.strip())
+
+    for encoding in COMPRESSION_ENCODERS:
+        if encoding in accepted:
+            return encoding
+    return None
+
+
+async def compression_middleware(_, handler, cache, min_size=1024, cache_size=256, logger=None):  # pylint: disable=too-many-arguments
+    """
+    A middleware to compress responses bodies with brotli (if installed) or gzip, according to Accept-Encoding
+    Handlers can store a data version in request["data_version"], compressed bodies are then cached in cache OrderedDict
+    by path, data version and encoding so identical responses are only compressed once
+    Factory is called for every request, so cache must be created once by caller
+    WebSocket and streamed responses are left untouched
+    """
+
+    async def return_compressed_response(request):
+        """ middleware handler """
+
+        response = await handler(request)
+
+        if not isinstance(response, aiohttp.web.Response) or response.prepared or response.status != 200:
+            return response
+        body = response.body
+        if not isinstance(body, bytes) or len(body) < min_size or "Content-Encoding" in response.headers:
+            return response
+        encoding = accepted_encoding(request.headers.get("Accept-Encoding", ""))
+        if encoding is None:
+            return response
+
+        data_version = request.get("data_version", None)
+        cache_key = (request.path_qs, data_version, encoding)
+        compressed = cache.get(cache_key, None) if data_version is not None else None
+        if compressed is None:
+            compressed = COMPRESSION_ENCODERS[encoding](body)
+            if data_version is not None:
+                cache[cache_key] = compressed
+                if len(cache) > cache_size:
+                    cache.popitem(last=False)
+            if isinstance(logger, logging.Logger):
+                logger.debug("Compressed %s with %s from %d to %d bytes", request.path_qs, encoding, len(body), len(compressed))
+        else:
+            cache.move_to_end(cache_key)
+
+        response.body = compressed
+        response.headers["Content-Encoding"] = encoding
+        response.headers["Vary"] = "Accept-Encoding"
+        return response
+
+    return return_compressed_response
+
+
+async def admission_control_middleware(_, handler, classify, limiters, client_buckets=None, logger=None):
+    """
+    A middleware capping in-flight requests of each route class so a burst of REST calls cannot starve scrapper and WebSocket fan-out
+      * classify(request) returns route class name, None for routes not limited (WebSocket, documentation)
+      * limiters is a {route_class: ConcurrencyLimiter} dict, rejected requests get 503 with Retry-After
+      * if client_buckets (ClientTokenBuckets) is given, clients exhausting their bucket get 429 with Retry-After
+    Must be placed inside rest_error_middleware so rejections are turned into JSON errors
+    Factory is called for every request, state must live in limiters and client_buckets
+    """
+
+    async def return_admitted_response(request):
+        """ middleware handler """
+
+        limiter = limiters.get(classify(request), None)
+        if limiter is None:
+            return await handler(request)
+
+        if client_buckets is not None:
+            bucket = client_buckets.get(request.remote)
+            if not bucket.consume():
+                raise aiohttp.web.HTTPTooManyRequests(headers={"Retry-After": str(int(bucket.delay()) + 1)})
+
+        if not await limiter.admit():
+            if isinstance(logger, logging.Logger):
+                logger.warning("Shedding %s request, %d in flight and %d waiting", request.path, limiter.in_flight, limiter.waiting)
+            raise aiohttp.web.HTTPServiceUnavailable(headers={"Retry-After": str(limiter.retry_after)})
+
+        try:
+            return await handler(request)
+        finally:
+            limiter.release()
+
+    return return_admitted_response
@@ -0,0 +1,76 @@
+"""
+MessagePack encoding for high-volume WebSocket subscribers and bulk exports
+Keys are interned as small integers and timestamps sent as local wall clock seconds since epoch
+msgpack package is optional, check AVAILABLE before use
+"""
+
+
+# pylint: disable=line-too-long
+
+
+import datetime
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+AVAILABLE = msgpack is not None
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def epoch_seconds(timestamp):
+    """ Turn a naive local datetime into local wall clock seconds since epoch """
+
+    return int((timestamp - EPOCH).total_seconds())
+
+
+def pack(payload):
+    """ Serialize payload to msgpack bytes """
+
+    return msgpack.packb(payload, use_bin_type=True)  # pylint: disable=no-member
+
+
+def unpack(data):
+    """ Deserialize msgpack bytes """
+
+    return msgpack.unpackb(data, raw=False, strict_map_key=False)  # pylint: disable=no-member
+
+
+def pack_spliced(payload, raw_field, raw_bytes):
+    """
+    Serialize payload dict plus one more field whose value is already msgpack encoded
+    msgpack being a streaming format, a map is its header followed by encoded keys and values
+    so a shared encoded value can be reused without decoding it
+    """
+
+    return pack_spliced_fields(payload, {raw_field: raw_bytes})
+
+
+def pack_spliced_fields(payload, raw_fields):
+    """ Same as pack_spliced with several already encoded fields, raw_fields being a {name: msgpack bytes} dict """
+
+    packer = msgpack.Packer(use_bin_type=True)  # pylint: disable=no-member
+    chunks = [packer.pack_map_header(len(payload) + len(raw_fields))]
+    for name, value in payload.items():
+        chunks.append(packer.pack(name))
+        chunks.append(packer.pack(value))
+    for name, raw_bytes in raw_fields.items():
+        chunks.append(packer.pack(name))
+        chunks.append(raw_bytes)
+    return b"".join(chunks)
+
+
+def group_by_key_id(appointments, key_id):
+    """
+    Turn a list of appointment dicts into {key_id: [seconds, ...]}
+    key_id is a callable returning interned id of a (user_type, control_type, vehicle_type, (organism, site)) key
+    """
+
+    grouped = {}
+    for appointment in appointments:
+        key = (appointment["user_type"], appointment["control_type"], appointment["vehicle_type"], (appointment["organism"], appointment["site"]))
+        grouped.setdefault(key_id(key), []).append(epoch_seconds(appointment["timestamp"]))
+    return grouped
@@ -0,0 +1,100 @@
+"""
+JSON encoding and decoding for REST and WebSocket responses
+Use orjson native codec when installed and fallback to stdlib json
+"""
+
+
+# pylint: disable=line-too-long
+
+
+import json
+import datetime
+import aiohttp.web
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+BACKEND = "orjson" if orjson is not None else "json"
+
+
+def json_serializer(payload):
+    """ A serializer handling datetime.datetime to iso8601 for stdlib json """
+
+    if isinstance(payload, (datetime.datetime, datetime.date)):
+        return payload.isoformat()
+    raise TypeError("Object of type %s is not JSON serializable" % payload.__class__.__name__)
+
+
+def dumps_bytes(payload):
+    """ Serialize payload to UTF-8 encoded JSON bytes, datetimes are turned into iso8601 """
+
+    if orjson is not None:
+        return orjson.dumps(payload)  # pylint: disable=no-member
+    return json.dumps(payload, default=json_serializer, separators=(",", ":")).encode("utf-8")
+
+
+def dumps(payload):
+    """ Serialize payload to JSON string, datetimes are turned into iso8601 """
+
+    if orjson is not None:
+        return orjson.dumps(payload).decode("utf-8")  # pylint: disable=no-member
+    return json.dumps(payload, default=json_serializer, separators=(",", ":"))
+
+
+def loads(data):
+    """ Deserialize JSON from str or bytes """
+
+    if orjson is not None:
+        return orjson.loads(data)  # pylint: disable=no-member
+    return json.loads(data)
+
+
+def json_response(payload, status=200, headers=None):
+    """ Drop-in replacement for aiohttp.web.json_response using the fastest available codec """
+
+    return aiohttp.web.Response(body=dumps_bytes(payload), status=status, headers=headers, content_type="application/json")
+
+
+if __name__ == "__main__":
+
+    import timeit
+
+    def realistic_payload(count=5000):
+        """ Build a WebSocket snapshot like payload """
+
+        start = datetime.datetime(2019, 1, 7, 7, 30)
+        sites = ["esch_sur_alzette", "sandweiler", "wilwerwiltz", "livange", "bissen"]
+        added = []
+        for idx in range(count):
+            added.append(
+                {
+                    "user_type": "PRIVATE",
+                    "control_type": "REGULAR",
+                    "vehicle_type": "car",
+                    "organism": "snct",
+                    "site": sites[idx % len(sites)],
+                    "timestamp": start + datetime.timedelta(minutes=15 * idx),
+                }
+            )
+        return {"status": 200, "added": added, "removed": []}
+
+    PAYLOAD = realistic_payload()
+    STDLIB_ENCODED = json.dumps(PAYLOAD, default=json_serializer)
+    NUMBER = 50
+
+    print("Payload: %d appointments, %d bytes" % (len(PAYLOAD["added"]), len(STDLIB_ENCODED)))
+    RESULTS = {
+        "stdlib encode": timeit.timeit(lambda: json.dumps(PAYLOAD, default=json_serializer), number=NUMBER),
+        "stdlib decode": timeit.timeit(lambda: json.loads(STDLIB_ENCODED), number=NUMBER),
+    }
+    if orjson is not None:
+        RESULTS["orjson encode"] = timeit.timeit(lambda: orjson.dumps(PAYLOAD), number=NUMBER)  # pylint: disable=no-member
+        RESULTS["orjson decode"] = timeit.timeit(lambda: orjson.loads(STDLIB_ENCODED), number=NUMBER)  # pylint: disable=no-member
+    else:
+        print("orjson is not installed, only stdlib figures are available")
+
+    for NAME, ELAPSED in RESULTS.items():
+        print("%-14s %8.3f ms per call" % (NAME, ELAPSED * 1000 / NUMBER))
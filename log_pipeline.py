@@ -0,0 +1,114 @@
+"""
+Non-blocking logging pipeline
+Records are queued from the event loop and formatted and written by a background thread
+High-volume messages opt in to rate limiting per message template by logging with extra=RATE_LIMITED
+"""
+
+
+# pylint: disable=line-too-long
+
+
+import sys
+import copy
+import time
+import queue
+import collections
+import atexit
+import logging
+import logging.handlers
+
+
+# Extra attributes marking a hot path record (per key or per client message) as subject to rate limiting
+RATE_LIMITED = {"rate_limited": True}
+
+# Argument types copied when queuing a record, as callers may change them before listener formats it
+MUTABLE_ARGS = (list, dict, set, bytearray, collections.deque)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Let at most burst records of the same category go through every period seconds
+    Category is logger name and message template, so each kind of message has its own budget
+    Only records logged with extra=RATE_LIMITED are limited, so operational warnings are never dropped,
+    neither are records above max_level (errors by default)
+    """
+
+    def __init__(self, burst=20, period=10.0, max_level=logging.WARNING):
+        super().__init__()
+        self.burst = burst
+        self.period = period
+        self.max_level = max_level
+        self.windows = {}
+
+    def filter(self, record):
+        if record.levelno > self.max_level or not getattr(record, "rate_limited", False):
+            return True
+
+        category = (record.name, record.msg)
+        now = time.monotonic()
+        window_start, count, suppressed = self.windows.get(category, (now, 0, 0))
+
+        if now - window_start >= self.period:
+            if suppressed:
+                record.msg = "%s (%d similar messages suppressed)" % (record.msg, suppressed)
+            window_start, count, suppressed = now, 0, 0
+
+        if count >= self.burst:
+            self.windows[category] = (window_start, count, suppressed + 1)
+            return False
+
+        self.windows[category] = (window_start, count + 1, suppressed)
+        return True
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler leaving formatting, including %-formatting of message arguments, to listener thread
+    Mutable containers passed as arguments are copied so later changes to them do not alter the record
+    Stock QueueHandler.prepare runs the whole formatter, including exception formatting, in the caller thread
+    """
+
+    @staticmethod
+    def snapshot(arg):
+        """ Return arg, or a shallow copy of it if it may change before being formatted """
+
+        if isinstance(arg, MUTABLE_ARGS):
+            return copy.copy(arg)
+        if isinstance(arg, tuple):
+            return tuple(LazyQueueHandler.snapshot(x) for x in arg)
+        return arg
+
+    def prepare(self, record):
+        if isinstance(record.args, dict):
+            record.args = {x: self.snapshot(y) for x, y in record.args.items()}
+        elif record.args:
+            record.args = tuple(self.snapshot(x) for x in record.args)
+        return record
+
+
+def setup_queue_logging(level, formatter, rate_limit_burst=20, rate_limit_period=10.0):
+    """
+    Install a QueueHandler on root logger and a QueueListener writing to stdout from a background thread
+    Return the started listener, it is stopped automatically at exit
+    """
+
+    log_queue = queue.Queue(-1)
+
+    stream_handler = logging.StreamHandler(stream=sys.stdout)
+    stream_handler.setFormatter(logging.Formatter(formatter))
+
+    queue_handler = LazyQueueHandler(log_queue)
+    if rate_limit_burst:
+        queue_handler.addFilter(RateLimitFilter(burst=rate_limit_burst, period=rate_limit_period))
+
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    root_logger.addHandler(queue_handler)
+    root_logger.setLevel(level)
+
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    return listener
@@ -12,11 +12,13 @@ Main file to run SNCT Appointment helper
 import sys
 import os
 import shutil
+import asyncio
 import logging
 import argparse
 import aiohttp.web
 import setproctitle
 
+import log_pipeline
 from api_factory import ApiFactory
 
 
@@ -39,15 +41,18 @@ def set_process_name(config_obj=None):
     setproctitle.setproctitle("%s-%s %s" % (artifact_id, version, cli_args))  # pylint: disable=maybe-no-member,bad-option-value,c-extension-no-member
 
 
-def configure_root_logger(level=logging.INFO):
-    """ Override root logger to use a better formatter """
+def configure_root_logger(level=logging.INFO, rate_limit_burst=20, rate_limit_period=10.0):
+    """
+    Override root logger to use a better formatter
+    Logs are written from a background thread so they never block the event loop
+    """
 
     if os.getenv("NO_LOGS_TS", None) is None:
         formatter = "%(asctime)s %(levelname)-8s [%(name)s] %(message)s"
     else:
         formatter = "%(levelname)-8s [%(name)s] %(message)s"
 
-    logging.basicConfig(level=level, format=formatter, stream=sys.stdout)
+    log_pipeline.setup_queue_logging(level=level, formatter=formatter, rate_limit_burst=rate_limit_burst, rate_limit_period=rate_limit_period)
 
 
 def get_arguments_from_cmd_line():
@@ -64,8 +69,62 @@ def get_arguments_from_cmd_line():
 
     parser.add_argument("-c", "--context-path", type=str, default="/", help="Text to be used as prefix URL")
     parser.add_argument("-d", "--debug", action="store_true", help="Put loggers in DEBUG level")
+    parser.add_argument("--log-rate-limit", type=int, default=20, help="Maximum number of identical per key or per client INFO/WARNING messages logged every --log-rate-period seconds, 0 to disable")
+    parser.add_argument("--log-rate-period", type=float, default=10.0, help="Period in seconds used by --log-rate-limit")
     parser.add_argument("-o", "--allow-origin", type=str, help="Allow to restrict the API access to the given URL or domain only")
 
+    parser.add_argument("--idle-refresh-interval", type=int, default=900, help="Seconds between refreshes of appointments nobody subscribed to or queried recently, a first subscriber or REST hit fetches them at once (with --shard-socket, on next scrapper node heartbeat)")
+    parser.add_argument("--demand-window", type=int, default=3600, help="Seconds during which a REST query keeps appointments refreshed at full speed")
+
+    parser.add_argument("--ws-history-size", type=int, default=1000, help="Number of recent updates kept to let WebSocket clients resume their session")
+
+    parser.add_argument("--ws-connect-rate", type=float, default=50, help="Number of new WebSocket clients accepted per second")
+    parser.add_argument("--ws-connect-burst", type=int, default=100, help="Number of new WebSocket clients accepted at once before rate limit applies")
+    parser.add_argument("--ws-connect-queue", type=int, default=1000, help="Number of WebSocket clients waiting to be accepted before rejecting new ones")
+
+    parser.add_argument("--enable-profiling", action="store_true", help="Expose /admin/profile route to profile running event loop on demand")
+
+    parser.add_argument("--uvloop", action="store_true", help="Use uvloop event loop if installed")
+    parser.add_argument("--loop-lag-threshold", type=float, default=0.5, help="Log stack of code blocking the event loop longer than this number of seconds, 0 to disable")
+
+    parser.add_argument("--offload", type=str, choices=["none", "thread", "process"], default="none", help="Parse and diff appointments in a worker pool instead of event loop")
+    parser.add_argument("--offload-workers", type=int, default=None, help="Number of workers in offload pool, defaults to executor own default")
+    parser.add_argument("--offload-chunk-size", type=int, default=50, help="Number of keys sent to a worker at once")
+
+    parser.add_argument("--history-db", type=str, default=None, help="SQLite database file recording slots appearing and vanishing, enables /history routes")
+
+    parser.add_argument("--burst-budget", type=int, default=0, help="Maximum number of extra requests per minute re-polling changed keys and their neighbours, 0 to disable")
+    parser.add_argument("--burst-neighbours", type=str, nargs="*", choices=["site", "vehicle"], default=["site"], help="Neighbours re-polled with a changed key: other vehicles at same site, same vehicle at other sites")
+    parser.add_argument("--burst-delay", type=float, default=5.0, help="Seconds to wait after a change before re-polling")
+
+    parser.add_argument("--providers", type=str, nargs="+", choices=["snct", "fake"], default=["snct"], help="Appointment providers to scrape, fake generates random local appointments for testing")
+
+    parser.add_argument("--requests-per-second", type=float, default=0, help="Maximum number of requests per second sent to providers, 0 to pace periodic refreshes evenly over the refresh interval")
+
+    parser.add_argument("--catalog-refresh-interval", type=int, default=3600, help="Seconds between refreshes of providers sites and vehicles lists")
+    parser.add_argument("--unsupported-recheck-interval", type=int, default=86400, help="Seconds before re-checking a site and vehicle combination the provider does not handle")
+    parser.add_argument("--freshness-target", type=int, default=120, help="Seconds after which appointments of a key are considered stale in /freshness report")
+    parser.add_argument("--freshness-objective", type=float, default=0.99, help="Ratio of time keys in demand must spend within --freshness-target")
+    parser.add_argument("--record-traffic", type=str, default=None, help="Record all provider responses to this gzipped capture file, to be replayed by replay_benchmark.py")
+    parser.add_argument("--shard-socket", type=str, default=None, help="Do not scrap, let scrapper_node.py processes share keys and publish results on this Unix socket")
+    parser.add_argument("--shard-node-timeout", type=int, default=30, help="Seconds without news from a scrapper node before its shard is given to other nodes")
+    parser.add_argument("--webhooks-file", type=str, default=None, help="JSON file persisting webhooks subscriptions, enables /webhooks routes")
+    parser.add_argument("--webhook-concurrency", type=int, default=20, help="Maximum number of webhook deliveries in flight")
+    parser.add_argument("--webhook-max-attempts", type=int, default=5, help="Number of attempts to deliver a webhook batch before giving up")
+    parser.add_argument("--webhook-max-subscriptions", type=int, default=1000, help="Maximum number of webhooks subscribed at once")
+    parser.add_argument("--webhook-max-criterias", type=int, default=100, help="Maximum number of criterias of a webhook")
+    parser.add_argument("--webhook-allow-private", action="store_true", help="Allow webhooks URLs whose host has a loopback, link-local or private address")
+    parser.add_argument("--rest-max-in-flight", type=int, default=32, help="Maximum number of in-flight REST requests per route class, 0 to disable admission control")
+    parser.add_argument("--rest-class-limit", type=str, nargs="*", default=["export=2", "history=4"], help="Override --rest-max-in-flight of some route classes, like export=2")
+    parser.add_argument("--rest-max-queue", type=int, default=64, help="Number of REST requests of a route class waiting for a slot before rejecting with 503")
+    parser.add_argument("--rest-max-wait", type=float, default=1.0, help="Seconds a REST request may wait for a slot before rejecting with 503")
+    parser.add_argument("--rest-client-rate", type=float, default=0, help="REST requests per second allowed to each client address before answering 429, 0 to disable")
+    parser.add_argument("--rest-client-burst", type=int, default=20, help="Burst of REST requests allowed to each client address")
+    parser.add_argument("--compress-min-size", type=int, default=1024, help="Compress REST responses bodies bigger than this number of bytes with brotli (if installed) or gzip, 0 to disable")
+    parser.add_argument("--compress-cache-size", type=int, default=256, help="Number of compressed REST responses bodies kept in cache")
+    parser.add_argument("--no-ws-compress", dest="ws_compress", action="store_false", help="Do not negotiate permessage-deflate WebSocket compression")
+
+    parser.add_argument("--swagger-cache", type=str, default=None, help="JSON file caching Swagger spec built from handlers docstrings, regenerated when they change")
     parser.add_argument("-s", "--swagger-ui-schemes", type=str, nargs="+", default=("http", "https"), help="Override SwaggerUI list of schemes")
 
     parsed = parser.parse_args()
@@ -77,13 +136,30 @@ def get_arguments_from_cmd_line():
     return parsed
 
 
+def install_uvloop():
+    """ Make asyncio use uvloop if installed, return True if it is """
+
+    logger = logging.getLogger("main")
+    try:
+        import uvloop  # pylint: disable=import-outside-toplevel,import-error
+    except ImportError:
+        logger.warning("uvloop is not installed, using default asyncio event loop")
+        return False
+
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    logger.info("Using uvloop event loop")
+    return True
+
+
 def create_api():
     """ Setup app for both command line and Gunicorn run """
 
     config = get_arguments_from_cmd_line()
     log_level = logging.DEBUG if config.debug else logging.INFO
-    configure_root_logger(level=log_level)
+    configure_root_logger(level=log_level, rate_limit_burst=config.log_rate_limit, rate_limit_period=config.log_rate_period)
     set_process_name(config_obj=config)
+    if config.uvloop:
+        install_uvloop()
     return ApiFactory(config=config)
 
 
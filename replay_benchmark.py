@@ -0,0 +1,141 @@
+#!/usr/bin/python3
+
+
+# pylint: disable=line-too-long
+
+
+"""
+Replay a traffic capture recorded with main.py --record-traffic through scrape, diff and fan-out, on a virtual clock
+A day of refresh cycles runs as fast as the pipeline allows, with the same inputs on every run
+"""
+
+
+import time
+import random
+import asyncio
+import logging
+import argparse
+import datetime
+
+import services
+
+
+def get_arguments_from_cmd_line():
+    """ Handle command line arguments """
+
+    parser = argparse.ArgumentParser(description="SNCT Appointment helper replay benchmark", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("capture", type=str, help="Traffic capture recorded with main.py --record-traffic")
+    parser.add_argument("-d", "--debug", action="store_true", help="Log pipeline messages, slows the benchmark down")
+    parser.add_argument("--days", type=float, default=1.0, help="Number of virtual days to replay")
+    parser.add_argument("--clients", type=int, default=1000, help="Number of simulated subscribers")
+    parser.add_argument("--criterias-per-client", type=int, default=3, help="Number of keys each simulated subscriber follows")
+    parser.add_argument("--latency-scale", type=float, default=0.0, help="Reproduce recorded response times multiplied by this factor")
+    parser.add_argument("--offload", type=str, choices=["none", "thread", "process"], default="none", help="Parse and diff appointments in a worker pool instead of event loop")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of simulated subscribers criterias")
+
+    return parser.parse_args()
+
+
+class BenchmarkClient:
+    """ Stand-in of a WebSocket client, only counting what it receives """
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    async def push_appointments(self, added=None, removed=None, seq=None):  # pylint: disable=unused-argument
+        """ Called by dispatcher fan-out """
+
+        self.stats["pushes"] += 1
+        self.stats["pushed_appointments"] += len(added or []) + len(removed or [])
+
+
+def percentiles(values):
+    """ Return p50, p95 and max of given values, in milliseconds """
+
+    values = sorted(values) or [0.0]
+    return tuple(1000 * values[min(len(values) - 1, int(len(values) * x))] for x in (0.5, 0.95, 1.0))
+
+
+async def run_benchmark(config):  # pylint: disable=too-many-locals
+    """ Replay capture and print timings """
+
+    server = services.ReplayServer(config.capture, latency_scale=config.latency_scale)
+    await server.start_server()
+    clock = server.clock
+
+    executor = services.offload.create_executor(config.offload)
+    dispatcher = services.AppointmentDispatcher(executor=executor, clock=clock)
+    stats = {"pushes": 0, "pushed_appointments": 0}
+    handler_timings = []
+
+    async def timed_appointment_handler(payload):
+        """ Measure diff and fan-out of a cycle """
+
+        started = time.perf_counter()
+        result = dispatcher.appointment_handler(payload)
+        if asyncio.iscoroutine(result):
+            await result
+        handler_timings.append(time.perf_counter() - started)
+
+    scrapper = services.SnctAppointmentScrapper(
+        site_handler=dispatcher.site_handler,
+        vehicle_handler=dispatcher.vehicle_handler,
+        appointment_handler=timed_appointment_handler,
+        demand_handler=dispatcher.is_key_in_demand,
+        executor=executor,
+        providers=[services.SnctProvider(url=server.url)],
+        priority_handler=dispatcher.key_priority,
+        capability_handler=dispatcher.capability_handler,
+        clock=clock,
+    )
+
+    cycle_timings = []
+    real_started = time.perf_counter()
+    try:
+        await scrapper.refresh_sites()
+        await scrapper.refresh_vehicles()
+
+        rand = random.Random(config.seed)
+        keys = sorted(scrapper.appointment_keys())
+        for _ in range(config.clients):
+            criterias = []
+            for key in rand.sample(keys, min(len(keys), config.criterias_per_client)):
+                start_dt = datetime.datetime(2000, 1, 1)
+                criterias.append({"user_type": key[0], "control_type": key[1], "vehicle_type": key[2], "organism": key[3][0], "site": key[3][1], "start_dt": start_dt, "end_dt": start_dt.replace(year=2100)})
+            dispatcher.register_appointment_client(BenchmarkClient(stats), criterias)
+
+        for _ in range(int(config.days * 86400 / scrapper.refresh_interval)):
+            if scrapper.is_catalog_due("sites"):
+                await scrapper.refresh_sites()
+            if scrapper.is_catalog_due("vehicles"):
+                await scrapper.refresh_vehicles()
+
+            started = time.perf_counter()
+            await scrapper.refresh_appointments()
+            # Let fan-out tasks run before next cycle
+            await asyncio.sleep(0)
+            cycle_timings.append(time.perf_counter() - started)
+            await clock.sleep(scrapper.refresh_interval)
+    finally:
+        await scrapper.close()
+        await server.close()
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    real_elapsed = time.perf_counter() - real_started
+    print("Replayed %d cycles (%.1f virtual hours) in %.1fs, %.0fx faster than real time" % (len(cycle_timings), clock.monotonic() / 3600, real_elapsed, clock.monotonic() / max(real_elapsed, 1e-9)))
+    print("Provider responses served: %d, unknown URLs: %d" % (server.served, server.missed))
+    print("Cycle (scrape, parse, diff, fan-out)  p50 %.1fms  p95 %.1fms  max %.1fms" % percentiles(cycle_timings))
+    print("Diff and fan-out                      p50 %.1fms  p95 %.1fms  max %.1fms" % percentiles(handler_timings))
+    print("Pushed %d updates holding %d appointments to %d clients" % (stats["pushes"], stats["pushed_appointments"], config.clients))
+
+
+if __name__ == "__main__":
+
+    CONFIG = get_arguments_from_cmd_line()
+    logging.basicConfig(level=logging.DEBUG if CONFIG.debug else logging.WARNING, format="%(levelname)-8s [%(name)s] %(message)s")
+
+    LOOP = asyncio.get_event_loop()
+    LOOP.run_until_complete(run_benchmark(CONFIG))
+    LOOP.close()
@@ -6,3 +6,10 @@ from .rest_appointments import RestAppointments
 from .rest_sites import RestSites
 from .rest_vehicles import RestVehicles
 from .ws_appointments import WsAppointments
+from .rest_profile import RestProfile
+from .rest_history import RestHistoryAppearances
+from .rest_capabilities import RestCapabilities
+from .rest_export import RestExport
+from .rest_webhooks import RestWebhooks
+from .rest_freshness import RestFreshness
+from .rest_heatmap import RestHeatmap
@@ -6,9 +6,21 @@ Return available appointments for given filter
 # pylint: disable=line-too-long
 
 
+import bisect
 import logging
 import datetime
-import aiohttp.web
+import json_codec
+
+
+def freshness_headers(data_age, changed_age):
+    """ Return headers telling how old returned data is, in seconds, unknown ages are left out """
+
+    headers = {}
+    if data_age is not None:
+        headers["X-Data-Age"] = str(int(data_age))
+    if changed_age is not None:
+        headers["X-Data-Changed-Age"] = str(int(changed_age))
+    return headers
 
 
 class RestAppointments:  # pylint: disable=too-few-public-methods
@@ -53,7 +65,7 @@ class RestAppointments:  # pylint: disable=too-few-public-methods
           name: organism
           description: SNCT or a private competitor
           type: string
-          enum: ["snct"]
+          enum: ["snct", "fake"]
           default: snct
           required: true
         - in: path
@@ -76,6 +88,13 @@ class RestAppointments:  # pylint: disable=too-few-public-methods
         responses:
           200:
             description: Available appointments slots returned
+            headers:
+              X-Data-Age:
+                type: integer
+                description: Seconds since appointments were last fetched successfully, missing if never
+              X-Data-Changed-Age:
+                type: integer
+                description: Seconds since appointments last changed, missing if they never did
             schema:
               title: List of_appointments
               type: array
@@ -116,14 +135,16 @@ class RestAppointments:  # pylint: disable=too-few-public-methods
         start_date = request.match_info["start_date"]
         end_date = request.match_info["end_date"]
 
-        # Dispatcher service having all appointments
+        # Dispatcher service having all appointments, and its current immutable state
         disp = request.app["apptm_disp"]
+        state = disp.state
 
         assert user_type in ["PRIVATE", "PROFESSIONAL"], "user_type must be one of PRIVATE, PROFESSIONAL"
         assert control_type in ["REGULAR", "REJECTED"], "user_type must be one of REGULAR, REJECTED"
-        assert vehicle_type in disp.appointments[user_type][control_type].keys(), "vehicle_type must be one of %s" % list(disp.appointments[user_type][control_type].keys())
-        assert organism in ["snct"], "user_type must be one of snct"
-        assert (organism, site) in disp.appointments[user_type][control_type][vehicle_type].keys(), "site must be one of %s" % list(disp.appointments[user_type][control_type][vehicle_type].keys())
+        assert vehicle_type in state.vehicle_types(user_type, control_type), "vehicle_type must be one of %s" % state.vehicle_types(user_type, control_type)
+        assert organism in disp.organisms, "organism must be one of %s" % ", ".join(sorted(disp.organisms))
+        assert (organism, site) in state.sites(user_type, control_type, vehicle_type), "site must be one of %s" % state.sites(user_type, control_type, vehicle_type)
+        assert disp.is_key_supported((user_type, control_type, vehicle_type, (organism, site))), "site %s does not handle %s vehicles for %s %s controls, see /capabilities" % (site, vehicle_type, user_type, control_type)
         try:
             start_date = datetime.datetime.strptime(start_date, "%Y-%m-%d")
         except:  # pylint: disable=broad-except
@@ -133,9 +154,14 @@ class RestAppointments:  # pylint: disable=too-few-public-methods
         except:  # pylint: disable=broad-except
             raise AssertionError("end_date must be a date like 2019-02-01")
 
-        appointments = disp.appointments[user_type][control_type][vehicle_type][(organism, site)]
+        key = (user_type, control_type, vehicle_type, (organism, site))
+        disp.touch_key(key)
+        appointments = state.get(key)
         if appointments is None:
-            appointments = []
+            appointments = ()
 
-        payload = [x.isoformat() for x in sorted(appointments) if x >= start_date and x < end_date]
-        return aiohttp.web.json_response(payload, status=200)
+        # Appointments of a state are sorted
+        payload = list(appointments[bisect.bisect_left(appointments, start_date):bisect.bisect_left(appointments, end_date)])
+        # Lets compression middleware cache compressed body until key changes
+        request["data_version"] = disp.key_versions[key]
+        return json_codec.json_response(payload, status=200, headers=freshness_headers(*disp.key_freshness([key])))
@@ -0,0 +1,64 @@
+"""
+Return which vehicle types each site handles
+"""
+
+
+# pylint: disable=line-too-long
+
+
+import logging
+import json_codec
+
+
+class RestCapabilities:  # pylint: disable=too-few-public-methods
+    """
+    Return which vehicle types each site handles
+    """
+
+    logger = logging.getLogger(__name__)
+
+    @classmethod
+    async def get(cls, request):
+        """
+        ---
+        description: Return vehicle types handled by each site, for each user type and control type. Subscribing to other combinations is rejected
+        produces:
+        - application/json
+        tags:
+        - definitions
+        responses:
+          200:
+            description: Capability matrix returned
+            schema:
+              title: Capabilities
+              type: object
+              example:
+                snct:
+                  sandweiler:
+                    PRIVATE:
+                      REGULAR:
+                        - car
+                        - motocycle
+              description: Organism
+              additionalProperties:
+                type: object
+                description: Site
+                additionalProperties:
+                  type: object
+                  description: User type
+                  additionalProperties:
+                    type: object
+                    description: Control type
+                    additionalProperties:
+                      type: array
+                      items:
+                        type: string
+                        example: car
+        """
+
+        # Dispatcher service
+        disp = request.app["apptm_disp"]
+
+        # Matrix also grows when a key is refreshed for the first time
+        request["data_version"] = (disp.catalog_version, len(disp.key_versions))
+        return json_codec.json_response(disp.capabilities(), status=200)
@@ -0,0 +1,158 @@
+"""
+Stream all available appointments at once
+"""
+
+
+# pylint: disable=line-too-long
+
+
+import logging
+import aiohttp.web
+import json_codec
+import binary_codec
+
+
+class RestExport:  # pylint: disable=too-few-public-methods
+    """
+    Stream all available appointments at once, one line (or msgpack object) per key
+    """
+
+    logger = logging.getLogger(__name__)
+
+    # Number of keys encoded between two writes, writing gives control back to the loop
+    batch_size = 100
+
+    @staticmethod
+    def encode_ndjson(item):
+        """ Encode a record as a JSON line """
+
+        return json_codec.dumps_bytes(item) + b"\n"
+
+    @staticmethod
+    def encode_msgpack(item):
+        """ Encode a record as msgpack, datetimes are turned into local wall clock seconds since epoch """
+
+        if "appointments" in item:
+            item = dict(item, appointments=[binary_codec.epoch_seconds(x) for x in item["appointments"]])
+        return binary_codec.pack(item)
+
+    @classmethod
+    async def get(cls, request):
+        """
+        ---
+        description: |
+                     Stream all available appointments of every supported key, taken from a consistent snapshot
+
+                     First record is a header giving stream_id and seq of the snapshot, WebSocket clients can resume from it.
+                     Every following record holds appointments of one key.
+
+                     Default format is NDJSON (one JSON document per line), msgpack format is a stream of concatenated
+                     msgpack maps with timestamps as local wall clock seconds since epoch (needs msgpack package).
+        produces:
+        - application/x-ndjson
+        - application/x-msgpack
+        tags:
+        - appointments
+        parameters:
+        - in: query
+          name: format
+          description: Encoding of records
+          type: string
+          enum: ["ndjson", "msgpack"]
+          default: ndjson
+        responses:
+          200:
+            description: Records streamed
+            schema:
+              title: Export_record
+              type: object
+              properties:
+                stream_id:
+                  type: string
+                  description: Only in header record
+                  example: 2c1b9a8e6f0d4f7e9f2b8d3c4a5e6f70
+                seq:
+                  type: integer
+                  description: Only in header record
+                  example: 1234
+                keys:
+                  type: integer
+                  description: Number of following records, only in header record
+                  example: 320
+                user_type:
+                  type: string
+                  example: PRIVATE
+                control_type:
+                  type: string
+                  example: REGULAR
+                vehicle_type:
+                  type: string
+                  example: car
+                organism:
+                  type: string
+                  example: snct
+                site:
+                  type: string
+                  example: sandweiler
+                appointments:
+                  type: array
+                  items:
+                    type: string
+                    format: date-time
+          400:
+            description: Bad request
+            schema:
+              title: Bad_Request
+              type: object
+              required:
+                - status
+                - message
+              properties:
+                message:
+                  type: string
+                  description: Validation error message
+                  example: "format must be one of ndjson, msgpack"
+                status:
+                  type: integer
+                  description: HTTP error status code
+                  example: 400
+        """
+
+        export_format = request.query.get("format", "ndjson")
+        assert export_format in ["ndjson", "msgpack"], "format must be one of ndjson, msgpack"
+        assert export_format != "msgpack" or binary_codec.AVAILABLE, "msgpack format is not available, msgpack package is not installed"
+
+        # Dispatcher service
+        disp = request.app["apptm_disp"]
+
+        stream_id, seq, keys = await disp.snapshot()
+
+        if export_format == "msgpack":
+            encode = cls.encode_msgpack
+            content_type = "application/x-msgpack"
+        else:
+            encode = cls.encode_ndjson
+            content_type = "application/x-ndjson"
+
+        response = aiohttp.web.StreamResponse(status=200, headers={"Content-Type": content_type})
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+
+        await response.write(encode({"stream_id": stream_id, "seq": seq, "keys": len(keys)}))
+        for idx in range(0, len(keys), cls.batch_size):
+            chunk = b"".join(
+                encode({
+                    "user_type": user_type,
+                    "control_type": control_type,
+                    "vehicle_type": vehicle_type,
+                    "organism": site[0],
+                    "site": site[1],
+                    "appointments": appointments,
+                })
+                for (user_type, control_type, vehicle_type, site), appointments in keys[idx:idx + cls.batch_size]
+            )
+            await response.write(chunk)
+
+        await response.write_eof()
+        cls.logger.info("Exported %d keys as %s at seq %d", len(keys), export_format, seq)
+        return response
@@ -0,0 +1,80 @@
+"""
+Return how fresh appointments are compared to freshness target
+"""
+
+
+# pylint: disable=line-too-long
+
+
+import logging
+import json_codec
+
+
+class RestFreshness:  # pylint: disable=too-few-public-methods
+    """
+    Return how fresh appointments are compared to freshness target
+    """
+
+    logger = logging.getLogger(__name__)
+
+    @classmethod
+    async def get(cls, request):
+        """
+        ---
+        description: |
+                     Return staleness SLO report, age of a key being the number of seconds since its appointments were last fetched successfully.
+                     Unsupported keys are left out, in_demand keys are those having subscribers or queried recently.
+
+                       * current: keys within --freshness-target right now, with a cumulative histogram of their ages
+                       * time_weighted: ratio of time keys spent within target since start, with cumulative histogram of key-seconds
+                         spent in each age bucket, only in_demand keys are compared to --freshness-objective as idle ones
+                         are polled every --idle-refresh-interval
+                       * stalest: keys fetched the longest time ago, with their number of consecutive failures
+        produces:
+        - application/json
+        tags:
+        - admin
+        responses:
+          200:
+            description: Staleness report returned
+            schema:
+              title: Freshness
+              type: object
+              example:
+                target_seconds: 120
+                objective: 0.99
+                current:
+                  all:
+                    keys: 480
+                    within_target: 478
+                    ratio: 0.9958
+                    histogram: {"30": 12, "60": 400, "120": 478, "300": 479, "600": 479, "1800": 479, "3600": 480, "14400": 480, "+Inf": 480}
+                  in_demand:
+                    keys: 20
+                    within_target: 20
+                    ratio: 1.0
+                    histogram: {"30": 2, "60": 20, "120": 20, "300": 20, "600": 20, "1800": 20, "3600": 20, "14400": 20, "+Inf": 20}
+                time_weighted:
+                  all:
+                    ratio: 0.3412
+                    objective_met: null
+                    histogram_seconds: {"30": 1200.0, "60": 41000.5, "120": 98000.0, "300": 98500.0, "600": 98600.0, "1800": 288000.0, "3600": 288000.0, "14400": 288000.0, "+Inf": 288000.0}
+                  in_demand:
+                    ratio: 0.9912
+                    objective_met: true
+                    histogram_seconds: {"30": 1200.0, "60": 41000.5, "120": 98000.0, "300": 98500.0, "600": 98600.0, "1800": 98800.0, "3600": 98850.0, "14400": 98870.0, "+Inf": 98870.0}
+                stalest:
+                  - user_type: PRIVATE
+                    control_type: REGULAR
+                    vehicle_type: car
+                    organism: snct
+                    site: sandweiler
+                    age: 1260.2
+                    changed_age: 4000.8
+                    failures: 21
+        """
+
+        # Dispatcher service
+        disp = request.app["apptm_disp"]
+
+        return json_codec.json_response(disp.freshness_report(), status=200)
@@ -0,0 +1,159 @@
+"""
+Return number of available appointments per day or per hour
+"""
+
+
+# pylint: disable=line-too-long
+
+
+import logging
+import datetime
+import json_codec
+import services
+
+
+class RestHeatmap:  # pylint: disable=too-few-public-methods
+    """
+    Return number of available appointments per day or per hour
+    """
+
+    logger = logging.getLogger(__name__)
+
+    filters = ("user_type", "control_type", "vehicle_type", "organism", "site")
+
+    @classmethod
+    async def get(cls, request):
+        """
+        ---
+        description: |
+                     Return number of available appointments of each key per day, or per day and hour.
+                     Counts are maintained as appointments change, so this is much cheaper than fetching all timeslots.
+                     Use WebSocket route with `{"criterias": [...], "heatmap": "day"}` subscription to receive updates.
+        produces:
+        - application/json
+        tags:
+        - appointments
+        parameters:
+        - in: path
+          name: granularity
+          description: Count appointments per day or per day and hour
+          type: string
+          enum: ["day", "hour"]
+          default: day
+          required: true
+        - in: query
+          name: user_type
+          description: Only return counts of this type of user
+          type: string
+          enum: ["PRIVATE", "PROFESSIONAL"]
+          required: false
+        - in: query
+          name: control_type
+          description: Only return counts of this type of control
+          type: string
+          enum: ["REGULAR", "REJECTED"]
+          required: false
+        - in: query
+          name: vehicle_type
+          description: Only return counts of this type of vehicle
+          type: string
+          required: false
+        - in: query
+          name: organism
+          description: Only return counts of this organism sites
+          type: string
+          required: false
+        - in: query
+          name: site
+          description: Only return counts of this site
+          type: string
+          required: false
+        - in: query
+          name: start_date
+          description: Only return days after this date (included)
+          type: string
+          format: date
+          required: false
+        - in: query
+          name: end_date
+          description: Only return days before this date (included)
+          type: string
+          format: date
+          required: false
+        responses:
+          200:
+            description: Appointments counts returned
+            schema:
+              title: Heatmap
+              type: array
+              items:
+                type: object
+                required:
+                  - user_type
+                  - control_type
+                  - vehicle_type
+                  - organism
+                  - site
+                  - counts
+                properties:
+                  user_type:
+                    type: string
+                  control_type:
+                    type: string
+                  vehicle_type:
+                    type: string
+                  organism:
+                    type: string
+                  site:
+                    type: string
+                  counts:
+                    type: object
+                    description: Number of appointments per day, or per day then per hour (two digits) with hour granularity
+                    example: {"2019-01-02": 4, "2019-01-03": 1}
+          400:
+            description: Bad request
+            schema:
+              title: Bad_Request
+              type: object
+              required:
+                - status
+                - message
+              properties:
+                message:
+                  type: string
+                  description: Validation error message
+                  example: "granularity must be one of day, hour"
+                status:
+                  type: integer
+                  description: HTTP error status code
+                  example: 400
+        """
+
+        granularity = request.match_info["granularity"]
+        assert granularity in services.HEATMAP_GRANULARITIES, "granularity must be one of %s" % ", ".join(services.HEATMAP_GRANULARITIES)
+
+        dates = {}
+        for name in ["start_date", "end_date"]:
+            value = request.query.get(name, None)
+            try:
+                dates[name] = datetime.datetime.strptime(value, "%Y-%m-%d").date() if value is not None else None
+            except ValueError:
+                raise AssertionError("%s must be a date like 2019-01-01" % name)
+        filters = {x: request.query[x] for x in cls.filters if x in request.query}
+
+        # Dispatcher service
+        disp = request.app["apptm_disp"]
+
+        payload = []
+        for key in sorted(disp.heatmap.days):
+            if not disp.is_key_supported(key):
+                continue
+            item = disp.describe_key(key)
+            if any(item[x] != y for x, y in filters.items()):
+                continue
+            item["counts"] = disp.heatmap.view(key, granularity, start=dates["start_date"], end=dates["end_date"])
+            payload.append(item)
+
+        # Lets compression middleware cache compressed body until counts change
+        request["data_version"] = (disp.heatmap.version, disp.catalog_version)
+        return json_codec.json_response(payload, status=200)
@@ -0,0 +1,135 @@
+"""
+Return statistics about appointments slots history
+"""
+
+
+# pylint: disable=line-too-long
+
+
+import time
+import logging
+import datetime
+import json_codec
+
+
+class RestHistoryAppearances:  # pylint: disable=too-few-public-methods
+    """
+    Return when cancelled appointments slots usually appear
+    """
+
+    logger = logging.getLogger(__name__)
+
+    @classmethod
+    async def get(cls, request):
+        """
+        ---
+        description: Return number of appointments slots which appeared, by site, weekday and hour they were noticed (Lux local time)
+        produces:
+        - application/json
+        tags:
+        - history
+        parameters:
+        - in: query
+          name: organism
+          description: SNCT or a private competitor
+          type: string
+          enum: ["snct", "fake"]
+        - in: query
+          name: site
+          description: Site name, like esch_sur_alzette for SNCT
+          type: string
+        - in: query
+          name: vehicle_type
+          description: Type of vehicle
+          type: string
+          enum: ["motocycle", "car", "bus", "small_trailer", "large_trailer", "van", "truck", "tractor"]
+        - in: query
+          name: since
+          description: Only count slots noticed after this date (included), defaults to 90 days ago
+          type: string
+          format: date
+        - in: query
+          name: until
+          description: Only count slots noticed before this date (excluded), defaults to now
+          type: string
+          format: date
+        responses:
+          200:
+            description: Appearance counts returned
+            schema:
+              title: List of_appearances
+              type: array
+              items:
+                type: object
+                required:
+                  - organism
+                  - site
+                  - weekday
+                  - hour
+                  - count
+                  - rate_per_week
+                properties:
+                  organism:
+                    type: string
+                    example: snct
+                  site:
+                    type: string
+                    example: sandweiler
+                  weekday:
+                    type: integer
+                    description: Day of week slots were noticed, 0 is Monday
+                    example: 0
+                  hour:
+                    type: integer
+                    description: Hour of day slots were noticed
+                    example: 8
+                  count:
+                    type: integer
+                    description: Number of slots which appeared
+                    example: 42
+                  rate_per_week:
+                    type: number
+                    description: Average number of slots which appeared per week
+                    example: 3.5
+          400:
+            description: Bad request
+            schema:
+              title: Bad_Request
+              type: object
+              required:
+                - status
+                - message
+              properties:
+                message:
+                  type: string
+                  description: Validation error message
+                  example: "since must be a date like 2019-01-01"
+                status:
+                  type: integer
+                  description: HTTP error status code
+                  example: 400
+        """
+
+        store = request.app["slot_history"]
+
+        now = int(time.time())
+        since = now - 90 * 24 * 3600
+        until = now
+        epoch = datetime.datetime(1970, 1, 1)
+
+        if "since" in request.query:
+            try:
+                since = int((datetime.datetime.strptime(request.query["since"], "%Y-%m-%d") - epoch).total_seconds())
+            except ValueError:
+                raise AssertionError("since must be a date like 2019-01-01")
+        if "until" in request.query:
+            try:
+                until = int((datetime.datetime.strptime(request.query["until"], "%Y-%m-%d") - epoch).total_seconds())
+            except ValueError:
+                raise AssertionError("until must be a date like 2019-02-01")
+        assert since < until, "since must be before until"
+
+        payload = await store.appearances(
+            since, until, organism=request.query.get("organism", None), site=request.query.get("site", None), vehicle_type=request.query.get("vehicle_type", None)
+        )
+        return json_codec.json_response(payload, status=200)
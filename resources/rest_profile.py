@@ -0,0 +1,125 @@
+"""
+Profile running event loop on demand
+"""
+
+
+# pylint: disable=line-too-long
+
+
+import asyncio
+import logging
+import aiohttp.web
+
+
+class RestProfile:  # pylint: disable=too-few-public-methods
+    """
+    Profile running event loop on demand
+    """
+
+    logger = logging.getLogger(__name__)
+
+    @classmethod
+    async def get(cls, request):
+        """
+        ---
+        description: |
+                     Profile the running event loop and return the report as text
+
+                     * scope `time` profiles everything running on the loop for given number of seconds
+                     * scope `cycle` waits for next appointments refresh cycle (scrapping, diffing and publishing) and profiles it,
+                       it is not available with --shard-socket as scrapping happens in scrapper_node.py processes
+                     * format `pstats` is cProfile output, `collapsed` is sampled stacks usable by flamegraph.pl or speedscope
+        produces:
+        - text/plain
+        tags:
+        - admin
+        parameters:
+        - in: query
+          name: scope
+          description: Profile a fixed duration or next refresh cycle
+          type: string
+          enum: ["time", "cycle"]
+          default: time
+        - in: query
+          name: seconds
+          description: Duration of profile when scope is time
+          type: number
+          default: 10
+        - in: query
+          name: timeout
+          description: Seconds to wait for next refresh cycle when scope is cycle, 504 is returned if none happened
+          type: number
+          default: 300
+        - in: query
+          name: format
+          description: Output format
+          type: string
+          enum: ["pstats", "collapsed"]
+          default: pstats
+        - in: query
+          name: sort
+          description: pstats sort key
+          type: string
+          enum: ["cumulative", "tottime", "ncalls"]
+          default: cumulative
+        - in: query
+          name: limit
+          description: Number of functions in pstats output
+          type: integer
+          default: 100
+        responses:
+          200:
+            description: Profile report
+          400:
+            description: Bad request
+            schema:
+              title: Bad_Request
+              type: object
+              required:
+                - status
+                - message
+              properties:
+                message:
+                  type: string
+                  description: Validation error message
+                  example: "a profile is already running"
+                status:
+                  type: integer
+                  description: HTTP error status code
+                  example: 400
+        """
+
+        profiler = request.app["profiler"]
+
+        scope = request.query.get("scope", "time")
+        fmt = request.query.get("format", "pstats")
+        sort = request.query.get("sort", "cumulative")
+
+        assert scope in ["time", "cycle"], "scope must be one of time, cycle"
+        assert fmt in profiler.formats, "format must be one of %s" % ", ".join(profiler.formats)
+        assert sort in ["cumulative", "tottime", "ncalls"], "sort must be one of cumulative, tottime, ncalls"
+        try:
+            seconds = float(request.query.get("seconds", 10))
+            assert 0 < seconds <= 300
+        except (ValueError, AssertionError):
+            raise AssertionError("seconds must be a number between 0 and 300")
+        try:
+            timeout = float(request.query.get("timeout", 300))
+            assert 0 < timeout <= 900
+        except (ValueError, AssertionError):
+            raise AssertionError("timeout must be a number between 0 and 900")
+        try:
+            limit = int(request.query.get("limit", 100))
+        except ValueError:
+            raise AssertionError("limit must be an integer")
+
+        if scope == "cycle":
+            assert request.app.get("snct_scrapper", None) is not None, "scope cycle requires a local scrapper, not available with --shard-socket"
+            try:
+                report = await profiler.profile_next_cycle(fmt=fmt, sort=sort, limit=limit, timeout=timeout)
+            except asyncio.TimeoutError:
+                raise aiohttp.web.HTTPGatewayTimeout(reason="No refresh cycle happened in time")
+        else:
+            report = await profiler.profile_for(seconds, fmt=fmt, sort=sort, limit=limit)
+
+        return aiohttp.web.Response(text=report, status=200, content_type="text/plain")
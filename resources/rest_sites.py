@@ -8,7 +8,7 @@ Return list of organisms and sites
 
 import logging
 import collections
-import aiohttp.web
+import json_codec
 
 
 class RestSites:  # pylint: disable=too-few-public-methods
@@ -51,8 +51,9 @@ class RestSites:  # pylint: disable=too-few-public-methods
         # Dispatcher service
         disp = request.app["apptm_disp"]
 
+        request["data_version"] = disp.catalog_version
         payload = collections.defaultdict(list)
         for organism, site in disp.sites:
             payload[organism].append(site)
 
-        return aiohttp.web.json_response(payload, status=200)
+        return json_codec.json_response(payload, status=200)
@@ -7,7 +7,7 @@ Return list of vehicle categories
 
 
 import logging
-import aiohttp.web
+import json_codec
 
 
 class RestVehicles:  # pylint: disable=too-few-public-methods
@@ -49,4 +49,5 @@ class RestVehicles:  # pylint: disable=too-few-public-methods
         # Dispatcher service
         disp = request.app["apptm_disp"]
 
-        return aiohttp.web.json_response(list(disp.vehicle_types.keys()), status=200)
+        request["data_version"] = disp.catalog_version
+        return json_codec.json_response(list(disp.vehicle_types.keys()), status=200)
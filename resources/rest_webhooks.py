@@ -0,0 +1,162 @@
+"""
+Manage webhooks receiving appointments updates
+"""
+
+
+# pylint: disable=line-too-long
+
+
+import logging
+import aiohttp.web
+import json_codec
+from .ws_appointments import validate_criterias
+
+
+class RestWebhooks:
+    """
+    Subscribe, show and unsubscribe webhooks
+    """
+
+    logger = logging.getLogger(__name__)
+
+    # Only these fields of each criteria are kept, persisted and returned
+    criteria_fields = ("user_type", "control_type", "vehicle_type", "organism", "site", "start_dt", "end_dt")
+
+    @classmethod
+    async def post(cls, request):
+        """
+        ---
+        description: |
+                     Subscribe a webhook, matching appointments updates will be POSTed to its URL
+
+                     Updates of a refresh cycle going to the same URL are batched as
+                     `{"stream_id": "...", "deliveries": [{"id": "...", "seq": 42, "added": [...], "removed": [...]}]}`.
+                     Failed deliveries are retried with backoff, answering 410 Gone unsubscribes the URL.
+        consumes:
+        - application/json
+        produces:
+        - application/json
+        tags:
+        - webhooks
+        parameters:
+        - in: body
+          name: webhook
+          description: |
+                       URL and criterias, criterias being the same as WebSocket ones (unknown fields are dropped).
+                       URL host must have a public address unless server runs with --webhook-allow-private,
+                       number of criterias and of webhooks are limited by --webhook-max-criterias and --webhook-max-subscriptions.
+          schema:
+            type: object
+            required:
+              - url
+              - criterias
+            properties:
+              url:
+                type: string
+                example: https://partner.example.com/appointments
+              criterias:
+                type: array
+                items:
+                  type: object
+        responses:
+          201:
+            description: Webhook subscribed
+            schema:
+              title: Webhook
+              type: object
+              properties:
+                id:
+                  type: string
+                  description: Webhook id, needed to unsubscribe
+                  example: 0b8d4e4b1a5c4c6f9c1f1a4f6b1bd7a1
+                url:
+                  type: string
+                criterias:
+                  type: array
+                  items:
+                    type: object
+          400:
+            description: Bad request
+            schema:
+              title: Bad_Request
+              type: object
+              required:
+                - status
+                - message
+              properties:
+                message:
+                  type: string
+                  description: Validation error message
+                  example: "url must be an http or https URL"
+                status:
+                  type: integer
+                  description: HTTP error status code
+                  example: 400
+        """
+
+        try:
+            body = json_codec.loads(await request.read())
+        except ValueError:
+            raise AssertionError("body must be a JSON object")
+        assert isinstance(body, dict), "body must be a JSON object"
+
+        webhooks = request.app["webhooks"]
+        url = body.get("url", None)
+        await webhooks.check_url(url)
+        criterias = body.get("criterias", None)
+        assert not isinstance(criterias, list) or 1 <= len(criterias) <= webhooks.max_criterias, "criterias must contain between 1 and %d items" % webhooks.max_criterias
+        criterias = [{x: y.get(x, None) for x in cls.criteria_fields} for y in validate_criterias(request.app["apptm_disp"], criterias)]
+
+        subscription = await webhooks.add(url, criterias)
+        return json_codec.json_response(subscription.to_dict(), status=201)
+
+    @classmethod
+    async def get(cls, request):
+        """
+        ---
+        description: Return a webhook subscription
+        produces:
+        - application/json
+        tags:
+        - webhooks
+        parameters:
+        - in: path
+          name: webhook_id
+          description: Webhook id returned on subscription
+          type: string
+          required: true
+        responses:
+          200:
+            description: Webhook returned
+          404:
+            description: Unknown webhook
+        """
+
+        subscription = request.app["webhooks"].subscriptions.get(request.match_info["webhook_id"], None)
+        if subscription is None:
+            raise aiohttp.web.HTTPNotFound()
+        return json_codec.json_response(subscription.to_dict(), status=200)
+
+    @classmethod
+    async def delete(cls, request):
+        """
+        ---
+        description: Unsubscribe a webhook
+        tags:
+        - webhooks
+        parameters:
+        - in: path
+          name: webhook_id
+          description: Webhook id returned on subscription
+          type: string
+          required: true
+        responses:
+          204:
+            description: Webhook unsubscribed
+          404:
+            description: Unknown webhook
+        """
+
+        if not await request.app["webhooks"].remove(request.match_info["webhook_id"]):
+            raise aiohttp.web.HTTPNotFound()
+        return aiohttp.web.Response(status=204)
@@ -10,11 +10,67 @@ WebSocket API:
 
 import asyncio
 import logging
-import datetime
 import functools
-import json
+import collections
 import aiohttp
 import dateutil.parser
+import json_codec
+import binary_codec
+import log_pipeline
+import services
+
+
+# Negotiated with Sec-WebSocket-Protocol, clients not asking for any get JSON
+JSON_PROTOCOL = "appointments.json.v1"
+BINARY_PROTOCOL = "appointments.msgpack.v1"
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_criteria_dt(value):
+    """ Parse a criteria date or datetime, cached as reconnecting clients keep sending the same ones """
+
+    return dateutil.parser.parse(value[:19])
+
+
+def validate_criterias(disp, criterias):
+    """
+    Validate appoitments criteria, parsing start_dt and end_dt in place
+    Shared by WebSocket and webhook subscriptions
+    """
+
+    assert isinstance(criterias, list), "criterias must be a list of dict"
+    assert all([isinstance(x, dict) for x in criterias]), "criterias must be a list of dict"
+
+    state = disp.state
+    for criteria in criterias:
+
+        user_type = criteria.get("user_type", None)
+        control_type = criteria.get("control_type", None)
+        vehicle_type = criteria.get("vehicle_type", None)
+        organism = criteria.get("organism", None)
+        site = criteria.get("site", None)
+        start_dt = criteria.get("start_dt", None)
+        end_dt = criteria.get("end_dt", None)
+
+        assert user_type in ["PRIVATE", "PROFESSIONAL"], "user_type must be one of PRIVATE, PROFESSIONAL"
+        assert control_type in ["REGULAR", "REJECTED"], "user_type must be one of REGULAR, REJECTED"
+        assert vehicle_type in state.vehicle_types(user_type, control_type), "vehicle_type must be one of %s" % state.vehicle_types(user_type, control_type)
+        assert organism in disp.organisms, "organism must be one of %s" % ", ".join(sorted(disp.organisms))
+        organism_site = (organism, site)
+        assert organism_site in state.sites(user_type, control_type, vehicle_type), "site must be one of %s" % state.sites(user_type, control_type, vehicle_type)
+        assert disp.is_key_supported((user_type, control_type, vehicle_type, organism_site)), "site %s does not handle %s vehicles for %s %s controls, see /capabilities" % (site, vehicle_type, user_type, control_type)
+        try:
+            start_dt = parse_criteria_dt(start_dt)
+            criteria["start_dt"] = start_dt
+        except:  # pylint: disable=broad-except
+            raise AssertionError("start_dt must be a date like 2019-01-01 or a datetime like 2019-01-01T08:15:00")
+        try:
+            end_dt = parse_criteria_dt(end_dt)
+            criteria["end_dt"] = end_dt
+        except:  # pylint: disable=broad-except
+            raise AssertionError("end_dt must be a date like 2019-02-01 or a datetime like 2019-01-01T09:30:00")
+
+    return criterias
 
 
 class WsAppointments:  # pylint: disable=invalid-name,too-few-public-methods
@@ -24,8 +80,59 @@ class WsAppointments:  # pylint: disable=invalid-name,too-few-public-methods
       * Appointment dispatcher send appointments matching criteria
     """
 
-    def __init__(self):
+    def __init__(self, connect_rate=50, connect_burst=100, connect_queue=1000, snapshot_cache_size=1024, compress=True, delta_cache_size=1024):  # pylint: disable=too-many-arguments
         self.logger = logging.getLogger(self.__class__.__name__)
+        # Negotiate permessage-deflate with clients supporting it
+        self.compress = compress
+        # Admission control to survive all clients reconnecting at once after a restart
+        self.admission = services.AdmissionQueue(rate=connect_rate, burst=connect_burst, max_queue=connect_queue)
+        # Encoded initial snapshots shared by subscribers having identical criterias
+        self.snapshot_cache = collections.OrderedDict()
+        self.snapshot_cache_size = snapshot_cache_size
+        # Encoded updates shared by subscribers of the same subprotocol having identical criterias
+        self.delta_cache = collections.OrderedDict()
+        self.delta_cache_size = delta_cache_size
+        self.protocols = (JSON_PROTOCOL, BINARY_PROTOCOL) if binary_codec.AVAILABLE else (JSON_PROTOCOL,)
+
+    def cached_snapshot(self, disp, criterias, build, binary=False):
+        """
+        Return JSON encoded list of appointments matching criterias, or msgpack encoded {key_id: [seconds, ...]} if binary
+        build callable is only called if criterias and version of their keys are not in cache
+        """
+
+        normalized = disp.criterias_signature(criterias)
+        versions = tuple(disp.key_versions[(x[0], x[1], x[2], (x[3], x[4]))] for x in normalized)
+        cache_key = (normalized, versions, binary)
+
+        try:
+            encoded = self.snapshot_cache[cache_key]
+        except KeyError:
+            if binary:
+                encoded = binary_codec.pack(binary_codec.group_by_key_id(build(), disp.key_id))
+            else:
+                encoded = json_codec.dumps(build())
+            self.snapshot_cache[cache_key] = encoded
+            if len(self.snapshot_cache) > self.snapshot_cache_size:
+                self.snapshot_cache.popitem(last=False)
+        else:
+            self.snapshot_cache.move_to_end(cache_key)
+
+        return encoded
+
+    def cached_delta(self, cache_key, encode):
+        """
+        Return encoded part of an update shared by subscribers, for given (protocol, stream_id, seq, snapshot, criterias signature) cache key
+        encode callable is only called by first subscriber pushing this update, per session fields like ages are not cached
+        """
+
+        try:
+            encoded = self.delta_cache[cache_key]
+        except KeyError:
+            encoded = encode()
+            self.delta_cache[cache_key] = encoded
+            if len(self.delta_cache) > self.delta_cache_size:
+                self.delta_cache.popitem(last=False)
+        return encoded
 
     async def get(self, request):
         """
@@ -35,6 +142,21 @@ class WsAppointments:  # pylint: disable=invalid-name,too-few-public-methods
 
                      * body is the type of message you need to send as subscription criterias
                      * 101 response is defining the type of messages you will receive
+
+                     To resume a session after reconnecting, send `{"criterias": [...], "stream_id": "...", "last_seq": 42}`
+                     using `stream_id` and `seq` of the last message received. Only missed updates are sent if they are still
+                     in server history, otherwise a full snapshot (`snapshot: true`) is sent.
+
+                     To receive slot counts instead of slots, send `{"criterias": [...], "heatmap": "day"}` (or `"hour"`).
+                     Messages are then `{"status", "stream_id", "seq", "snapshot", "heatmap": "day", "counts": [...]}`,
+                     counts being like /heatmap ones. Updates only hold changed days or hours, with 0 for emptied ones.
+
+                     High-volume subscribers can negotiate `appointments.msgpack.v1` subprotocol (Sec-WebSocket-Protocol header,
+                     needs msgpack on server side). Subscription is still sent as JSON text, server sends binary msgpack maps:
+                       * `{"t": "keys", "keys": {1: [user_type, control_type, vehicle_type, organism, site], ...}}` announcing ids of subscribed keys
+                       * `{"t": "delta", "status", "stream_id", "seq", "snapshot", "data_age", "changed_age", "added": {1: [seconds, ...]}, "removed": {...}}`,
+                         timestamps being Lux local time as seconds since epoch
+                       * `{"t": "error", "status", "message"}`
         produces:
         - application/json
         tags:
@@ -83,7 +205,7 @@ class WsAppointments:  # pylint: disable=invalid-name,too-few-public-methods
               organism:
                 description: SNCT or a private competitor
                 type: string
-                enum: ["snct"]
+                enum: ["snct", "fake"]
                 default: snct
               site:
                 description: Site name, like esch_sur_alzette for SNCT
@@ -96,6 +218,9 @@ class WsAppointments:  # pylint: disable=invalid-name,too-few-public-methods
               type: object
               required:
                 - status
+                - stream_id
+                - seq
+                - snapshot
                 - added
                 - removed
               properties:
@@ -103,6 +228,26 @@ class WsAppointments:  # pylint: disable=invalid-name,too-few-public-methods
                   type: integer
                   description: HTTP success code
                   example: 200
+                stream_id:
+                  type: string
+                  description: Identifier of server updates stream, changes when server restarts
+                  example: 0b8d4e4b1a5c4c6f9c1f1a4f6b1bd7a1
+                seq:
+                  type: integer
+                  description: Sequence number of last update included in this message, to be sent back as last_seq when resuming
+                  example: 42
+                snapshot:
+                  type: boolean
+                  description: True if added is the full list of matching appointments and client state must be reset
+                  example: true
+                data_age:
+                  type: integer
+                  description: Seconds since the least recently fetched subscribed key was fetched successfully, null if one was never fetched
+                  example: 45
+                changed_age:
+                  type: integer
+                  description: Seconds since appointments of a subscribed key last changed, null if none did
+                  example: 600
                 added:
                   title: List of new available appointments
                   type: array
@@ -134,7 +279,7 @@ class WsAppointments:  # pylint: disable=invalid-name,too-few-public-methods
                       organism:
                         description: SNCT or a private competitor
                         type: string
-                        enum: ["snct"]
+                        enum: ["snct", "fake"]
                         default: snct
                       site:
                         description: Site name, like esch_sur_alzette for SNCT
@@ -174,7 +319,7 @@ class WsAppointments:  # pylint: disable=invalid-name,too-few-public-methods
                       organism:
                         description: SNCT or a private competitor
                         type: string
-                        enum: ["snct"]
+                        enum: ["snct", "fake"]
                         default: snct
                       site:
                         description: Site name, like esch_sur_alzette for SNCT
@@ -200,6 +345,23 @@ class WsAppointments:  # pylint: disable=invalid-name,too-few-public-methods
                   type: integer
                   description: HTTP error status code
                   example: 400
+          503:
+            description: Too many clients are connecting, retry after number of seconds given in Retry-After header
+            schema:
+              title: Service_Unavailable
+              type: object
+              required:
+                - status
+                - message
+              properties:
+                message:
+                  type: string
+                  description: Error message
+                  example: Service Unavailable
+                status:
+                  type: integer
+                  description: HTTP error status code
+                  example: 503
           403:
             description: Forbidden
             schema:
@@ -219,7 +381,12 @@ class WsAppointments:  # pylint: disable=invalid-name,too-few-public-methods
                   example: 403
         """
 
-        self.logger.info("New client subscribed to appointments WS stream")
+        if not await self.admission.admit():
+            retry_after = self.admission.retry_after
+            self.logger.warning("Too many WebSocket clients connecting, rejecting and asking to retry in %ds", retry_after, extra=log_pipeline.RATE_LIMITED)
+            raise aiohttp.web.HTTPServiceUnavailable(headers={"Retry-After": str(retry_after)})
+
+        self.logger.info("New client subscribed to appointments WS stream", extra=log_pipeline.RATE_LIMITED)
         ws_handler = WsHandler(self, request, asyncio.Task.current_task())
         await ws_handler.prepare()
         ws_obj = await ws_handler.run_forever()
@@ -236,8 +403,25 @@ class WsHandler:
         self.factory = factory
         self.request = request
         self.aiohttp_task = aiohttp_task
-        self.ws = aiohttp.web.WebSocketResponse(heartbeat=30)  # pylint: disable=invalid-name,no-member
+        self.ws = aiohttp.web.WebSocketResponse(heartbeat=30, compress=factory.compress, protocols=factory.protocols)  # pylint: disable=invalid-name,no-member
         self.criterias = None
+        self.signature = None
+        self.keys = []
+        # "day" or "hour" if client subscribed to slot counts instead of slots
+        self.heatmap = None
+        self.announced_key_ids = set()
+
+    @property
+    def binary(self):
+        """ Tell if client negotiated binary subprotocol """
+
+        return self.ws.ws_protocol == BINARY_PROTOCOL
+
+    @property
+    def protocol(self):
+        """ Return negotiated subprotocol, JSON one if client did not ask for any """
+
+        return BINARY_PROTOCOL if self.binary else JSON_PROTOCOL
 
     @property
     def app(self):
@@ -251,14 +435,6 @@ class WsHandler:
 
         return self.app["apptm_disp"]
 
-    @staticmethod
-    def json_serializer(payload):
-        """ A serializer handling datetime.datetime to iso8601 """
-
-        if isinstance(payload, datetime.datetime):
-            return payload.isoformat()
-        return payload
-
     def add_to_ws_stream_coro(self):
         """
         Add this handler coroutine to an aiohttp server service
@@ -283,68 +459,109 @@ class WsHandler:
 
         await self.ws.prepare(self.request)
         self.add_to_ws_stream_coro()
-        self.logger.info("Client connected")
+        self.logger.info("Client connected", extra=log_pipeline.RATE_LIMITED)
 
     async def send_json(self, payload):
         """ Send a JSON to WebSocket client """
 
-        json_dumper = functools.partial(json.dumps, default=self.json_serializer)
+        await self.send_str(json_codec.dumps(payload))
+
+    async def send_str(self, data):
+        """ Send an already encoded JSON to WebSocket client """
 
         # Changed in version 3.0: The method is converted into coroutine
-        if asyncio.iscoroutinefunction(self.ws.send_json):
-            await self.ws.send_json(payload, dumps=json_dumper)
+        if asyncio.iscoroutinefunction(self.ws.send_str):
+            await self.ws.send_str(data)
+        else:
+            self.ws.send_str(data)
+
+    async def send_bytes(self, data):
+        """ Send an already encoded binary message to WebSocket client """
+
+        if asyncio.iscoroutinefunction(self.ws.send_bytes):
+            await self.ws.send_bytes(data)
         else:
-            self.ws.send_json(payload, dumps=json_dumper)
+            self.ws.send_bytes(data)
+
+    async def send_error(self, status, message):
+        """ Send an error to WebSocket client using negotiated subprotocol """
+
+        if self.binary:
+            await self.send_bytes(binary_codec.pack({"t": "error", "status": status, "message": message}))
+        else:
+            await self.send_json({"message": message, "status": status})
+
+    def freshness(self):
+        """ Return data_age and changed_age of subscribed keys, in seconds """
+
+        data_age, changed_age = self.disp.key_freshness(self.keys)
+        return {
+            "data_age": None if data_age is None else int(data_age),
+            "changed_age": None if changed_age is None else int(changed_age),
+        }
+
+    def keys_announcement(self):
+        """ Return binary message announcing ids of subscribed keys not announced yet in this session, None if none """
+
+        keys = {}
+        for user_type, control_type, vehicle_type, organism, site, _, _ in self.signature:
+            key = (user_type, control_type, vehicle_type, (organism, site))
+            key_id = self.disp.key_id(key)
+            if key_id not in self.announced_key_ids:
+                keys[key_id] = [user_type, control_type, vehicle_type, organism, site]
+        if not keys:
+            return None
+        self.announced_key_ids.update(keys)
+        return binary_codec.pack({"t": "keys", "keys": keys})
 
     async def close(self):
         """ Close WebSocket object """
 
         await self.ws.close()
         self.remove_from_ws_stream_coro()
-        self.disp.unregister_appointment_client(self)
-        self.logger.info("Client disconnected")
+        self.unregister()
+        self.logger.info("Client disconnected", extra=log_pipeline.RATE_LIMITED)
+
+    def unregister(self):
+        """ Unregister from dispatcher, whatever kind of subscription client made """
+
+        if self in self.disp.heatmap_clients:
+            self.disp.unregister_heatmap_client(self)
+        if self in self.disp.appointments_clients:
+            self.disp.unregister_appointment_client(self)
+
+    def parse_subscription(self, data):
+        """
+        Parse subscription message received on Websocket
+        It is either a list of criterias or a dict with criterias and session to resume or heatmap granularity
+        Return a (criterias, stream_id, last_seq, heatmap) tuple
+        """
+
+        message = json_codec.loads(data)
+        stream_id = None
+        last_seq = None
+        heatmap = None
+
+        if isinstance(message, dict):
+            stream_id = message.get("stream_id", None)
+            last_seq = message.get("last_seq", None)
+            heatmap = message.get("heatmap", None)
+            assert stream_id is None or isinstance(stream_id, str), "stream_id must be a string"
+            assert last_seq is None or isinstance(last_seq, int), "last_seq must be an integer"
+            assert heatmap is None or heatmap in services.HEATMAP_GRANULARITIES, "heatmap must be one of %s" % ", ".join(services.HEATMAP_GRANULARITIES)
+            message = message.get("criterias", None)
+
+        return self.validate_criterias(message), stream_id, last_seq, heatmap
 
     def validate_criterias(self, criterias):
         """
         Validate appoitments criteria received on Websocket
         """
 
-        criterias = json.loads(criterias)
-        assert isinstance(criterias, list), "criterias must be a list of dict"
-
-        for criteria in criterias:
-
-            user_type = criteria.get("user_type", None)
-            control_type = criteria.get("control_type", None)
-            vehicle_type = criteria.get("vehicle_type", None)
-            organism = criteria.get("organism", None)
-            site = criteria.get("site", None)
-            start_dt = criteria.get("start_dt", None)
-            end_dt = criteria.get("end_dt", None)
-
-            assert user_type in ["PRIVATE", "PROFESSIONAL"], "user_type must be one of PRIVATE, PROFESSIONAL"
-            assert control_type in ["REGULAR", "REJECTED"], "user_type must be one of REGULAR, REJECTED"
-            assert vehicle_type in self.disp.appointments[user_type][control_type].keys(), "vehicle_type must be one of %s" % list(self.disp.appointments[user_type][control_type].keys())
-            assert organism in ["snct"], "user_type must be one of snct"
-            organism_site = (organism, site)
-            assert organism_site in self.disp.appointments[user_type][control_type][vehicle_type].keys(), "site must be one of %s" % list(
-                self.disp.appointments[user_type][control_type][vehicle_type].keys()
-            )
-            try:
-                start_dt = dateutil.parser.parse(start_dt[:19])
-                criteria["start_dt"] = start_dt
-            except:  # pylint: disable=broad-except
-                raise AssertionError("start_dt must be a date like 2019-01-01 or a datetime like 2019-01-01T08:15:00")
-            try:
-                end_dt = dateutil.parser.parse(end_dt[:19])
-                criteria["end_dt"] = end_dt
-            except:  # pylint: disable=broad-except
-                raise AssertionError("end_dt must be a date like 2019-02-01 or a datetime like 2019-01-01T09:30:00")
-
-        return criterias
+        return validate_criterias(self.disp, criterias)
 
-    async def push_initial_appointments(self):
-        """ Once WS received criterias of interrest, push list of available appointments """
+    def initial_appointments(self, state):
+        """ Return list of available appointments of given dispatcher state matching criterias of interrest """
 
         payload = []
         for criteria in self.criterias:
@@ -357,20 +574,107 @@ class WsHandler:
             start_dt = criteria["start_dt"]
             end_dt = criteria["end_dt"]
 
-            appointments = self.disp.appointments[user_type][control_type][vehicle_type][(organism, site)]
+            appointments = state.get((user_type, control_type, vehicle_type, (organism, site)))
 
             # Refresh failed
             if appointments is None:
-                appointments = []
+                appointments = ()
 
             for appointment in appointments:
                 if appointment < start_dt or appointment > end_dt:
                     continue
-                payload.append({"user_type": user_type, "control_type": control_type, "vehicle_type": vehicle_type, "organism": organism, "site": site, "timestamp": appointment.isoformat()})
+                payload.append({"user_type": user_type, "control_type": control_type, "vehicle_type": vehicle_type, "organism": organism, "site": site, "timestamp": appointment})
 
-        await self.push_appointments(added=payload)
+        return payload
+
+    async def subscribe(self, stream_id=None, last_seq=None):
+        """
+        Once WS received criterias of interrest, register to dispatcher and bring client up to date
+        Only missed updates are pushed when resuming a session still in dispatcher history
+        Registration happens before first await so no update can be lost in between
+        """
 
-    async def push_appointments(self, added=None, removed=None):
+        # Pinned state, matching seq whatever happens during awaits below
+        state = self.disp.state
+        seq = state.seq
+        self.signature = self.disp.criterias_signature(self.criterias)
+        self.keys = sorted({(x[0], x[1], x[2], (x[3], x[4])) for x in self.signature})
+        if self.heatmap is not None:
+            await self.subscribe_heatmap()
+            return
+        if self in self.disp.heatmap_clients:
+            self.disp.unregister_heatmap_client(self)
+
+        deltas = self.disp.deltas_since(stream_id, last_seq)
+        if deltas is None:
+            snapshot = self.factory.cached_snapshot(self.disp, self.criterias, functools.partial(self.initial_appointments, state), binary=self.binary)
+        announcement = self.keys_announcement() if self.binary else None
+        self.disp.register_appointment_client(self, self.criterias)
+
+        if announcement is not None:
+            await self.send_bytes(announcement)
+
+        if deltas is None:
+            # Splice shared encoded snapshot into message instead of encoding it again
+            freshness = self.freshness()
+            if self.binary:
+                await self.send_bytes(binary_codec.pack_spliced(dict({"t": "delta", "status": 200, "stream_id": self.disp.stream_id, "seq": seq, "snapshot": True, "removed": {}}, **freshness), "added", snapshot))
+            else:
+                await self.send_str(
+                    '{"status":200,"stream_id":"%s","seq":%d,"snapshot":true,"data_age":%s,"changed_age":%s,"added":%s,"removed":[]}'
+                    % (self.disp.stream_id, seq, json_codec.dumps(freshness["data_age"]), json_codec.dumps(freshness["changed_age"]), snapshot)
+                )
+            return
+
+        self.logger.info("Resuming session from seq %d, %d updates to replay", last_seq, len(deltas), extra=log_pipeline.RATE_LIMITED)
+        sent = False
+        for delta_seq, added, removed in deltas:
+            added = self.disp.filter_appointments(self.criterias, added)
+            removed = self.disp.filter_appointments(self.criterias, removed)
+            if added or removed:
+                await self.push_appointments(added=added, removed=removed, seq=delta_seq)
+                sent = True
+        if not sent:
+            await self.push_appointments(seq=seq)
+
+    async def subscribe_heatmap(self):
+        """ Register to dispatcher for slot counts and send current ones, sessions are not resumed as a snapshot is small """
+
+        if self in self.disp.appointments_clients:
+            self.disp.unregister_appointment_client(self)
+        counts = self.disp.heatmap_counts(self.criterias, self.heatmap)
+        self.disp.register_heatmap_client(self, self.criterias, self.heatmap)
+        await self.push_heatmap(counts, snapshot=True)
+
+    async def push_heatmap(self, counts, seq=None, snapshot=False):
+        """
+        Method called by AppointmentDispatcher when slot counts of subscribed keys change
+        counts being returned by dispatcher heatmap_counts method
+        """
+
+        seq = seq if seq is not None else self.disp.seq
+
+        def encode():
+            """ Encode slot counts using negotiated subprotocol """
+
+            return binary_codec.pack(counts) if self.binary else json_codec.dumps(counts)
+
+        # Counts are shared by alike subscribers, ages are spliced per session as they depend on when they are sent
+        if not snapshot:
+            encoded = self.factory.cached_delta((self.protocol, self.disp.stream_id, seq, "heatmap", self.heatmap, self.signature), encode)
+        else:
+            encoded = encode()
+
+        freshness = self.freshness()
+        if self.binary:
+            await self.send_bytes(binary_codec.pack_spliced(dict({"t": "heatmap", "status": 200, "stream_id": self.disp.stream_id, "seq": seq, "snapshot": snapshot, "heatmap": self.heatmap}, **freshness), "counts", encoded))
+        else:
+            await self.send_str(
+                '{"status":200,"stream_id":"%s","seq":%d,"snapshot":%s,"heatmap":"%s","data_age":%s,"changed_age":%s,"counts":%s}'
+                % (self.disp.stream_id, seq, json_codec.dumps(snapshot), self.heatmap, json_codec.dumps(freshness["data_age"]), json_codec.dumps(freshness["changed_age"]), encoded)
+            )
+
+    async def push_appointments(self, added=None, removed=None, seq=None, snapshot=False):
         """
         Method called by AppointmentDispatcher when new appointments
         match giver criterias
@@ -378,8 +682,33 @@ class WsHandler:
 
         added = added if added is not None else []
         removed = removed if removed is not None else []
+        seq = seq if seq is not None else self.disp.seq
 
-        await self.send_json({"status": 200, "added": added, "removed": removed})
+        def encode():
+            """ Encode added and removed appointments using negotiated subprotocol """
+
+            if self.binary:
+                return binary_codec.pack(binary_codec.group_by_key_id(added, self.disp.key_id)), binary_codec.pack(binary_codec.group_by_key_id(removed, self.disp.key_id))
+            return json_codec.dumps(added), json_codec.dumps(removed)
+
+        # Appointments of a non empty update only depend on its seq and criterias, encode them once for all alike subscribers
+        # Ages are spliced per session as they depend on when the update is sent, including when replayed to a resuming session
+        if (added or removed) and self.signature is not None:
+            encoded_added, encoded_removed = self.factory.cached_delta((self.protocol, self.disp.stream_id, seq, snapshot, self.signature), encode)
+        else:
+            encoded_added, encoded_removed = encode()
+
+        freshness = self.freshness()
+        if self.binary:
+            await self.send_bytes(binary_codec.pack_spliced_fields(
+                dict({"t": "delta", "status": 200, "stream_id": self.disp.stream_id, "seq": seq, "snapshot": snapshot}, **freshness),
+                {"added": encoded_added, "removed": encoded_removed},
+            ))
+        else:
+            await self.send_str(
+                '{"status":200,"stream_id":"%s","seq":%d,"snapshot":%s,"data_age":%s,"changed_age":%s,"added":%s,"removed":%s}'
+                % (self.disp.stream_id, seq, json_codec.dumps(snapshot), json_codec.dumps(freshness["data_age"]), json_codec.dumps(freshness["changed_age"]), encoded_added, encoded_removed)
+            )
 
     async def run_forever(self):  # pylint: disable=too-many-branches
         """
@@ -395,24 +724,23 @@ class WsHandler:
                         break
                     else:
                         try:
-                            self.criterias = self.validate_criterias(msg.data)
+                            self.criterias, stream_id, last_seq, self.heatmap = self.parse_subscription(msg.data)
                         except AssertionError as exc:
-                            await self.send_json({"message": str(exc), "status": 400})
-                            self.logger.info("Got INVALID criterias: %s: %s", exc, self.criterias)
+                            await self.send_error(400, str(exc))
+                            self.logger.info("Got INVALID criterias: %s: %s", exc, self.criterias, extra=log_pipeline.RATE_LIMITED)
                         except Exception as exc:  # pylint: disable=broad-except
-                            await self.send_json({"message": "Got unhandled type of message", "status": 500})
-                            self.logger.warning("Got invalid WebSocket payload: %s: %s: %s", exc.__class__.__name__, exc, msg.data)
+                            await self.send_error(500, "Got unhandled type of message")
+                            self.logger.warning("Got invalid WebSocket payload: %s: %s: %s", exc.__class__.__name__, exc, msg.data, extra=log_pipeline.RATE_LIMITED)
                         else:
-                            self.logger.info("Got valid criterias: %s", self.criterias)
-                            await self.push_initial_appointments()
-                            self.disp.register_appointment_client(self, self.criterias)
+                            self.logger.info("Got valid criterias: %s", self.criterias, extra=log_pipeline.RATE_LIMITED)
+                            await self.subscribe(stream_id=stream_id, last_seq=last_seq)
                 elif msg.type == aiohttp.WSMsgType.close:
                     break
                 # aiohttp.WSMsgType.closing existence seems to depends on aiohttp version
                 elif hasattr(aiohttp.WSMsgType, "closing") and msg.type == aiohttp.WSMsgType.closing:  # pylint: disable=no-member
                     break
                 else:
-                    self.logger.warning("Client sent an unknown message: %s", msg)
+                    self.logger.warning("Client sent an unknown message: %s", msg, extra=log_pipeline.RATE_LIMITED)
             return self.ws
         except asyncio.CancelledError:
             return self.ws
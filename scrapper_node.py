@@ -0,0 +1,76 @@
+#!/usr/bin/python3
+
+
+# pylint: disable=line-too-long
+
+
+"""
+Scrapper node polling its shard of keys and publishing results to a main.py started with --shard-socket
+"""
+
+
+import os
+import asyncio
+import logging
+import argparse
+
+import log_pipeline
+import services
+
+
+def get_arguments_from_cmd_line():
+    """ Handle command line arguments """
+
+    parser = argparse.ArgumentParser(description="SNCT Appointment helper scrapper node", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("-s", "--shard-socket", type=str, required=True, help="Unix socket of shard coordinator, as given to main.py --shard-socket")
+    parser.add_argument("-n", "--node-id", type=str, default=None, help="Node identifier, defaults to hostname and pid")
+    parser.add_argument("-d", "--debug", action="store_true", help="Put loggers in DEBUG level")
+    parser.add_argument("--heartbeat-interval", type=int, default=10, help="Seconds between heartbeats, must be lower than coordinator --shard-node-timeout")
+    parser.add_argument("--providers", type=str, nargs="+", default=["snct"], choices=sorted(services.PROVIDERS), help="Appointment providers to scrap")
+    parser.add_argument("--idle-refresh-interval", type=int, default=900, help="Seconds between refreshes of keys nobody subscribed to nor queried recently")
+    parser.add_argument("--requests-per-second", type=float, default=0, help="Outgoing requests budget of this node, 0 to pace requests evenly over refresh cycle")
+    parser.add_argument("--catalog-refresh-interval", type=int, default=3600, help="Seconds between refreshes of providers sites and vehicles lists")
+    parser.add_argument("--unsupported-recheck-interval", type=int, default=86400, help="Seconds before re-checking a site and vehicle combination the provider does not handle")
+
+    return parser.parse_args()
+
+
+async def run_node(config):
+    """ Join coordinator and poll shard until cancelled """
+
+    node = services.ShardNode(
+        services.UnixCoordinatorClient(config.shard_socket),
+        node_id=config.node_id,
+        heartbeat_interval=config.heartbeat_interval,
+        providers=[services.PROVIDERS[x]() for x in config.providers],
+        idle_refresh_interval=config.idle_refresh_interval,
+        requests_per_second=config.requests_per_second,
+        catalog_refresh_interval=config.catalog_refresh_interval,
+        unsupported_recheck_interval=config.unsupported_recheck_interval,
+    )
+    try:
+        await node.start()
+        await node.run_forever()
+    finally:
+        await asyncio.shield(node.close())
+
+
+if __name__ == "__main__":
+
+    CONFIG = get_arguments_from_cmd_line()
+    if os.getenv("NO_LOGS_TS", None) is None:
+        FORMATTER = "%(asctime)s %(levelname)-8s [%(name)s] %(message)s"
+    else:
+        FORMATTER = "%(levelname)-8s [%(name)s] %(message)s"
+    log_pipeline.setup_queue_logging(level=logging.DEBUG if CONFIG.debug else logging.INFO, formatter=FORMATTER)
+
+    LOOP = asyncio.get_event_loop()
+    TASK = asyncio.ensure_future(run_node(CONFIG))
+    try:
+        LOOP.run_until_complete(TASK)
+    except KeyboardInterrupt:
+        TASK.cancel()
+        LOOP.run_until_complete(asyncio.gather(TASK, return_exceptions=True))
+    finally:
+        LOOP.close()
@@ -1,4 +1,16 @@
 """ Relative imports of all services """
 
 from .snct_appointment_scrapper import SnctAppointmentScrapper
+from .providers import AppointmentProvider, SnctProvider, FakeProvider, PROVIDERS
 from .appointment_dispatcher import AppointmentDispatcher
+from .appointments_state import AppointmentsState
+from .rate_limiting import TokenBucket, AdmissionQueue, ConcurrencyLimiter, ClientTokenBuckets
+from .profiler import LoopProfiler
+from .loop_monitor import LoopLagMonitor
+from . import offload
+from .slot_history import SlotHistoryStore
+from .webhooks import WebhookDelivery, WebhookSubscription
+from .heatmap import HeatmapAggregates, GRANULARITIES as HEATMAP_GRANULARITIES
+from .clock import SystemClock, VirtualClock
+from .traffic_replay import TrafficRecorder, ReplayServer
+from .sharding import HashRing, ShardCoordinator, ShardCoordinatorServer, ShardNode, LocalCoordinatorClient, UnixCoordinatorClient
@@ -6,9 +6,19 @@ Receive scrapper updates and dispatch new appointments offers to clients
 # pylint: disable=line-too-long
 
 
+import time
+import uuid
+import datetime
 import logging
 import collections
 import asyncio
+import log_pipeline
+
+from . import offload
+from .clock import SystemClock
+from .freshness import FreshnessTracker
+from .heatmap import HeatmapAggregates
+from .appointments_state import AppointmentsState
 
 
 class AppointmentDispatcher:
@@ -16,14 +26,135 @@ class AppointmentDispatcher:
     Receive scrapper updates and dispatch new appointments offers to clients
     """
 
-    def __init__(self):
+    def __init__(self, demand_window=3600, history_size=1000, executor=None, offload_chunk_size=50, recent_change_window=600, near_term_window=72 * 3600, freshness_target=120, freshness_objective=0.99, clock=None):  # pylint: disable=too-many-arguments
 
         self.logger = logging.getLogger(self.__class__.__name__)
+        # Same clock as scrapper, so data ages and demand are measured in virtual time when replaying traffic
+        self.clock = clock if clock is not None else SystemClock()
         self.sites = []
         self.vehicle_types = []
-        self.appointments = collections.defaultdict(lambda: collections.defaultdict(lambda: collections.defaultdict(dict)))
+        # Immutable snapshot of appointments of all keys, replaced at the end of each update
+        # Readers keep a reference to it to get a consistent view, even across awaits
+        self.state = AppointmentsState()
 
         self.appointments_clients = {}
+        self.appointments_signatures = {}
+        # Webhooks only queue updates synchronously, so thousands of them do not slow down WebSocket fan-out
+        self.webhook_clients = {}
+        # Clients receiving slot counts of their keys instead of slots, and their "day" or "hour" granularity
+        self.heatmap_clients = {}
+        self.heatmap_granularities = {}
+        # Slot counts per key and day or hour, updated from diffs
+        self.heatmap = HeatmapAggregates()
+
+        # Optional thread or process pool executor diffing keys out of the event loop
+        self.executor = executor
+        self.offload_chunk_size = offload_chunk_size
+        self.update_lock = asyncio.Lock()
+
+        # Every published delta get a sequence number and recent ones are kept
+        # so reconnecting WebSocket clients only receive what they missed
+        # stream_id changes on restart, so sequence numbers from a previous run are never trusted
+        self.stream_id = uuid.uuid4().hex
+        self.seq = 0
+        self.history = collections.deque(maxlen=history_size)
+        # Bumped every time appointments of a key change, used to cache computed responses
+        self.key_versions = collections.Counter()
+        # Keys interned as small integers for binary WebSocket subscribers, stable for the life of stream_id
+        self.key_ids = {}
+        # Bumped every time sites, vehicle types or unsupported keys change
+        self.catalog_version = 0
+        # Callables receiving (key, added, removed) for every changed key
+        self.change_listeners = []
+
+        # Demand tracking, used by scrapper to poll keys nobody cares about less often
+        # A key is a (user_type, control_type, vehicle_type, (organism, site)) tuple
+        self.demand_window = demand_window
+        self.subscribed_keys = collections.Counter()
+        self.rest_hits = {}
+        # Callable receiving a list of keys to refresh out of cycle, attached by scrapper
+        self.refresh_requester = None
+
+        # Used to prioritize scrapper requests
+        self.recent_change_window = recent_change_window
+        self.near_term_window = datetime.timedelta(seconds=near_term_window)
+        self.key_changed_at = {}
+        self.key_earliest = {}
+
+        # Keys their provider does not handle, as learnt by scrapper
+        self.unsupported_keys = set()
+
+        # Last successful fetch and last change of each supported key, failed refreshes keep previous appointments
+        self.freshness = FreshnessTracker(target=freshness_target, objective=freshness_objective)
+
+    @staticmethod
+    def criteria_key(criteria):
+        """ Return appointments key matching a client criteria """
+
+        return (criteria["user_type"], criteria["control_type"], criteria["vehicle_type"], (criteria["organism"], criteria["site"]))
+
+    @staticmethod
+    def criterias_signature(criterias):
+        """ Return hashable normalized form of a list of criterias, identical for clients subscribing to the same thing """
+
+        return tuple(sorted({(x["user_type"], x["control_type"], x["vehicle_type"], x["organism"], x["site"], x["start_dt"], x["end_dt"]) for x in criterias}))
+
+    def key_id(self, key):
+        """ Return small integer interned for given key """
+
+        try:
+            return self.key_ids[key]
+        except KeyError:
+            self.key_ids[key] = len(self.key_ids) + 1
+            return self.key_ids[key]
+
+    def key_priority(self, key):
+        """
+        Return priority of scrapper request for given key, lower is fetched first
+        Subscribed keys come first, then recently queried ones, then idle ones
+        Keys which changed recently or have a slot soon get a boost
+        """
+
+        if self.subscribed_keys[key] > 0:
+            priority = 0.0
+        elif self.is_key_in_demand(key):
+            priority = 1.0
+        else:
+            priority = 3.0
+
+        changed_at = self.key_changed_at.get(key, None)
+        if changed_at is not None and self.clock.monotonic() - changed_at < self.recent_change_window:
+            priority -= 0.5
+
+        earliest = self.key_earliest.get(key, None)
+        if earliest is not None and earliest - self.clock.now() < self.near_term_window:
+            priority -= 0.25
+
+        return priority
+
+    def touch_key(self, key):
+        """ Record a REST hit for given key so it is considered as in demand, fetching it right now if it was idle """
+
+        was_idle = not self.is_key_in_demand(key)
+        self.rest_hits[key] = self.clock.monotonic()
+        if was_idle and self.refresh_requester is not None:
+            self.refresh_requester([key])  # pylint: disable=not-callable
+
+    def is_key_in_demand(self, key):
+        """ Tell if given key has live subscribers or has been queried over REST recently """
+
+        if self.subscribed_keys[key] > 0:
+            return True
+        last_hit = self.rest_hits.get(key, None)
+        return last_hit is not None and self.clock.monotonic() - last_hit < self.demand_window
+
+    def keys_in_demand(self):
+        """ Return list of keys having live subscribers or queried over REST recently """
+
+        now = self.clock.monotonic()
+        keys = {x for x, count in self.subscribed_keys.items() if count > 0}
+        keys.update(x for x, last_hit in self.rest_hits.items() if now - last_hit < self.demand_window)
+        return list(keys)
 
     def site_handler(self, payload, exc):
         """ Will be attached to SNCT scrapper and receive list of SNCT sites """
@@ -31,34 +162,128 @@ class AppointmentDispatcher:
         if exc is None:
             self.logger.info("Updated sites received")
             self.sites = payload
+            self.catalog_version += 1
+
+    @property
+    def organisms(self):
+        """ Return set of organisms having at least one site """
+
+        return {x[0] for x in self.sites}
 
     def vehicle_handler(self, payload, exc):
-        """ Will be attached to SNCT scrapper and receive list of types of vehicules """
+        """ Will be attached to SNCT scrapper and receive dict of types of vehicules with their id for each organism """
 
         if exc is None:
             self.logger.info("Updated vehicle types received")
             self.vehicle_types = payload
+            self.catalog_version += 1
+
+    def capability_handler(self, unsupported):
+        """ Will be attached to SNCT scrapper and receive set of keys not handled by their provider """
+
+        self.logger.info("Updated unsupported keys received, %d keys are not supported", len(unsupported))
+        self.unsupported_keys = set(unsupported)
+        for key in self.unsupported_keys:
+            self.freshness.forget(key)
+        self.catalog_version += 1
+
+    def is_key_supported(self, key):
+        """ Tell if given key is not known as unsupported by its provider """
+
+        return key not in self.unsupported_keys
+
+    def capabilities(self):
+        """
+        Return supported vehicle types as {organism: {site: {user_type: {control_type: [vehicle_type, ...]}}}}
+        Only keys already refreshed once are listed
+        """
+
+        matrix = {}
+        for key in self.state.appointments:
+            if not self.is_key_supported(key):
+                continue
+            user_type, control_type, vehicle_type, (organism, site) = key
+            vehicle_types = matrix.setdefault(organism, {}).setdefault(site, {}).setdefault(user_type, {}).setdefault(control_type, [])
+            vehicle_types.append(vehicle_type)
+
+        for sites in matrix.values():
+            for user_types in sites.values():
+                for control_types in user_types.values():
+                    for vehicle_types in control_types.values():
+                        vehicle_types.sort()
+        return matrix
 
     def appointment_handler(self, payload):
-        """ Will be attached to SNCT scrapper and receive dict of available appointments slots """
+        """
+        Will be attached to SNCT scrapper and receive dict of available appointments slots
+        When diffing is offloaded to a worker pool, return a coroutine the scrapper must await
+        """
 
         self.logger.info("Updated appointments received")
 
-        new_appointments_to_publish = []
-        removed_appointments_to_publish = []
+        if self.executor is not None:
+            return self.appointment_handler_offloaded(payload)
+
+        blocking_started = time.perf_counter()
+        to_diff, initial = self.collect_appointments_to_diff(payload)
+        self.apply_appointments_diff(to_diff, offload.diff_appointments_chunk(to_diff), initial)
+        self.logger.info("Diffing and publishing %d keys blocked event loop for %.3fs", len(to_diff), time.perf_counter() - blocking_started)
+        return None
+
+    async def appointment_handler_offloaded(self, payload):
+        """
+        Same as appointment_handler but diffing keys is done in executor, by chunks
+        Workers only see tuples of the pinned state and lists of the payload, nothing they read is mutated meanwhile
+        """
+
+        # Updates are serialized so state cannot change between collecting and applying diffs
+        async with self.update_lock:
+            blocking_started = time.perf_counter()
+            to_diff, initial = self.collect_appointments_to_diff(payload)
+            blocking = time.perf_counter() - blocking_started
+
+            diffs = await offload.map_chunks(self.executor, offload.diff_appointments_chunk, to_diff, chunk_size=self.offload_chunk_size)
+
+            blocking_started = time.perf_counter()
+            self.apply_appointments_diff(to_diff, diffs, initial)
+            blocking += time.perf_counter() - blocking_started
+
+        self.logger.info("Diffing and publishing %d keys blocked event loop for %.3fs", len(to_diff), blocking)
+
+    def collect_appointments_to_diff(self, payload):
+        """
+        Compare payload to current state without modifying it, skipping failed refreshes
+        Return a (to_diff, initial) tuple, to_diff being a list of (key, orig_appointments, new_appointments) tuples
+        and initial a {key: appointments} dict of keys received for the first time
+        """
+
+        to_diff = []
+        initial = {}
+        state = self.state
+        now = self.clock.monotonic()
+        # Ages are sampled right before keys are refreshed, when they are the oldest
+        self.freshness.sample(now, self.is_key_in_demand)
 
         for user_type in payload:  # pylint: disable=too-many-nested-blocks
             for control_type in payload[user_type]:
                 for vehicle_type in payload[user_type][control_type]:
                     for site in payload[user_type][control_type][vehicle_type]:
 
-                        orig_appointments = self.appointments[user_type][control_type][vehicle_type].get(site, None)
+                        key = (user_type, control_type, vehicle_type, site)
+                        orig_appointments = state.get(key)
                         new_appointments = payload[user_type][control_type][vehicle_type][site]
 
-                        # First call for this site
+                        if self.is_key_supported(key):
+                            if new_appointments is None:
+                                self.freshness.failed(key)
+                            else:
+                                self.freshness.fetched(key, now)
+
+                        # First call for this site, or first successful one
                         if orig_appointments is None:
-                            self.appointments[user_type][control_type][vehicle_type][site] = new_appointments
-                            self.logger.info("Initial appointments update for %s/%s %s/%s/%s", site[0], site[1], user_type, control_type, vehicle_type)
+                            if new_appointments is not None or key not in state:
+                                initial[key] = new_appointments
+                                self.logger.debug("Initial appointments update for %s/%s %s/%s/%s", site[0], site[1], user_type, control_type, vehicle_type, extra=log_pipeline.RATE_LIMITED)
                             continue
 
                         # None in payload instead of list, refresh failed
@@ -66,77 +291,300 @@ class AppointmentDispatcher:
                             self.logger.warning("Ignoring %s/%s %s/%s/%s, refresh seems to have failed", site[0], site[1], user_type, control_type, vehicle_type)
                             continue
 
-                        added = [x for x in new_appointments if x not in orig_appointments]
-                        removed = [x for x in orig_appointments if x not in new_appointments]
-
-                        if added:
-                            self.logger.info("Found new appointments for %s/%s %s/%s/%s: %s", site[0], site[1], user_type, control_type, vehicle_type, [x.isoformat() for x in added])
-                            for timestamp in added:
-                                new_appointments_to_publish.append({
-                                    "user_type": user_type,
-                                    "control_type": control_type,
-                                    "vehicle_type": vehicle_type,
-                                    "organism": site[0],
-                                    "site": site[1],
-                                    "timestamp": timestamp,
-                                })
-                        if removed:
-                            self.logger.info("Found removed appointments for %s/%s %s/%s/%s: %s", site[0], site[1], user_type, control_type, vehicle_type, [x.isoformat() for x in removed])
-                            for timestamp in removed:
-                                removed_appointments_to_publish.append({
-                                    "user_type": user_type,
-                                    "control_type": control_type,
-                                    "vehicle_type": vehicle_type,
-                                    "organism": site[0],
-                                    "site": site[1],
-                                    "timestamp": timestamp,
-                                })
-
-                        self.appointments[user_type][control_type][vehicle_type][site] = new_appointments
-
-        if new_appointments_to_publish:
-            self.push_appointments_criterias(new_appointments_to_publish, cat="added")
-        if removed_appointments_to_publish:
-            self.push_appointments_criterias(new_appointments_to_publish, cat="removed")
-
-    def push_appointments_criterias(self, appointments, cat="added"):
-        """ Iterate over all clients and push updates to client with matching criterias """
+                        to_diff.append((key, orig_appointments, new_appointments))
+
+        return to_diff, initial
+
+    def apply_appointments_diff(self, to_diff, diffs, initial):
+        """
+        Publish next state made of initial appointments and changed keys of diffs, then publish added and removed appointments
+        diffs are in the same order as to_diff
+        """
 
+        new_appointments_to_publish = []
+        removed_appointments_to_publish = []
+        heatmap_changes = {}
+        changes = dict(initial)
+
+        for key, new_appointments in initial.items():
+            self.key_versions[key] += 1
+            if new_appointments is not None:
+                self.freshness.changed(key, self.clock.monotonic())
+                self.heatmap.load(key, new_appointments)
+            self.key_earliest[key] = min(new_appointments) if new_appointments else None
+
+        for (key, _, new_appointments), (_, added, removed) in zip(to_diff, diffs):
+
+            user_type, control_type, vehicle_type, site = key
+
+            if added:
+                self.logger.info("Found %d new appointments for %s/%s %s/%s/%s", len(added), site[0], site[1], user_type, control_type, vehicle_type, extra=log_pipeline.RATE_LIMITED)
+                if self.logger.isEnabledFor(logging.DEBUG):
+                    self.logger.debug("New appointments for %s/%s %s/%s/%s: %s", site[0], site[1], user_type, control_type, vehicle_type, [x.isoformat() for x in added], extra=log_pipeline.RATE_LIMITED)
+                for timestamp in added:
+                    new_appointments_to_publish.append({
+                        "user_type": user_type,
+                        "control_type": control_type,
+                        "vehicle_type": vehicle_type,
+                        "organism": site[0],
+                        "site": site[1],
+                        "timestamp": timestamp,
+                    })
+            if removed:
+                self.logger.info("Found %d removed appointments for %s/%s %s/%s/%s", len(removed), site[0], site[1], user_type, control_type, vehicle_type, extra=log_pipeline.RATE_LIMITED)
+                if self.logger.isEnabledFor(logging.DEBUG):
+                    self.logger.debug("Removed appointments for %s/%s %s/%s/%s: %s", site[0], site[1], user_type, control_type, vehicle_type, [x.isoformat() for x in removed], extra=log_pipeline.RATE_LIMITED)
+                for timestamp in removed:
+                    removed_appointments_to_publish.append({
+                        "user_type": user_type,
+                        "control_type": control_type,
+                        "vehicle_type": vehicle_type,
+                        "organism": site[0],
+                        "site": site[1],
+                        "timestamp": timestamp,
+                    })
+
+            if added or removed:
+                self.key_versions[key] += 1
+                self.key_changed_at[key] = self.clock.monotonic()
+                self.freshness.changed(key, self.key_changed_at[key])
+                heatmap_changes[key] = self.heatmap.apply(key, added, removed)
+                self.key_earliest[key] = min(new_appointments) if new_appointments else None
+                self.notify_change_listeners(key, added, removed)
+                changes[key] = new_appointments
+
+        # Swapped before publishing, so clients subscribing from now on see a state matching last seq
+        publishing = bool(new_appointments_to_publish or removed_appointments_to_publish)
+        self.state = self.state.evolve(changes, self.seq + 1 if publishing else self.seq)
+        if publishing:
+            self.publish_delta(new_appointments_to_publish, removed_appointments_to_publish)
+            self.push_heatmap(heatmap_changes, self.seq)
+
+    def key_freshness(self, keys):
+        """ Return (seconds since stalest of given keys was fetched, seconds since most recent change of them), None if unknown """
+
+        now = self.clock.monotonic()
+        return self.freshness.max_age(keys, now), self.freshness.min_changed_age(keys, now)
+
+    @staticmethod
+    def describe_key(key):
+        """ Turn a key into a dict """
+
+        return {"user_type": key[0], "control_type": key[1], "vehicle_type": key[2], "organism": key[3][0], "site": key[3][1]}
+
+    def freshness_report(self):
+        """ Return staleness SLO report, see FreshnessTracker.report """
+
+        return self.freshness.report(self.clock.monotonic(), self.is_key_in_demand, self.describe_key)
+
+    async def snapshot(self):
+        """
+        Return (stream_id, seq, [(key, appointments), ...]) of current state, unsupported keys excluded
+        State being immutable, pinning it is enough to never see a half-applied update
+        """
+
+        state = self.state
+        keys = [(x, y if y is not None else ()) for x, y in state.items() if self.is_key_supported(x)]
+        return self.stream_id, state.seq, keys
+
+    def add_change_listener(self, listener):
+        """ Register a callable receiving (key, added, removed) for every key whose appointments changed """
+
+        assert callable(listener), "listener must be a callable taking key, added and removed arguments"
+        self.change_listeners.append(listener)
+
+    def notify_change_listeners(self, key, added, removed):
+        """ Call all change listeners, a failing one must not prevent publishing """
+
+        for listener in self.change_listeners:
+            try:
+                listener(key, added, removed)
+            except Exception as exc:  # pylint: disable=broad-except
+                self.logger.exception("Change listener %s failed: %s: %s", listener, exc.__class__.__name__, exc)
+
+    def publish_delta(self, added, removed):
+        """ Stamp a delta with next sequence number, keep it in history and push it to clients """
+
+        self.seq += 1
+        self.history.append((self.seq, added, removed))
+        self.push_appointments_criterias(added, removed, self.seq)
+
+    def deltas_since(self, stream_id, seq):
+        """
+        Return list of (seq, added, removed) deltas published after given sequence number
+        Return None if they cannot be replayed, because of a restart or a gap older than history
+        """
+
+        if stream_id != self.stream_id or seq is None or seq > self.seq:
+            return None
+        if seq == self.seq:
+            return []
+        if not self.history or self.history[0][0] > seq + 1:
+            return None
+        return [x for x in self.history if x[0] > seq]
+
+    @staticmethod
+    def criteria_match(criteria, appointment):
+        """ Tell if an appointment dict is matching a client criteria """
+
+        return (
+            criteria["site"] == appointment["site"]
+            and criteria["vehicle_type"] == appointment["vehicle_type"]
+            and criteria["organism"] == appointment["organism"]
+            and criteria["control_type"] == appointment["control_type"]
+            and criteria["user_type"] == appointment["user_type"]
+            and criteria["start_dt"] <= appointment["timestamp"] <= criteria["end_dt"]
+        )
+
+    @classmethod
+    def filter_appointments(cls, criterias, appointments):
+        """ Return appointments matching at least one of given criterias """
+
+        return [x for x in appointments if any(cls.criteria_match(y, x) for y in criterias)]
+
+    def push_appointments_criterias(self, added, removed, seq):
+        """
+        Iterate over all clients and push updates to client with matching criterias
+        Updates are filtered once per distinct criterias, clients sharing them receive the same lists
+        """
+
+        pushed = 0
+        filtered = {}
         for client_handler, criterias in self.appointments_clients.items():
-            filtered = []
-            for criteria in criterias:
-                for appointment in appointments:
-                    condition = [
-                        criteria["user_type"] == appointment["user_type"],
-                        criteria["control_type"] == appointment["control_type"],
-                        criteria["vehicle_type"] == appointment["vehicle_type"],
-                        criteria["organism"] == appointment["organism"],
-                        criteria["site"] == appointment["site"],
-                        appointment["timestamp"] >= criteria["start_dt"],
-                        appointment["timestamp"] <= criteria["end_dt"],
-                    ]
-                    if all(condition):
-                        filtered.append(appointment)
-                        self.logger.info("Found %s appointment for handler %s: %s", cat, client_handler, appointment)
-
-            if filtered:
-                if cat == "added":
-                    asyncio.ensure_future(client_handler.push_appointments(added=appointments))
-                else:
-                    asyncio.ensure_future(client_handler.push_appointments(removed=appointments))
+            signature = self.appointments_signatures[client_handler]
+            try:
+                filtered_added, filtered_removed = filtered[signature]
+            except KeyError:
+                filtered_added = self.filter_appointments(criterias, added)
+                filtered_removed = self.filter_appointments(criterias, removed)
+                filtered[signature] = (filtered_added, filtered_removed)
+
+            if filtered_added or filtered_removed:
+                self.logger.debug("Found %d added and %d removed appointments for handler %s", len(filtered_added), len(filtered_removed), client_handler, extra=log_pipeline.RATE_LIMITED)
+                asyncio.ensure_future(client_handler.push_appointments(added=filtered_added, removed=filtered_removed, seq=seq))
+                pushed += 1
+
+        queued = 0
+        for webhook_handler, criterias in self.webhook_clients.items():
+            signature = self.appointments_signatures[webhook_handler]
+            try:
+                filtered_added, filtered_removed = filtered[signature]
+            except KeyError:
+                filtered_added = self.filter_appointments(criterias, added)
+                filtered_removed = self.filter_appointments(criterias, removed)
+                filtered[signature] = (filtered_added, filtered_removed)
+
+            if filtered_added or filtered_removed:
+                webhook_handler.queue_appointments(added=filtered_added, removed=filtered_removed, seq=seq)
+                queued += 1
+
+        self.logger.info("Update %d with %d added and %d removed appointments pushed to %d clients out of %d (%d distinct criterias)", seq, len(added), len(removed), pushed, len(self.appointments_clients), len(filtered))
+        if self.webhook_clients:
+            self.logger.info("Update %d queued for %d webhooks out of %d", seq, queued, len(self.webhook_clients))
+
+    def heatmap_counts(self, criterias, granularity, changes=None):
+        """
+        Return [{"user_type", "control_type", "vehicle_type", "organism", "site", "counts"}, ...] slot counts of keys of given criterias,
+        restricted to days of their start_dt and end_dt, see HeatmapAggregates.view for counts format
+        If changes {key: (changed days, changed hours)} is given, only changed buckets of changed keys are returned
+        """
+
+        result = []
+        for criteria in criterias:
+            key = self.criteria_key(criteria)
+            buckets = None
+            if changes is not None:
+                if key not in changes:
+                    continue
+                buckets = changes[key][0 if granularity == "day" else 1]
+            counts = self.heatmap.view(key, granularity, start=criteria["start_dt"].date(), end=criteria["end_dt"].date(), buckets=buckets)
+            if counts or changes is None:
+                result.append(dict(self.describe_key(key), counts=counts))
+        return result
+
+    def push_heatmap(self, changes, seq):
+        """ Push changed slot counts to heatmap clients, computed once per distinct criterias and granularity """
+
+        pushed = 0
+        computed = {}
+        for client_handler, criterias in self.heatmap_clients.items():
+            granularity = self.heatmap_granularities[client_handler]
+            signature = (self.appointments_signatures[client_handler], granularity)
+            try:
+                counts = computed[signature]
+            except KeyError:
+                counts = self.heatmap_counts(criterias, granularity, changes=changes)
+                computed[signature] = counts
+
+            if counts:
+                asyncio.ensure_future(client_handler.push_heatmap(counts, seq=seq))
+                pushed += 1
+
+        if self.heatmap_clients:
+            self.logger.info("Update %d slot counts pushed to %d heatmap clients out of %d", seq, pushed, len(self.heatmap_clients))
+
+    def _register_client(self, clients, handler, criterias):
+        """ Store criterias of a client in given clients dict and update demand of their keys """
+
+        assert isinstance(criterias, list), "criterias must be a list of dict"
+        assert all([isinstance(x, dict) for x in criterias]), "criterias must be a list of dict"
+
+        new_keys = {self.criteria_key(x) for x in criterias}
+        idle_keys = [x for x in new_keys if not self.is_key_in_demand(x)]
+
+        previous_criterias = clients.get(handler, [])
+        self.subscribed_keys.subtract({self.criteria_key(x) for x in previous_criterias})
+        self.subscribed_keys.update(new_keys)
+        self.subscribed_keys += collections.Counter()  # Drop keys with no subscribers left
+
+        clients[handler] = criterias
+        self.appointments_signatures[handler] = self.criterias_signature(criterias)
+        self.logger.info("New %s client registered", handler.__class__.__name__, extra=log_pipeline.RATE_LIMITED)
+
+        # Fetch newly subscribed keys right now so first pushed update is fresh
+        if idle_keys and self.refresh_requester is not None:
+            self.refresh_requester(idle_keys)  # pylint: disable=not-callable
+
+    def _unregister_client(self, clients, handler):
+        """ Forget a client from given clients dict and update demand of its keys """
+
+        self.logger.info("A client %s unregistered", handler.__class__.__name__, extra=log_pipeline.RATE_LIMITED)
+        criterias = clients.pop(handler, [])
+        self.appointments_signatures.pop(handler, None)
+        self.subscribed_keys.subtract({self.criteria_key(x) for x in criterias})
+        self.subscribed_keys += collections.Counter()  # Drop keys with no subscribers left
 
     def register_appointment_client(self, handler, criterias):
         """ Register a new client for appointments update """
 
         assert hasattr(handler, "push_appointments"), "handler must be an instance of class implementing push_appointments method"
-        assert isinstance(criterias, list), "criterias must be a list of dict"
-        assert all([isinstance(x, dict) for x in criterias]), "criterias must be a list of dict"
-
-        self.appointments_clients[handler] = criterias
-        self.logger.info("New %s client registered", handler.__class__.__name__)
+        self._register_client(self.appointments_clients, handler, criterias)
 
     def unregister_appointment_client(self, handler):
         """ Register a new client for appointments update """
 
-        self.logger.info("A client %s unregistered", handler.__class__.__name__)
-        self.appointments_clients.pop(handler, None)
+        self._unregister_client(self.appointments_clients, handler)
+
+    def register_heatmap_client(self, handler, criterias, granularity):
+        """ Register a new client for slot counts updates, granularity being "day" or "hour" """
+
+        assert hasattr(handler, "push_heatmap"), "handler must be an instance of class implementing push_heatmap method"
+        self.heatmap_granularities[handler] = granularity
+        self._register_client(self.heatmap_clients, handler, criterias)
+
+    def unregister_heatmap_client(self, handler):
+        """ Unregister a client for slot counts updates """
+
+        self.heatmap_granularities.pop(handler, None)
+        self._unregister_client(self.heatmap_clients, handler)
+
+    def register_webhook_client(self, handler, criterias):
+        """ Register a webhook for appointments update, its queue_appointments method is called synchronously """
+
+        assert hasattr(handler, "queue_appointments"), "handler must be an instance of class implementing queue_appointments method"
+        self._register_client(self.webhook_clients, handler, criterias)
+
+    def unregister_webhook_client(self, handler):
+        """ Unregister a webhook """
+
+        self._unregister_client(self.webhook_clients, handler)
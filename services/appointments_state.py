@@ -0,0 +1,77 @@
+"""
+Immutable versioned snapshot of appointments of all keys, published by AppointmentDispatcher
+"""
+
+
+# pylint: disable=line-too-long
+
+
+import types
+
+
+class AppointmentsState:
+    """
+    Appointments of all keys at a given version, never modified once built
+
+      * appointments of a key are a sorted tuple of datetime, None if its first refresh failed
+      * seq is the sequence number of the last delta published with this state
+      * readers pin a state by keeping a reference to it, dispatcher replaces it at the end of each update
+        and unchanged keys share their tuples with previous state
+    """
+
+    __slots__ = ("version", "seq", "appointments", "vehicle_types_index", "sites_index")
+
+    def __init__(self, version=0, seq=0, appointments=None, indexes=None):
+
+        self.version = version
+        self.seq = seq
+        self.appointments = types.MappingProxyType(appointments if appointments is not None else {})
+
+        # Lists used to validate requests, only rebuilt when keys are added
+        if indexes is not None:
+            self.vehicle_types_index, self.sites_index = indexes
+            return
+        vehicle_types = {}
+        sites = {}
+        for user_type, control_type, vehicle_type, site in self.appointments:
+            vehicle_types.setdefault((user_type, control_type), set()).add(vehicle_type)
+            sites.setdefault((user_type, control_type, vehicle_type), set()).add(site)
+        self.vehicle_types_index = {x: sorted(y) for x, y in vehicle_types.items()}
+        self.sites_index = {x: sorted(y) for x, y in sites.items()}
+
+    def __len__(self):
+        return len(self.appointments)
+
+    def __contains__(self, key):
+        return key in self.appointments
+
+    def get(self, key):
+        """ Return sorted tuple of appointments of a key, None if unknown or never fetched successfully """
+
+        return self.appointments.get(key, None)
+
+    def items(self):
+        """ Return (key, appointments) pairs """
+
+        return self.appointments.items()
+
+    def vehicle_types(self, user_type, control_type):
+        """ Return sorted list of vehicle types known for given user and control types """
+
+        return self.vehicle_types_index.get((user_type, control_type), [])
+
+    def sites(self, user_type, control_type, vehicle_type):
+        """ Return sorted list of (organism, site) known for given user, control and vehicle types """
+
+        return self.sites_index.get((user_type, control_type, vehicle_type), [])
+
+    def evolve(self, changes, seq):
+        """ Return next state, changes being a {key: appointments} dict, appointments lists are sorted and frozen """
+
+        if not changes and seq == self.seq:
+            return self
+        appointments = dict(self.appointments)
+        for key, key_appointments in changes.items():
+            appointments[key] = tuple(sorted(key_appointments)) if key_appointments is not None else None
+        same_keys = len(appointments) == len(self.appointments)
+        return AppointmentsState(self.version + 1, seq, appointments, indexes=(self.vehicle_types_index, self.sites_index) if same_keys else None)
@@ -0,0 +1,72 @@
+"""
+Clocks used by SnctAppointmentScrapper, the virtual one lets a replayed day of refresh cycles run in minutes
+"""
+
+
+# pylint: disable=line-too-long
+
+
+import time
+import asyncio
+import datetime
+
+
+class SystemClock:
+    """ Real clock, default of scrapper """
+
+    @staticmethod
+    def monotonic():
+        """ Return seconds from an arbitrary reference, see time.monotonic """
+        return time.monotonic()
+
+    @staticmethod
+    def now(tz=None):  # pylint: disable=invalid-name
+        """ Return current datetime, see datetime.datetime.now """
+        return datetime.datetime.now(tz=tz)
+
+    @staticmethod
+    async def sleep(seconds):
+        """ Wait given number of seconds """
+        await asyncio.sleep(seconds)
+
+
+class VirtualClock:
+    """
+    Discrete clock starting at a given UTC datetime, time only moves forward when a coroutine sleeps on it
+    Sleeping returns at once, so a day of 60 seconds refresh cycles runs as fast as the work done in between,
+    and everything reading the clock (query plan dates, refresh due dates, replayed captures) is deterministic
+    Meant for a single sleeper, like scrapper refresh loop
+    """
+
+    def __init__(self, start=None):
+
+        if start is None:
+            start = datetime.datetime.now(tz=datetime.timezone.utc)
+        assert start.tzinfo is not None, "start must be an aware datetime"
+
+        self.start = start
+        self.elapsed = 0.0
+
+    def monotonic(self):
+        """ Return virtual seconds elapsed since start """
+        return self.elapsed
+
+    def now(self, tz=None):  # pylint: disable=invalid-name
+        """ Return virtual datetime, naive local time if no timezone is given like datetime.datetime.now """
+
+        now = self.start + datetime.timedelta(seconds=self.elapsed)
+        if tz is None:
+            return now.astimezone().replace(tzinfo=None)
+        return now.astimezone(tz)
+
+    def advance(self, seconds):
+        """ Move virtual time forward """
+
+        assert seconds >= 0, "Virtual time cannot go backward"
+        self.elapsed += seconds
+
+    async def sleep(self, seconds):
+        """ Move virtual time forward and let other tasks run once """
+
+        self.advance(seconds)
+        await asyncio.sleep(0)
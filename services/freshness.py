@@ -0,0 +1,175 @@
+"""
+Track when appointments of each key were last fetched and last changed, and report staleness against a target
+"""
+
+
+# pylint: disable=line-too-long
+
+
+import bisect
+import collections
+
+
+# Upper bounds of staleness histogram buckets, in seconds
+AGE_BUCKETS = (30, 60, 120, 300, 600, 1800, 3600, 4 * 3600)
+
+
+class FreshnessTracker:
+    """
+    Keep last successful fetch and last change time of each key, times being time.monotonic() values
+
+      * age of a key is the number of seconds since it was last fetched successfully, None if never
+      * every sample adds the time elapsed since previous one to the histogram bucket of each key current age,
+        so time weighted histograms do not depend on how often samples are taken
+      * keys are either "all" tracked keys or the "in_demand" ones, those having subscribers or recent REST hits
+      * objective only applies to keys in demand, idle ones being polled far less often than target on purpose
+    """
+
+    populations = ("all", "in_demand")
+    # Population whose time weighted ratio is compared to objective
+    objective_population = "in_demand"
+
+    def __init__(self, target=120, objective=0.99):
+
+        assert target > 0, "target must be a positive number of seconds"
+        assert 0 < objective <= 1, "objective must be a ratio between 0 and 1"
+
+        self.target = target
+        self.objective = objective
+        self.fetched_at = {}
+        self.changed_at = {}
+        self.failures = collections.Counter()
+        self.tracked = set()
+
+        self.sampled_at = None
+        # {population: [seconds spent in each bucket, the last one being beyond last bound]}
+        self.weighted = {x: [0.0] * (len(AGE_BUCKETS) + 1) for x in self.populations}
+        # {population: [key-seconds within target, key-seconds in total]}
+        self.within_target = {x: [0.0, 0.0] for x in self.populations}
+
+    def fetched(self, key, now):
+        """ Record a successful fetch """
+
+        self.tracked.add(key)
+        self.fetched_at[key] = now
+        self.failures.pop(key, None)
+
+    def failed(self, key):
+        """ Record a failed fetch """
+
+        self.tracked.add(key)
+        self.failures[key] += 1
+
+    def changed(self, key, now):
+        """ Record a change of appointments """
+
+        self.changed_at[key] = now
+
+    def forget(self, key):
+        """ Stop tracking a key, like one its provider does not handle """
+
+        self.tracked.discard(key)
+
+    def age(self, key, now):
+        """ Return seconds since key was last fetched successfully, None if never """
+
+        fetched_at = self.fetched_at.get(key, None)
+        return None if fetched_at is None else now - fetched_at
+
+    def changed_age(self, key, now):
+        """ Return seconds since appointments of key last changed, None if never """
+
+        changed_at = self.changed_at.get(key, None)
+        return None if changed_at is None else now - changed_at
+
+    def max_age(self, keys, now):
+        """ Return age of the stalest of given keys, None if one of them was never fetched """
+
+        ages = [self.age(x, now) for x in keys]
+        if not ages or None in ages:
+            return None
+        return max(ages)
+
+    def min_changed_age(self, keys, now):
+        """ Return seconds since the most recent change of given keys, None if none changed yet """
+
+        ages = [x for x in (self.changed_age(y, now) for y in keys) if x is not None]
+        return min(ages) if ages else None
+
+    @staticmethod
+    def bucket(age):
+        """ Return index of histogram bucket of given age, never fetched keys go to last one """
+
+        return len(AGE_BUCKETS) if age is None else bisect.bisect_left(AGE_BUCKETS, age)
+
+    def sample(self, now, is_in_demand):
+        """ Add time elapsed since previous sample to histograms, is_in_demand being a callable taking a key """
+
+        if self.sampled_at is not None and now > self.sampled_at:
+            elapsed = now - self.sampled_at
+            for key in self.tracked:
+                age = self.age(key, now)
+                within = age is not None and age <= self.target
+                for population in self.populations if is_in_demand(key) else self.populations[:1]:
+                    self.weighted[population][self.bucket(age)] += elapsed
+                    self.within_target[population][0] += elapsed if within else 0.0
+                    self.within_target[population][1] += elapsed
+        self.sampled_at = now
+
+    @staticmethod
+    def labelled(counts):
+        """ Turn a list of bucket values into a {upper bound: cumulative value} dict """
+
+        labels = [str(x) for x in AGE_BUCKETS] + ["+Inf"]
+        cumulated = 0
+        histogram = collections.OrderedDict()
+        for label, count in zip(labels, counts):
+            cumulated += count
+            histogram[label] = round(cumulated, 3)
+        return histogram
+
+    def report(self, now, is_in_demand, describe_key, stalest=10):
+        """
+        Return SLO report, describe_key turning a key into a dict for the stalest keys list
+          * current: number of keys within target right now and cumulative histogram of their ages
+          * time_weighted: ratio of key-seconds spent within target since start, compared to objective for keys in demand only
+        """
+
+        current = {x: {"keys": 0, "within_target": 0, "histogram": [0] * (len(AGE_BUCKETS) + 1)} for x in self.populations}
+        ages = []
+        for key in self.tracked:
+            age = self.age(key, now)
+            ages.append((float("inf") if age is None else age, key))
+            for population in self.populations if is_in_demand(key) else self.populations[:1]:
+                current[population]["keys"] += 1
+                current[population]["within_target"] += 1 if age is not None and age <= self.target else 0
+                current[population]["histogram"][self.bucket(age)] += 1
+
+        report = {"target_seconds": self.target, "objective": self.objective, "current": {}, "time_weighted": {}}
+        for population in self.populations:
+            stats = current[population]
+            within, total = self.within_target[population]
+            ratio = within / total if total else None
+            report["current"][population] = {
+                "keys": stats["keys"],
+                "within_target": stats["within_target"],
+                "ratio": stats["within_target"] / stats["keys"] if stats["keys"] else None,
+                "histogram": self.labelled(stats["histogram"]),
+            }
+            report["time_weighted"][population] = {
+                "ratio": ratio,
+                "objective_met": (ratio is None or ratio >= self.objective) if population == self.objective_population else None,
+                "histogram_seconds": self.labelled(self.weighted[population]),
+            }
+
+        report["stalest"] = []
+        for age, key in sorted(ages, key=lambda x: x[0], reverse=True)[:stalest]:
+            item = describe_key(key)
+            changed_age = self.changed_age(key, now)
+            item.update({
+                "age": None if age == float("inf") else round(age, 1),
+                "changed_age": None if changed_age is None else round(changed_age, 1),
+                "failures": self.failures[key],
+            })
+            report["stalest"].append(item)
+        return report
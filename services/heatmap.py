@@ -0,0 +1,86 @@
+"""
+Slot counts per key and day, and per key, day and hour, maintained from appointments diffs
+Reading them costs the number of days (or hours) asked for, whatever the number of slots
+"""
+
+
+# pylint: disable=line-too-long
+
+
+import collections
+
+
+GRANULARITIES = ("day", "hour")
+
+
+class HeatmapAggregates:
+    """
+    Materialized slot counts, keys being (user_type, control_type, vehicle_type, (organism, site)) tuples
+
+      * days: {key: Counter({date: count})}
+      * hours: {key: Counter({(date, hour): count})}
+    Buckets whose count drops to zero are removed, version is bumped on every change
+    """
+
+    def __init__(self):
+        self.days = collections.defaultdict(collections.Counter)
+        self.hours = collections.defaultdict(collections.Counter)
+        self.version = 0
+
+    def load(self, key, appointments):
+        """ Replace counts of a key by those of a full list of appointments """
+
+        self.days[key] = collections.Counter(x.date() for x in appointments)
+        self.hours[key] = collections.Counter((x.date(), x.hour) for x in appointments)
+        self.version += 1
+
+    def apply(self, key, added, removed):
+        """ Update counts of a key from a diff, return (changed days, changed (day, hour) buckets) sets """
+
+        days = self.days[key]
+        hours = self.hours[key]
+        changed_days = set()
+        changed_hours = set()
+
+        for timestamps, step in ((added, 1), (removed, -1)):
+            for timestamp in timestamps:
+                day = timestamp.date()
+                hour = (day, timestamp.hour)
+                days[day] += step
+                hours[hour] += step
+                changed_days.add(day)
+                changed_hours.add(hour)
+
+        for day in changed_days:
+            if days[day] <= 0:
+                del days[day]
+        for hour in changed_hours:
+            if hours[hour] <= 0:
+                del hours[hour]
+
+        if changed_days:
+            self.version += 1
+        return changed_days, changed_hours
+
+    def view(self, key, granularity, start=None, end=None, buckets=None):
+        """
+        Return {"YYYY-MM-DD": count} (day granularity) or {"YYYY-MM-DD": {"HH": count}} (hour granularity) of a key
+        Only days between start and end dates (both included) are returned, and only given buckets if any,
+        buckets being days or (day, hour) tuples as returned by apply, zero counts are only returned for them
+        """
+
+        assert granularity in GRANULARITIES, "granularity must be one of %s" % ", ".join(GRANULARITIES)
+
+        counts = self.days.get(key, {}) if granularity == "day" else self.hours.get(key, {})
+        items = [(x, counts.get(x, 0)) for x in sorted(buckets)] if buckets is not None else sorted(counts.items())
+
+        result = {}
+        for bucket, count in items:
+            day = bucket if granularity == "day" else bucket[0]
+            if (start is not None and day < start) or (end is not None and day > end):
+                continue
+            if granularity == "day":
+                result[day.isoformat()] = count
+            else:
+                result.setdefault(day.isoformat(), {})["%02d" % bucket[1]] = count
+        return result
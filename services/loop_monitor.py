@@ -0,0 +1,80 @@
+"""
+Detect event loop being blocked by long synchronous steps
+"""
+
+
+# pylint: disable=line-too-long
+
+
+import time
+import asyncio
+import logging
+import threading
+
+from .profiler import format_thread_stack
+
+
+class LoopLagMonitor:
+    """
+    Measure how late a periodic tick fires on the event loop
+    A watchdog thread logs the stack of the loop thread while it is blocked longer than threshold
+    """
+
+    def __init__(self, interval=0.25, threshold=0.5):
+
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.interval = interval
+        self.threshold = threshold
+
+        self.loop_thread_id = None
+        self.last_tick = None
+        self.reported_tick = None
+        self.task = None
+        self.watchdog = None
+        self.stopped = threading.Event()
+
+        self.max_lag = 0.0
+        self.last_lag = 0.0
+        self.blocked_count = 0
+
+    def start(self):
+        """ Start ticking on current event loop and start watchdog thread """
+
+        self.loop_thread_id = threading.get_ident()
+        self.last_tick = time.monotonic()
+        self.task = asyncio.ensure_future(self.tick_forever())
+        self.watchdog = threading.Thread(target=self.watch_forever, name="LoopLagWatchdog", daemon=True)
+        self.watchdog.start()
+
+    async def stop(self):
+        """ Stop ticking and watchdog thread """
+
+        self.stopped.set()
+        if self.task is not None:
+            self.task.cancel()
+        if self.watchdog is not None:
+            self.watchdog.join()
+
+    async def tick_forever(self):
+        """ Sleep for interval and record how late we are woken up """
+
+        while not self.stopped.is_set():
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self.last_tick = now
+            self.last_lag = max(0.0, now - expected)
+            self.max_lag = max(self.max_lag, self.last_lag)
+            if self.last_lag > self.threshold:
+                self.blocked_count += 1
+                self.logger.warning("Event loop was blocked for %.3fs", self.last_lag)
+
+    def watch_forever(self):
+        """ Runs in a thread: dump loop thread stack once per stall exceeding threshold """
+
+        while not self.stopped.wait(self.threshold / 2):
+            last_tick = self.last_tick
+            stalled_for = time.monotonic() - last_tick - self.interval
+            if stalled_for > self.threshold and self.reported_tick != last_tick:
+                self.reported_tick = last_tick
+                self.logger.warning("Event loop blocked for more than %.3fs, currently running:\n%s", stalled_for, format_thread_stack(self.loop_thread_id))
@@ -0,0 +1,79 @@
+"""
+CPU bound steps of a refresh cycle, written as top-level functions working on chunks
+so they can run inline, in a thread pool or in a process pool
+"""
+
+
+# pylint: disable=line-too-long
+
+
+import asyncio
+import datetime
+import concurrent.futures
+
+
+def parse_appointments_payload(payload):
+    """ Turn SNCT {time: [date, ...]} payload into a list of datetime """
+
+    appointments = []
+    for time_str in payload:
+        for date in payload[time_str]:
+            appointments.append(datetime.datetime.strptime("%sT%s" % (date, time_str), "%Y-%m-%dT%HH%M"))
+    return appointments
+
+
+def parse_appointments_chunk(items):
+    """
+    Parse a list of (key, payload, parser) tuples, parser being a module level function like parse_appointments_payload
+    Return a list of (key, appointments, error) tuples, appointments being None if parsing failed
+    """
+
+    results = []
+    for key, payload, parser in items:
+        try:
+            results.append((key, parser(payload), None))
+        except Exception as exc:  # pylint: disable=broad-except
+            results.append((key, None, "%s: %s" % (exc.__class__.__name__, exc)))
+    return results
+
+
+def diff_appointments_chunk(items):
+    """
+    Diff a list of (key, orig_appointments, new_appointments) tuples
+    Return a list of (key, added, removed) tuples, both sorted
+    """
+
+    results = []
+    for key, orig_appointments, new_appointments in items:
+        orig_set = set(orig_appointments)
+        new_set = set(new_appointments)
+        results.append((key, sorted(new_set - orig_set), sorted(orig_set - new_set)))
+    return results
+
+
+def create_executor(mode, workers=None):
+    """ Return executor for given offload mode: none, thread or process """
+
+    assert mode in ["none", "thread", "process"], "offload mode must be one of none, thread, process"
+    if mode == "thread":
+        return concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    if mode == "process":
+        return concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    return None
+
+
+async def map_chunks(executor, func, items, chunk_size=50):
+    """
+    Split items in chunks, run func on each of them in executor and return concatenated results
+    func is called inline if executor is None
+    """
+
+    if executor is None:
+        return func(items)
+
+    loop = asyncio.get_event_loop()
+    futures = [loop.run_in_executor(executor, func, items[idx:idx + chunk_size]) for idx in range(0, len(items), chunk_size)]
+    results = []
+    for chunk_result in await asyncio.gather(*futures):
+        results.extend(chunk_result)
+    return results
@@ -0,0 +1,160 @@
+"""
+On-demand CPU profiling of the running event loop
+Nothing is installed or sampled until a profile is requested
+"""
+
+
+# pylint: disable=line-too-long
+
+
+import io
+import sys
+import time
+import asyncio
+import logging
+import pstats
+import cProfile
+import threading
+import collections
+import traceback
+
+
+def format_thread_stack(thread_id):
+    """ Return current stack of given thread as a formatted string """
+
+    frame = sys._current_frames().get(thread_id, None)  # pylint: disable=protected-access
+    if frame is None:
+        return "Thread %s not found" % thread_id
+    return "".join(traceback.format_stack(frame))
+
+
+class StackSampler(threading.Thread):
+    """
+    Sample stack of a given thread at regular interval from a background thread
+    Result is in collapsed format (one "frame;frame;frame count" line per stack) usable by flamegraph.pl or speedscope
+    """
+
+    def __init__(self, thread_id, interval=0.005):
+        super().__init__(name="StackSampler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id, None)  # pylint: disable=protected-access
+            if frame is None:
+                continue
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append("%s:%s:%d" % (code.co_filename, code.co_name, code.co_firstlineno))
+                frame = frame.f_back
+            self.stacks[";".join(reversed(names))] += 1
+
+    def stop(self):
+        """ Stop sampling and return collapsed stacks """
+
+        self.stopped.set()
+        self.join()
+        return "\n".join("%s %d" % (stack, count) for stack, count in self.stacks.most_common())
+
+
+class LoopProfiler:
+    """
+    Profile the event loop thread with cProfile (deterministic) or a stack sampler (collapsed output)
+    Either for a given duration or for the next scrapper refresh cycle
+    """
+
+    formats = ("pstats", "collapsed")
+
+    def __init__(self):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.busy = False
+        # Futures waiting for next refresh cycle to be profiled, checked by scrapper
+        self.cycle_waiters = []
+
+    @property
+    def cycle_requested(self):
+        """ Tell scrapper next refresh cycle must be profiled """
+
+        return bool(self.cycle_waiters)
+
+    def _start(self, fmt):
+        """ Start profiling current thread, return an opaque profiler object """
+
+        assert fmt in self.formats, "format must be one of %s" % ", ".join(self.formats)
+        if fmt == "pstats":
+            profiler = cProfile.Profile()
+            profiler.enable()
+        else:
+            profiler = StackSampler(threading.get_ident())
+            profiler.start()
+        return profiler
+
+    @staticmethod
+    def _stop(profiler, sort="cumulative", limit=100):
+        """ Stop profiler and return its textual report """
+
+        if isinstance(profiler, StackSampler):
+            return profiler.stop()
+
+        profiler.disable()
+        output = io.StringIO()
+        stats = pstats.Stats(profiler, stream=output)
+        stats.sort_stats(sort).print_stats(limit)
+        return output.getvalue()
+
+    async def profile_for(self, seconds, fmt="pstats", sort="cumulative", limit=100):
+        """ Profile everything running on the event loop for given number of seconds """
+
+        assert not self.busy, "a profile is already running"
+        self.busy = True
+        try:
+            self.logger.info("Profiling event loop for %.1fs (%s)", seconds, fmt)
+            profiler = self._start(fmt)
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                report = self._stop(profiler, sort=sort, limit=limit)
+        finally:
+            self.busy = False
+        return report
+
+    async def profile_next_cycle(self, fmt="pstats", sort="cumulative", limit=100, timeout=600):
+        """ Wait for next refresh cycle to be profiled and return its report """
+
+        assert fmt in self.formats, "format must be one of %s" % ", ".join(self.formats)
+        waiter = asyncio.Future()
+        self.cycle_waiters.append((waiter, fmt, sort, limit))
+        try:
+            return await asyncio.wait_for(asyncio.shield(waiter), timeout)
+        finally:
+            self.cycle_waiters = [x for x in self.cycle_waiters if x[0] is not waiter]
+
+    async def profile_cycle(self, coro_func):
+        """
+        Called by scrapper instead of awaiting coro_func() directly when a cycle profile is requested
+        Other coroutines running at the same time on the loop are part of the profile too
+        """
+
+        waiters, self.cycle_waiters = self.cycle_waiters, []
+        if self.busy:
+            self.logger.warning("A profile is already running, not profiling this cycle")
+            self.cycle_waiters = waiters
+            return await coro_func()
+
+        waiter, fmt, sort, limit = waiters[0]
+        self.busy = True
+        started = time.monotonic()
+        profiler = self._start(fmt)
+        try:
+            return await coro_func()
+        finally:
+            report = self._stop(profiler, sort=sort, limit=limit)
+            self.busy = False
+            self.logger.info("Profiled refresh cycle took %.3fs", time.monotonic() - started)
+            for waiter, *_ in waiters:
+                if not waiter.done():
+                    waiter.set_result(report)
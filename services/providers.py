@@ -0,0 +1,214 @@
+"""
+Appointment providers (vehicle inspection organisms) scrapped by SnctAppointmentScrapper
+All providers share scrapper scheduler, request budget and HTTP connection pool
+"""
+
+
+# pylint: disable=line-too-long
+
+
+import random
+import logging
+import datetime
+import unicodedata
+
+from . import offload
+
+
+class UnsupportedCombination(Exception):
+    """ Provider told this site does not handle this vehicle, request or control type """
+
+
+class AppointmentProvider:
+    """
+    Base class of appointment providers
+
+    A provider knows how to list its sites and vehicle types and how to fetch appointments of a key,
+    a key being a (request_type, control_type, vehicle_type, (organism, site)) tuple
+    HTTP requests must go through self.request(url, key=None), attached by scrapper, returning a (payload, exc) tuple
+    """
+
+    organism = None
+    request_types = ("PRIVATE", "PROFESSIONAL")
+    control_types = ("REGULAR", "REJECTED")
+    # Module level function turning fetched payload into a list of datetime, it may run in a process pool
+    parser = None
+
+    def __init__(self):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.request = None
+        self.site_list = {}
+        self.vehicle_list = {}
+        # Bumped by scrapper when site_list or vehicle_list change, so its query plan entries are rebuilt
+        self.catalog_version = 0
+
+    async def fetch_sites(self):
+        """ Return {(organism, site): site_id} dict, raise on failure """
+        raise NotImplementedError()
+
+    async def fetch_vehicles(self):
+        """ Return {vehicle_type: vehicle_type_id} dict, raise on failure """
+        raise NotImplementedError()
+
+    def plan(self, key, start_date, end_date):  # pylint: disable=unused-argument
+        """
+        Return what fetch_appointments needs to fetch given key between two dates formatted as YYYY-MM-DD
+        Computed once per day by scrapper query plan
+        """
+        return start_date, end_date
+
+    async def fetch_appointments(self, key, plan_entry):
+        """ Return (payload, exc) tuple for given key, plan_entry being returned by plan method """
+        raise NotImplementedError()
+
+    def keys(self):
+        """ Return list of all keys handled by this provider """
+
+        keys = []
+        for request_type in self.request_types:
+            for control_type in self.control_types:
+                for vehicle_type in self.vehicle_list:
+                    for site in self.site_list:
+                        keys.append((request_type, control_type, vehicle_type, site))
+        return keys
+
+    def handles(self, key):
+        """ Tell if key is a known key of this provider """
+
+        return key[0] in self.request_types and key[1] in self.control_types and key[2] in self.vehicle_list and key[3] in self.site_list
+
+
+class SnctProvider(AppointmentProvider):
+    """
+    Société Nationale de Contrôle Technique, https://rdv.snct.lu
+    """
+
+    organism = "snct"
+    parser = staticmethod(offload.parse_appointments_payload)
+
+    def __init__(self, url="https://rdv.snct.lu"):
+        super().__init__()
+        self.url = url
+
+    @property
+    def site_list_url(self):
+        """ Return API url providing list of sites """
+        return self.url + "/rdvct/secure/admin/site/list"
+
+    @property
+    def vehicle_list_url(self):
+        """ Return API url providing list of vehicles """
+        return self.url + "/rdvct/secure/admin/vehicle/type/list"
+
+    @property
+    def vehicle_appointment_url_template(self):  # pylint: disable=invalid-name
+        """ Return API url template (to use with .format() providing list of free appoitments frames """
+        return self.url + "/rdvct/appointment/betweenDates/{start_dt}/{end_dt}/{vehicle_type}/{site_id}/{request_type}/{control_type}"
+
+    @staticmethod
+    def fixed_site_name(name):
+        """
+        Attempt to normalize sites names for easier use in URL placeholders
+        """
+
+        name = name.replace("/", " sur ")
+        name = name.replace(" ", "_")
+        return unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode()
+
+    @staticmethod
+    def fixed_vehicle_name(name):
+        """
+        Attempt to normalize vehicules types
+        Useless at the moment but can help to support Dekra for example
+        """
+
+        name = name.replace("voiture", "car")
+        name = name.replace("tracteur", "tractor")
+        name = name.replace("camionnette", "van")
+        name = name.replace("camion", "truck")
+        name = name.replace("remorque", "trailer")
+        name = name.replace("autobus / autocar", "bus")
+        name = name.replace("trailer < 3,5 t", "small_trailer")
+        name = name.replace("trailer > 3,5 t", "large_trailer")
+        name = name.replace(" ", "_")
+        return unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode()
+
+    async def fetch_sites(self):
+        payload, exc = await self.request(self.site_list_url)
+        if exc is not None:
+            raise exc
+        return {(self.organism, self.fixed_site_name(x["name"].lower())): x["id"] for x in payload}
+
+    async def fetch_vehicles(self):
+        payload, exc = await self.request(self.vehicle_list_url)
+        if exc is not None:
+            raise exc
+        return {self.fixed_vehicle_name(x["name"].lower()): x["id"] for x in payload}
+
+    def plan(self, key, start_date, end_date):
+        return self.appointment_url(key, start_date, end_date)
+
+    def appointment_url(self, key, start_date, end_date):
+        """ Return API url providing free appointments frames for given key """
+
+        request_type, control_type, vehicle_type, site = key
+        return self.vehicle_appointment_url_template.format(
+            start_dt=start_date,
+            end_dt=end_date,
+            vehicle_type=self.vehicle_list[vehicle_type],
+            site_id=self.site_list[site],
+            request_type=request_type,
+            control_type=control_type,
+        )
+
+    async def fetch_appointments(self, key, plan_entry):
+        return await self.request(plan_entry, key=key)
+
+
+class FakeProvider(AppointmentProvider):
+    """
+    Local provider generating random appointments, for testing without hitting any website
+    Payloads use SNCT format, a few slots appear and vanish on every fetch
+    """
+
+    organism = "fake"
+    parser = staticmethod(offload.parse_appointments_payload)
+
+    def __init__(self, sites=("north", "south"), vehicles=("car", "motocycle"), churn=0.1, seed=None, unsupported=(("south", "motocycle"),)):  # pylint: disable=too-many-arguments
+        super().__init__()
+        self.sites = sites
+        self.vehicles = vehicles
+        self.unsupported = set(unsupported)
+        self.churn = churn
+        self.random = random.Random(seed)
+        self.slots = {}
+
+    async def fetch_sites(self):
+        return {(self.organism, x): idx for idx, x in enumerate(self.sites, start=1)}
+
+    async def fetch_vehicles(self):
+        return {x: idx for idx, x in enumerate(self.vehicles, start=1)}
+
+    async def fetch_appointments(self, key, plan_entry):
+        if (key[3][1], key[2]) in self.unsupported:
+            return None, UnsupportedCombination("Site %s does not handle %s" % (key[3][1], key[2]))
+
+        start_date, end_date = plan_entry
+        start = datetime.datetime.strptime(start_date, "%Y-%m-%d")
+        days = (datetime.datetime.strptime(end_date, "%Y-%m-%d") - start).days
+
+        slots = self.slots.get(key, None)
+        if slots is None:
+            slots = {start + datetime.timedelta(days=self.random.randrange(days), hours=self.random.randrange(8, 17)) for _ in range(20)}
+        else:
+            slots = {x for x in slots if x >= start and self.random.random() >= self.churn}
+            slots.update(start + datetime.timedelta(days=self.random.randrange(days), hours=self.random.randrange(8, 17)) for _ in range(int(20 * self.churn)))
+        self.slots[key] = slots
+
+        payload = {}
+        for slot in slots:
+            payload.setdefault(slot.strftime("%HH%M"), []).append(slot.date().isoformat())
+        return payload, None
+
+
+PROVIDERS = {x.organism: x for x in [SnctProvider, FakeProvider]}
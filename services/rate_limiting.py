@@ -0,0 +1,182 @@
+"""
+Token bucket, bounded admission queue and concurrency limiter used to smooth bursts of incoming work
+"""
+
+
+# pylint: disable=line-too-long
+
+
+import time
+import asyncio
+import collections
+
+
+class TokenBucket:
+    """
+    Classic token bucket: rate tokens are added every second, up to burst tokens
+    Time is read from clock if given (see clock module), time.monotonic otherwise
+    """
+
+    def __init__(self, rate, burst=1, clock=None):
+
+        assert rate > 0, "rate must be a positive number of tokens per second"
+        assert burst >= 1, "burst must be at least 1"
+
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.monotonic = clock.monotonic if clock is not None else time.monotonic
+        self.updated_at = self.monotonic()
+
+    def _refill(self):
+        """ Add tokens earned since last call """
+
+        now = self.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def consume(self, tokens=1):
+        """ Take tokens if available and return True, return False otherwise """
+
+        self._refill()
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+
+    def delay(self, tokens=1):
+        """ Return number of seconds to wait before given number of tokens are available """
+
+        self._refill()
+        return max(0.0, (tokens - self.tokens) / self.rate)
+
+    async def acquire(self, tokens=1):
+        """ Wait until tokens are available and take them """
+
+        while not self.consume(tokens):
+            await asyncio.sleep(self.delay(tokens))
+
+
+class AdmissionQueue:
+    """
+    Admit work at a given rate, make excess wait in a bounded FIFO queue
+    and reject it once the queue is full
+    """
+
+    def __init__(self, rate, burst=1, max_queue=100):
+
+        self.bucket = TokenBucket(rate, burst)
+        self.max_queue = max_queue
+        self.waiting = 0
+        self.lock = asyncio.Lock()
+
+    @property
+    def retry_after(self):
+        """ Number of seconds a rejected caller should wait before retrying """
+
+        return int(self.bucket.delay(self.waiting + 1)) + 1
+
+    async def admit(self):
+        """ Wait for our turn and return True, or return False right away if queue is full """
+
+        if self.waiting == 0 and self.bucket.consume():
+            return True
+
+        if self.waiting >= self.max_queue:
+            return False
+
+        self.waiting += 1
+        try:
+            # asyncio.Lock wakes up waiters in FIFO order
+            async with self.lock:
+                await self.bucket.acquire()
+        finally:
+            self.waiting -= 1
+        return True
+
+
+class ConcurrencyLimiter:
+    """
+    Cap number of in-flight units of work, make excess wait in a short FIFO queue
+    Waiting is bounded by max_wait seconds, callers are rejected once the queue is full or their deadline passed
+    """
+
+    def __init__(self, max_in_flight, max_queue=0, max_wait=1.0):
+
+        assert max_in_flight >= 1, "max_in_flight must be at least 1"
+
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.in_flight = 0
+        self.waiting = 0
+        self.waiters = collections.deque()
+
+    @property
+    def retry_after(self):
+        """ Number of seconds a rejected caller should wait before retrying """
+
+        return int(self.max_wait) + 1
+
+    async def admit(self):
+        """ Return True once a slot is ours, release() must then be called, or False if rejected """
+
+        if self.in_flight < self.max_in_flight and self.waiting == 0:
+            self.in_flight += 1
+            return True
+
+        if self.waiting >= self.max_queue:
+            return False
+
+        waiter = asyncio.get_event_loop().create_future()
+        self.waiters.append(waiter)
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(waiter, timeout=self.max_wait)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as exc:
+            # Slot may have been granted right before deadline or cancellation, give it back
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            if isinstance(exc, asyncio.CancelledError):
+                raise
+            return False
+        finally:
+            self.waiting -= 1
+        return True
+
+    def release(self):
+        """ Give a slot back, handing it to first waiter still waiting """
+
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
+
+
+class ClientTokenBuckets:
+    """
+    One token bucket per client, least recently seen clients are forgotten beyond max_clients
+    """
+
+    def __init__(self, rate, burst=1, max_clients=10000):
+
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self.buckets = collections.OrderedDict()
+
+    def get(self, client):
+        """ Return token bucket of given client """
+
+        try:
+            bucket = self.buckets[client]
+        except KeyError:
+            bucket = TokenBucket(self.rate, burst=self.burst)
+            self.buckets[client] = bucket
+            if len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(client)
+        return bucket
@@ -0,0 +1,131 @@
+"""
+Priority request scheduler with a global rate budget
+"""
+
+
+# pylint: disable=line-too-long
+
+
+import heapq
+import asyncio
+import itertools
+
+from .rate_limiting import TokenBucket
+from .clock import SystemClock
+
+
+class RequestSlot:  # pylint: disable=too-few-public-methods
+    """ Async context manager holding a scheduler slot """
+
+    def __init__(self, scheduler, key):
+        self.scheduler = scheduler
+        self.key = key
+
+    async def __aenter__(self):
+        await self.scheduler.acquire(self.key)
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        self.scheduler.release()
+
+
+class RequestScheduler:
+    """
+    Drop-in replacement for a FIFO asyncio.Semaphore in front of outgoing requests
+
+      * pending requests wait in a heap ordered by priority_func(key), lower first, then by arrival
+      * at most concurrency requests are in flight
+      * requests are released at most rate per second, one at a time (token bucket of size 1),
+        so they are paced evenly instead of fired as a burst
+      * pacing waits on clock, so requests of a replay on a VirtualClock are paced in virtual time
+    """
+
+    default_priority = 10
+
+    def __init__(self, concurrency=10, rate=None, priority_func=None, clock=None):
+
+        assert priority_func is None or callable(priority_func), "priority_func must be a callable taking a key and returning a number"
+
+        self.concurrency = concurrency
+        self.clock = clock if clock is not None else SystemClock()
+        self.bucket = None
+        self.priority_func = priority_func
+        self.in_flight = 0
+        self.heap = []
+        self.counter = itertools.count()
+        self.wakeup = None
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        """ Change number of requests per second, None or 0 means unlimited """
+
+        if not rate:
+            self.bucket = None
+        elif self.bucket is None:
+            self.bucket = TokenBucket(rate, burst=1, clock=self.clock)
+        else:
+            self.bucket.rate = float(rate)
+
+    @property
+    def pending(self):
+        """ Number of requests waiting for a slot """
+
+        return len(self.heap)
+
+    def slot(self, key=None):
+        """ Return an async context manager waiting for a slot for given key """
+
+        return RequestSlot(self, key)
+
+    async def acquire(self, key=None):
+        """ Wait until a slot is granted """
+
+        priority = self.default_priority
+        if key is not None and self.priority_func is not None:
+            priority = self.priority_func(key)  # pylint: disable=not-callable
+
+        waiter = asyncio.get_event_loop().create_future()
+        heapq.heappush(self.heap, (priority, next(self.counter), waiter))
+        self._dispatch()
+
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            # Slot was granted right before cancellation, give it back
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        """ Give a slot back """
+
+        self.in_flight -= 1
+        self._dispatch()
+
+    async def _wakeup_dispatch(self, delay):
+        """ Wait until rate allows a new request """
+
+        try:
+            await self.clock.sleep(delay)
+        finally:
+            self.wakeup = None
+        self._dispatch()
+
+    def _dispatch(self):
+        """ Grant slots to highest priority waiters while concurrency and rate allow it """
+
+        while self.heap and self.in_flight < self.concurrency:
+
+            # Cancelled waiters must not use up a rate token
+            if self.heap[0][2].cancelled():
+                heapq.heappop(self.heap)
+                continue
+
+            if self.bucket is not None and not self.bucket.consume():
+                if self.wakeup is None:
+                    self.wakeup = asyncio.ensure_future(self._wakeup_dispatch(self.bucket.delay()))
+                return
+
+            _, _, waiter = heapq.heappop(self.heap)
+            self.in_flight += 1
+            waiter.set_result(None)
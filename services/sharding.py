@@ -0,0 +1,423 @@
+"""
+Split appointments keys between several scrapper nodes by consistent hashing
+Nodes poll their shard only and publish results to a coordinator feeding the central dispatcher
+Coordinator is reached in-process or through a Unix socket speaking newline delimited JSON
+"""
+
+
+# pylint: disable=line-too-long
+
+
+import os
+import time
+import bisect
+import socket
+import asyncio
+import hashlib
+import logging
+import datetime
+import json_codec
+
+from .snct_appointment_scrapper import SnctAppointmentScrapper
+
+
+# Publish messages hold a whole shard, default 64KiB StreamReader limit is too low
+STREAM_LIMIT = 2 ** 24
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def encode_key(key):
+    """ Turn (user_type, control_type, vehicle_type, (organism, site)) key into a JSON friendly list """
+
+    return [key[0], key[1], key[2], key[3][0], key[3][1]]
+
+
+def decode_key(item):
+    """ Reverse of encode_key """
+
+    return (item[0], item[1], item[2], (item[3], item[4]))
+
+
+def encode_appointments(payload):
+    """ Flatten scrapper nested appointments dict into [user_type, control_type, vehicle_type, organism, site, seconds or None] items """
+
+    items = []
+    for user_type in payload:  # pylint: disable=too-many-nested-blocks
+        for control_type in payload[user_type]:
+            for vehicle_type in payload[user_type][control_type]:
+                for site, appointments in payload[user_type][control_type][vehicle_type].items():
+                    if appointments is not None:
+                        appointments = [int((x - EPOCH).total_seconds()) for x in appointments]
+                    items.append([user_type, control_type, vehicle_type, site[0], site[1], appointments])
+    return items
+
+
+def decode_appointments(items):
+    """ Reverse of encode_appointments, return nested dict as expected by dispatcher appointment_handler """
+
+    payload = {}
+    for user_type, control_type, vehicle_type, organism, site, appointments in items:
+        if appointments is not None:
+            appointments = [EPOCH + datetime.timedelta(seconds=x) for x in appointments]
+        payload.setdefault(user_type, {}).setdefault(control_type, {}).setdefault(vehicle_type, {})[(organism, site)] = appointments
+    return payload
+
+
+class HashRing:
+    """
+    Consistent hashing ring, each node owns replicas points on the ring
+    A node joining or leaving only moves keys from or to itself
+    """
+
+    def __init__(self, nodes=(), replicas=64):
+        self.replicas = replicas
+        self.nodes = set()
+        self.points = []
+        self.owners = []
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def hash(value):
+        """ Return position of a string on the ring """
+
+        return int.from_bytes(hashlib.md5(value.encode("utf-8")).digest()[:8], "big")
+
+    def rebuild(self):
+        """ Recompute sorted points from nodes """
+
+        points = sorted((self.hash("%s#%d" % (node, idx)), node) for node in self.nodes for idx in range(self.replicas))
+        self.points = [x[0] for x in points]
+        self.owners = [x[1] for x in points]
+
+    def add(self, node):
+        """ Add a node to the ring """
+
+        self.nodes.add(node)
+        self.rebuild()
+
+    def remove(self, node):
+        """ Remove a node from the ring """
+
+        self.nodes.discard(node)
+        self.rebuild()
+
+    def node_for(self, key):
+        """ Return node owning given key, None if ring is empty """
+
+        if not self.points:
+            return None
+        idx = bisect.bisect(self.points, self.hash("|".join(encode_key(key)))) % len(self.points)
+        return self.owners[idx]
+
+
+class ShardCoordinator:
+    """
+    Track live scrapper nodes and feed their results to the dispatcher
+    Nodes not heard from for node_timeout seconds are dropped, their shard moves to remaining ones
+    """
+
+    def __init__(self, dispatcher, node_timeout=30):
+
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.dispatcher = dispatcher
+        self.node_timeout = node_timeout
+        # {node_id: monotonic time last message was received}
+        self.nodes = {}
+        # {node_id: set of unsupported keys}, merged before being sent to dispatcher
+        self.unsupported = {}
+        # {node_id: set of keys}, out of cycle refreshes waiting for next message of each node
+        self.refresh_pending = {}
+
+    def members(self):
+        """ Return sorted list of live node ids, expiring silent ones """
+
+        now = time.monotonic()
+        for node_id in [x for x, last_seen in self.nodes.items() if now - last_seen > self.node_timeout]:
+            self.logger.warning("Node %s has not been heard from for %ds, rebalancing its shard", node_id, self.node_timeout)
+            self.forget(node_id)
+        return sorted(self.nodes)
+
+    def forget(self, node_id):
+        """ Drop a node and its unsupported keys """
+
+        self.nodes.pop(node_id, None)
+        self.refresh_pending.pop(node_id, None)
+        if self.unsupported.pop(node_id, None):
+            self.publish_unsupported()
+
+    def publish_unsupported(self):
+        """ Send union of nodes unsupported keys to dispatcher """
+
+        unsupported = set()
+        for keys in self.unsupported.values():
+            unsupported.update(keys)
+        self.dispatcher.capability_handler(unsupported)
+
+    def request_refresh(self, keys):
+        """
+        Attached to dispatcher as refresh_requester, keys are sent to all nodes with their next heartbeat or publish
+        response and the node owning each of them refreshes it out of cycle
+        """
+
+        for node_id in self.members():
+            self.refresh_pending.setdefault(node_id, set()).update(keys)
+
+    async def handle(self, message):
+        """ Handle a join, heartbeat, leave or publish message and return membership and keys in demand """
+
+        op = message.get("op", None)
+        node_id = message.get("node_id", None)
+        assert op in ["join", "heartbeat", "leave", "publish"], "op must be one of join, heartbeat, leave, publish"
+        assert isinstance(node_id, str), "node_id must be a string"
+
+        if op == "leave":
+            self.logger.info("Node %s left, rebalancing its shard", node_id)
+            self.forget(node_id)
+        else:
+            if node_id not in self.nodes:
+                self.logger.info("Node %s joined, rebalancing shards", node_id)
+            self.nodes[node_id] = time.monotonic()
+
+        if op == "publish":
+            await self.publish(node_id, message)
+
+        response = {"members": self.members(), "in_demand": [encode_key(x) for x in self.dispatcher.keys_in_demand()]}
+        refresh = self.refresh_pending.pop(node_id, None)
+        if refresh and op != "leave":
+            response["refresh"] = [encode_key(x) for x in refresh]
+        return response
+
+    async def publish(self, node_id, message):
+        """ Forward catalogs and appointments published by a node to dispatcher """
+
+        if message.get("sites", None) is not None:
+            self.dispatcher.site_handler({(x[0], x[1]): x[2] for x in message["sites"]}, None)
+        if message.get("vehicle_types", None) is not None:
+            self.dispatcher.vehicle_handler(message["vehicle_types"], None)
+        if message.get("unsupported", None) is not None:
+            self.unsupported[node_id] = {decode_key(x) for x in message["unsupported"]}
+            self.publish_unsupported()
+        if message.get("appointments", None):
+            result = self.dispatcher.appointment_handler(decode_appointments(message["appointments"]))
+            if asyncio.iscoroutine(result):
+                await result
+
+
+class ShardCoordinatorServer:
+    """ Expose a ShardCoordinator on a Unix socket, one JSON message per line """
+
+    def __init__(self, coordinator, path):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.coordinator = coordinator
+        self.path = path
+        self.server = None
+
+    async def start(self):
+        """ Start listening """
+
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.server = await asyncio.start_unix_server(self.handle_connection, path=self.path, limit=STREAM_LIMIT)
+        self.logger.info("Shard coordinator listening on %s", self.path)
+
+    async def close(self):
+        """ Stop listening """
+
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def handle_connection(self, reader, writer):
+        """ Answer messages of a node until it disconnects """
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    response = await self.coordinator.handle(json_codec.loads(line))
+                except Exception as exc:  # pylint: disable=broad-except
+                    self.logger.exception("Unable to handle node message: %s: %s", exc.__class__.__name__, exc)
+                    response = {"error": "%s: %s" % (exc.__class__.__name__, exc)}
+                writer.write(json_codec.dumps_bytes(response) + b"\n")
+                await writer.drain()
+        finally:
+            writer.close()
+
+
+class LocalCoordinatorClient:  # pylint: disable=too-few-public-methods
+    """ Talk to a ShardCoordinator living in the same process """
+
+    def __init__(self, coordinator):
+        self.coordinator = coordinator
+
+    async def request(self, message):
+        """ Send a message and return response """
+
+        return await self.coordinator.handle(message)
+
+    async def close(self):
+        """ Nothing to close """
+
+
+class UnixCoordinatorClient:
+    """ Talk to a ShardCoordinatorServer through its Unix socket, reconnecting as needed """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = asyncio.Lock()
+        self.reader = None
+        self.writer = None
+
+    async def request(self, message):
+        """ Send a message and return response, raise on connection or coordinator error """
+
+        async with self.lock:
+            try:
+                if self.writer is None:
+                    self.reader, self.writer = await asyncio.open_unix_connection(self.path, limit=STREAM_LIMIT)
+                self.writer.write(json_codec.dumps_bytes(message) + b"\n")
+                await self.writer.drain()
+                line = await self.reader.readline()
+                if not line:
+                    raise ConnectionError("Shard coordinator closed connection")
+            except Exception:
+                await self.close()
+                raise
+
+        response = json_codec.loads(line)
+        if "error" in response:
+            raise RuntimeError("Shard coordinator error: %s" % response["error"])
+        return response
+
+    async def close(self):
+        """ Close connection """
+
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = None
+        self.writer = None
+
+
+class ShardNode:  # pylint: disable=too-many-instance-attributes
+    """
+    Scrapper polling only keys the hash ring gives to this node
+    Membership and keys in demand are refreshed on every heartbeat and publish
+    """
+
+    def __init__(self, client, node_id=None, heartbeat_interval=10, replicas=64, **scrapper_kwargs):
+
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.client = client
+        self.node_id = node_id if node_id is not None else "%s-%d" % (socket.gethostname(), os.getpid())
+        self.heartbeat_interval = heartbeat_interval
+        self.ring = HashRing(replicas=replicas)
+        self.in_demand = set()
+        # Catalogs and unsupported keys waiting for next publish
+        self.pending = {}
+        self.heartbeat_task = None
+
+        self.scrapper = SnctAppointmentScrapper(
+            site_handler=self.site_handler,
+            vehicle_handler=self.vehicle_handler,
+            appointment_handler=self.appointment_handler,
+            capability_handler=self.capability_handler,
+            demand_handler=self.is_key_in_demand,
+            shard_filter=self.owns,
+            **scrapper_kwargs
+        )
+
+    def owns(self, key):
+        """ Tell if key belongs to this node shard """
+
+        return self.ring.node_for(key) == self.node_id
+
+    def is_key_in_demand(self, key):
+        """ Tell if central dispatcher reported key as in demand """
+
+        return key in self.in_demand
+
+    def update(self, response):
+        """ Apply membership and keys in demand received from coordinator, refreshing requested keys of our shard """
+
+        members = set(response["members"])
+        if members != self.ring.nodes:
+            self.ring = HashRing(members, replicas=self.ring.replicas)
+            self.logger.info("Shard rebalanced between %d nodes, %d keys are ours", len(members), len(self.scrapper.appointment_keys()))
+        self.in_demand = {decode_key(x) for x in response["in_demand"]}
+        refresh = [x for x in (decode_key(y) for y in response.get("refresh", [])) if self.owns(x)]
+        if refresh:
+            self.scrapper.request_refresh(refresh)
+
+    def site_handler(self, payload, exc):
+        """ Queue sites for next publish """
+
+        if exc is None:
+            self.pending["sites"] = [[x[0], x[1], site_id] for x, site_id in payload.items()]
+
+    def vehicle_handler(self, payload, exc):
+        """ Queue vehicle types for next publish """
+
+        if exc is None:
+            self.pending["vehicle_types"] = payload
+
+    def capability_handler(self, unsupported):
+        """ Queue unsupported keys for next publish """
+
+        self.pending["unsupported"] = [encode_key(x) for x in unsupported]
+
+    async def publish(self, appointments=None):
+        """ Send pending catalogs and appointments to coordinator, catalogs are kept for next time on failure """
+
+        pending, self.pending = self.pending, {}
+        message = dict(pending, op="publish", node_id=self.node_id, appointments=appointments or [])
+        try:
+            self.update(await self.client.request(message))
+        except Exception as exc:  # pylint: disable=broad-except
+            self.logger.error("Unable to publish to shard coordinator: %s: %s", exc.__class__.__name__, exc)
+            self.pending = dict(pending, **self.pending)
+
+    async def appointment_handler(self, payload):
+        """ Attached to scrapper, publish shard appointments """
+
+        await self.publish(encode_appointments(payload))
+
+    async def heartbeat_forever(self):
+        """ Keep membership alive and up to date between cycles """
+
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                self.update(await self.client.request({"op": "heartbeat", "node_id": self.node_id}))
+            except Exception as exc:  # pylint: disable=broad-except
+                self.logger.error("Shard coordinator heartbeat failed: %s: %s", exc.__class__.__name__, exc)
+
+    async def start(self):
+        """ Join coordinator, fetch catalogs and publish them """
+
+        self.update(await self.client.request({"op": "join", "node_id": self.node_id}))
+        await self.scrapper.refresh_sites()
+        await self.scrapper.refresh_vehicles()
+        await self.publish()
+        self.heartbeat_task = asyncio.ensure_future(self.heartbeat_forever())
+        self.logger.info("Node %s started, %d keys are ours", self.node_id, len(self.scrapper.appointment_keys()))
+
+    async def run_forever(self):
+        """ Poll shard forever """
+
+        await self.scrapper.refresh_appointments_every_minutes()
+
+    async def close(self):
+        """ Leave coordinator so shard is rebalanced right away """
+
+        if self.heartbeat_task is not None:
+            self.heartbeat_task.cancel()
+        try:
+            await self.client.request({"op": "leave", "node_id": self.node_id})
+        except Exception as exc:  # pylint: disable=broad-except
+            self.logger.warning("Unable to leave shard coordinator: %s: %s", exc.__class__.__name__, exc)
+        await self.client.close()
+        await self.scrapper.close()
@@ -0,0 +1,178 @@
+"""
+Append-only history of appointments slots appearing and vanishing, stored in SQLite
+Writes are batched and run in a dedicated thread, never on the event loop
+"""
+
+
+# pylint: disable=line-too-long
+
+
+import time
+import asyncio
+import logging
+import sqlite3
+import datetime
+import concurrent.futures
+import pytz
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS slot_keys (
+    id INTEGER PRIMARY KEY,
+    user_type TEXT NOT NULL,
+    control_type TEXT NOT NULL,
+    vehicle_type TEXT NOT NULL,
+    organism TEXT NOT NULL,
+    site TEXT NOT NULL,
+    UNIQUE (user_type, control_type, vehicle_type, organism, site)
+);
+CREATE INDEX IF NOT EXISTS slot_keys_site_idx ON slot_keys (organism, site);
+CREATE TABLE IF NOT EXISTS slot_events (
+    observed_at INTEGER NOT NULL,
+    observed_weekday INTEGER NOT NULL,
+    observed_hour INTEGER NOT NULL,
+    key_id INTEGER NOT NULL REFERENCES slot_keys (id),
+    event INTEGER NOT NULL,
+    slot_at INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS slot_events_key_idx ON slot_events (key_id, event, observed_at, observed_weekday, observed_hour);
+CREATE INDEX IF NOT EXISTS slot_events_observed_idx ON slot_events (observed_at);
+"""
+
+
+class SlotHistoryStore:
+    """
+    Record every added/removed appointment slot with the time it was observed
+    observed_weekday (0 is Monday) and observed_hour are Luxembourg local time
+    slot_at is the slot local wall clock time as seconds since epoch
+    """
+
+    APPEARED = 1
+    VANISHED = 0
+
+    def __init__(self, path, flush_interval=5.0):
+
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.path = path
+        self.flush_interval = flush_interval
+        # SQLite connection is only ever used from this single thread
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.connection = None
+        self.key_ids = {}
+        self.pending = []
+        self.flush_task = None
+        self.closed = False
+
+    async def run_in_thread(self, func, *args):
+        """ Run func in store thread """
+
+        return await asyncio.get_event_loop().run_in_executor(self.executor, func, *args)
+
+    def _open(self):
+        """ Open database and create schema if needed """
+
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        for row in self.connection.execute("SELECT id, user_type, control_type, vehicle_type, organism, site FROM slot_keys"):
+            self.key_ids[(row[1], row[2], row[3], (row[4], row[5]))] = row[0]
+
+    async def start(self):
+        """ Open database and start flushing pending events periodically """
+
+        await self.run_in_thread(self._open)
+        self.flush_task = asyncio.ensure_future(self.flush_forever())
+        self.logger.info("Slot history stored in %s", self.path)
+
+    async def close(self):
+        """ Flush remaining events and close database """
+
+        self.closed = True
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+        await self.flush()
+        await self.run_in_thread(self.connection.close)
+        self.executor.shutdown(wait=True)
+
+    def change_listener(self, key, added, removed):
+        """ Attached to dispatcher, queue events for next flush, cheap enough to run on the loop """
+
+        now = datetime.datetime.now(tz=pytz.timezone("Europe/Luxembourg"))
+        observed = (int(time.time()), now.weekday(), now.hour)
+        self.pending.extend((observed, key, self.APPEARED, x) for x in added)
+        self.pending.extend((observed, key, self.VANISHED, x) for x in removed)
+
+    def _key_id(self, key):
+        """ Return id of key, inserting it if needed """
+
+        try:
+            return self.key_ids[key]
+        except KeyError:
+            user_type, control_type, vehicle_type, (organism, site) = key
+            cursor = self.connection.execute(
+                "INSERT INTO slot_keys (user_type, control_type, vehicle_type, organism, site) VALUES (?, ?, ?, ?, ?)", (user_type, control_type, vehicle_type, organism, site)
+            )
+            self.key_ids[key] = cursor.lastrowid
+            return cursor.lastrowid
+
+    def _write(self, events):
+        """ Write a batch of events in a single transaction """
+
+        with self.connection:
+            rows = []
+            for (observed_at, weekday, hour), key, event, slot in events:
+                slot_at = int((slot - datetime.datetime(1970, 1, 1)).total_seconds())
+                rows.append((observed_at, weekday, hour, self._key_id(key), event, slot_at))
+            self.connection.executemany("INSERT INTO slot_events VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+    async def flush(self):
+        """ Write pending events """
+
+        if not self.pending:
+            return
+        events, self.pending = self.pending, []
+        try:
+            await self.run_in_thread(self._write, events)
+        except Exception as exc:  # pylint: disable=broad-except
+            self.logger.exception("Unable to write %d slot events: %s: %s", len(events), exc.__class__.__name__, exc)
+        else:
+            self.logger.debug("%d slot events written", len(events))
+
+    async def flush_forever(self):
+        """ Flush pending events every flush_interval """
+
+        while not self.closed:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def _appearances(self, since, until, organism=None, site=None, vehicle_type=None):
+        """ Count appeared slots by site, weekday and hour of observation """
+
+        conditions = ["1 = 1"]
+        params = []
+        for column, value in (("organism", organism), ("site", site), ("vehicle_type", vehicle_type)):
+            if value is not None:
+                conditions.append("%s = ?" % column)
+                params.append(value)
+
+        query = """
+            SELECT k.organism, k.site, e.observed_weekday, e.observed_hour, COUNT(*)
+            FROM slot_keys k JOIN slot_events e ON e.key_id = k.id
+            WHERE %s AND e.event = ? AND e.observed_at >= ? AND e.observed_at < ?
+            GROUP BY k.organism, k.site, e.observed_weekday, e.observed_hour
+            ORDER BY k.organism, k.site, e.observed_weekday, e.observed_hour
+        """ % " AND ".join(conditions)
+        params.extend([self.APPEARED, since, until])
+
+        return self.connection.execute(query, params).fetchall()
+
+    async def appearances(self, since, until, organism=None, site=None, vehicle_type=None):
+        """
+        Return number of slots which appeared, by organism, site, weekday and hour of observation
+        rate_per_week is count divided by number of weeks in [since, until) range (unix timestamps)
+        """
+
+        rows = await self.run_in_thread(self._appearances, since, until, organism, site, vehicle_type)
+        weeks = max((until - since) / (7 * 24 * 3600), 1 / (7 * 24))
+        return [{"organism": x[0], "site": x[1], "weekday": x[2], "hour": x[3], "count": x[4], "rate_per_week": round(x[4] / weeks, 3)} for x in rows]
@@ -1,86 +1,195 @@
 """
-aiohttp asynchronous Bsoch RCP+ client
-For dome camera PTZ handling
+Scrape appointment providers, SNCT by default, and push free appointments to handlers
 """
 
 
 # pylint: disable=line-too-long
 
 
+import time
 import logging
 import asyncio
 import functools
 import collections
-import unicodedata
 import datetime
 import pytz
 import aiohttp
+import json_codec
 
+from . import offload
+from .providers import AppointmentProvider, SnctProvider, UnsupportedCombination
+from .rate_limiting import TokenBucket
+from .request_scheduler import RequestScheduler
+from .clock import SystemClock
 
-class SnctAppointmentScrapper:  # pylint: disable=too-many-instance-attributes
+
+LUX_TZ = pytz.timezone("Europe/Luxembourg")
+
+
+class SnctAppointmentScrapper:  # pylint: disable=too-many-instance-attributes,too-many-public-methods
     """
     Connect to SNCT API to find incoming free appointment timeframes and push them to handler
     Also take care of updating SNCT list of center and accepted vehicles types
+
+    Other inspection providers can be scrapped as well, they all share the same scheduler,
+    request budget and HTTP connection pool (see providers module)
     """
 
-    def __init__(self, site_handler=None, vehicle_handler=None, appointment_handler=None):
+    def __init__(self, site_handler=None, vehicle_handler=None, appointment_handler=None, demand_handler=None, idle_refresh_interval=900, profiler=None, executor=None, offload_chunk_size=50, burst_neighbours=(), burst_budget=0, burst_delay=5.0, providers=None, priority_handler=None, requests_per_second=0, catalog_refresh_interval=3600, capability_handler=None, unsupported_recheck_interval=86400, shard_filter=None, clock=None, recorder=None):  # pylint: disable=too-many-arguments
 
         # Defaults to local handlers doing nothing but writing logs
         if site_handler is None:
-            self.site_handler = self._site_handler
+            site_handler = self._site_handler
         if vehicle_handler is None:
             vehicle_handler = self._vehicle_handler
         if appointment_handler is None:
             appointment_handler = self._appointment_handler
+        if capability_handler is None:
+            capability_handler = self._capability_handler
 
         assert callable(site_handler), "site_handler must be a callable handling payload and exc arguments"
         assert callable(vehicle_handler), "vehicle_handler must be a callable handling payload and exc arguments"
         assert callable(appointment_handler), "appointment_handler must be a callable handling payload and exc arguments"
 
+        assert callable(capability_handler), "capability_handler must be a callable receiving a set of unsupported keys"
+        assert shard_filter is None or callable(shard_filter), "shard_filter must be a callable taking a key and returning a boolean"
+        assert demand_handler is None or callable(demand_handler), "demand_handler must be a callable taking a key and returning a boolean"
+
         self.site_handler = site_handler
         self.vehicle_handler = vehicle_handler
         self.appointment_handler = appointment_handler
+        self.capability_handler = capability_handler
+        # Tell if a (request_type, control_type, vehicle_type, site) key is wanted by someone, all keys are if not set
+        self.demand_handler = demand_handler
+        self.idle_refresh_interval = idle_refresh_interval
+        # Tell if a key belongs to this scrapper when keys are sharded between several nodes, all keys do if not set
+        self.shard_filter = shard_filter
+        # Optional LoopProfiler, asked before each cycle if it wants to profile it
+        self.profiler = profiler
+        # Optional thread or process pool executor parsing payloads out of the event loop
+        self.executor = executor
+        self.offload_chunk_size = offload_chunk_size
+
+        # Cancellations come in clusters, so a changed key triggers a quick re-poll of itself and its neighbours
+        # "site" neighbours are other vehicle types at same site, "vehicle" ones are same vehicle type at other sites
+        assert all([x in ["site", "vehicle"] for x in burst_neighbours]), "burst_neighbours must only contain site and/or vehicle"
+        self.burst_neighbours = set(burst_neighbours)
+        self.burst_delay = burst_delay
+        self.burst_budget = TokenBucket(rate=burst_budget / 60.0, burst=burst_budget) if burst_budget > 0 else None
+        self.burst_pending = set()
 
-        self.url = "https://rdv.snct.lu"
         self.timeout = 10
         self.concurrency = 10
+        self.refresh_interval = 60
+        # A VirtualClock lets replayed refresh cycles run faster than real time, see traffic_replay module
+        self.clock = clock if clock is not None else SystemClock()
         self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(verify_ssl=False))
+        # Optional TrafficRecorder capturing all responses
+        self.recorder = recorder
+        if recorder is not None:
+            self.session = recorder.wrap(self.session)
         self.logger = logging.getLogger(self.__class__.__name__)
         self.closed = False
-        self.semaphore = asyncio.Semaphore(value=self.concurrency)
-
-        self.site_list = {}
-        self.vehicle_list = {}
+        # Requests wait in a priority queue and are paced by a token bucket
+        # requests_per_second 0 means pacing periodic refreshes evenly over 80% of refresh interval
+        self.requests_per_second = requests_per_second
+        self.scheduler = RequestScheduler(concurrency=self.concurrency, rate=requests_per_second or None, priority_func=priority_handler, clock=self.clock)
+
+        # Providers only perform HTTP requests through our _request method
+        providers = providers if providers is not None else [SnctProvider()]
+        assert all([isinstance(x, AppointmentProvider) for x in providers]), "providers must be a list of AppointmentProvider instances"
+        self.providers = collections.OrderedDict((x.organism, x) for x in providers)
+        for provider in providers:
+            provider.request = self._request
+
+        self.last_refreshed = {}
+
+        # Negative cache: {key: monotonic time it was found unsupported}
+        self.unsupported = {}
+        self.unsupported_recheck_interval = unsupported_recheck_interval
+
+        # Precomputed keys and provider request arguments, see query_plan
+        self.plan = {}
+        self.plan_dates = None
+        self.plan_catalog_versions = {}
+        self.catalog_refresh_interval = catalog_refresh_interval
+        # Last time every provider sites and vehicles lists were fetched successfully, failures are retried next cycle
+        self.catalog_refreshed_at = {"sites": None, "vehicles": None}
+        self.out_of_cycle_tasks = set()
 
     async def close(self):
         """ Kill asyncio session on shutdown """
         self.closed = True
+        for task in self.out_of_cycle_tasks:
+            task.cancel()
         await self.session.close()
 
     @property
     def today_lux_date(self):
         """ Return today date properly formatted for SNCT API as local Luxembourg time """
-        return datetime.datetime.now(tz=pytz.timezone("Europe/Luxembourg")).date().isoformat()
+        return self.clock.now(tz=LUX_TZ).date().isoformat()
 
     @property
     def two_month_later_lux_date(self):
         """ Return two months offsetted date properly formatted for SNCT API as local Luxembourg time """
-        return (datetime.datetime.now(tz=pytz.timezone("Europe/Luxembourg")).date() + datetime.timedelta(weeks=10)).isoformat()
+        return (self.clock.now(tz=LUX_TZ).date() + datetime.timedelta(weeks=10)).isoformat()
 
-    @property
-    def site_list_url(self):
-        """ Return API url providing list of sites """
-        return self.url + "/rdvct/secure/admin/site/list"
+    def lux_dates(self):
+        """ Return (today, two months later) dates formatted for providers, computed from a single clock read """
+
+        today = self.clock.now(tz=LUX_TZ).date()
+        return today.isoformat(), (today + datetime.timedelta(weeks=10)).isoformat()
+
+    def query_plan(self):
+        """
+        Return {key: (provider, plan_entry)} dict of everything to poll, plan_entry being prepared by provider (an URL for SNCT)
+        Fully rebuilt on day rollover, only entries of providers whose sites or vehicles changed are rebuilt otherwise
+        """
+
+        dates = self.lux_dates()
+        if dates != self.plan_dates:
+            self.plan = {}
+            self.plan_dates = dates
+            self.plan_catalog_versions = {}
+
+        for organism, provider in self.providers.items():
+            if self.plan_catalog_versions.get(organism, None) == provider.catalog_version:
+                continue
+            for key in [x for x in self.plan if x[3][0] == organism]:
+                del self.plan[key]
+            for key in provider.keys():
+                self.plan[key] = (provider, provider.plan(key, *dates))
+            self.plan_catalog_versions[organism] = provider.catalog_version
+            self.logger.info("Query plan rebuilt for %s between %s and %s, %d keys to poll in total", organism, dates[0], dates[1], len(self.plan))
+
+        return self.plan
 
     @property
-    def vehicle_list_url(self):
-        """ Return API url providing list of vehicles """
-        return self.url + "/rdvct/secure/admin/vehicle/type/list"
+    def site_list(self):
+        """ Return {(organism, site): site_id} dict of all providers """
+
+        sites = {}
+        for provider in self.providers.values():
+            sites.update(provider.site_list)
+        return sites
 
     @property
-    def vehicle_appointment_url_template(self):  # pylint: disable=invalid-name
-        """ Return API url template (to use with .format() providing list of free appoitments frames """
-        return self.url + "/rdvct/appointment/betweenDates/{start_dt}/{end_dt}/{vehicle_type}/{site_id}/{request_type}/{control_type}"
+    def vehicle_list(self):
+        """ Return {vehicle_type: {organism: vehicle_type_id}} dict of all providers """
+
+        vehicles = collections.defaultdict(dict)
+        for organism, provider in self.providers.items():
+            for vehicle_type, vehicle_type_id in provider.vehicle_list.items():
+                vehicles[vehicle_type][organism] = vehicle_type_id
+        return dict(vehicles)
+
+    def provider_for(self, key):
+        """ Return provider handling given key, None if unknown """
+
+        provider = self.providers.get(key[3][0], None)
+        if provider is not None and provider.handles(key):
+            return provider
+        return None
 
     def _dummy_handler(self, payload, exc, data_type="undefined"):
         """ Dummy handler for receiving data updates """
@@ -104,22 +213,26 @@ class SnctAppointmentScrapper:  # pylint: disable=too-many-instance-attributes
         """ Dummy handler for receiving appoitment updates """
         return functools.partial(self._dummy_handler, data_type="appointment")
 
-    async def _request(self, url):
+    def _capability_handler(self, unsupported):
+        """ Dummy handler for receiving unsupported keys updates """
+        self.logger.debug("Got %d unsupported keys", len(unsupported))
+
+    async def _request(self, url, key=None):
         """
         Perform GET HTTP request on given URL
+        key, if given, is used to compute request priority
         Return a tuple (payload, exception) with None value if non-existing
         """
 
         if self.closed:
-            return
+            return None, RuntimeError("Scrapper has been closed")
 
         try:
-            #self.logger.info("About to query %s, semaphore is %s", url, self.semaphore)
-            async with self.semaphore:
+            async with self.scheduler.slot(key):
                 resp = await self.session.get(url, timeout=self.timeout)
             if resp.status == 200:
                 try:
-                    payload = await resp.json()
+                    payload = await resp.json(loads=json_codec.loads)
                 except RuntimeError as exc:
                     # Looks like being a bug in asyncio
                     # https://github.com/python/asyncio/issues/488
@@ -129,9 +242,9 @@ class SnctAppointmentScrapper:  # pylint: disable=too-many-instance-attributes
                         raise exc from None
             # Some centers do not handle motocycle for example
             elif resp.status == 400:
-                payload = await resp.json()
+                payload = await resp.json(loads=json_codec.loads)
                 assert payload["code"] == "1" and payload["type"] == "TECHNICAL", "API responded with 400 code but it is not the usual error: %s" % payload
-                payload = {}
+                return None, UnsupportedCombination("API responded with 400 code, combination is not handled: %s" % url)
             else:
                 assert False, "API responded with unexpected %d code: %.80s" % (resp.status, await resp.text())
         except (asyncio.TimeoutError, AssertionError) as exc:
@@ -144,129 +257,260 @@ class SnctAppointmentScrapper:  # pylint: disable=too-many-instance-attributes
             return payload, None
 
     async def refresh_sites(self):
-        """ Refresh sites list """
-
-        def fixed(name):
-            """
-            Attempt to normalize sites names for easier use in URL placeholders
-            """
+        """ Refresh sites list of all providers, a provider failing keeps its previous list """
 
-            name = name.replace("/", " sur ")
-            name = name.replace(" ", "_")
-            return unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode()
+        started = self.clock.monotonic()
+        last_exc = None
+        for provider in self.providers.values():
+            try:
+                sites = await provider.fetch_sites()
+                if sites != provider.site_list:
+                    provider.site_list = sites
+                    provider.catalog_version += 1
+            except Exception as exc:  # pylint: disable=broad-except
+                self.logger.exception("Got exception while refreshing %s sites: %s: %s", provider.organism, exc.__class__.__name__, exc)
+                last_exc = exc
 
-        payload, exc = await self._request(self.site_list_url)
+        if last_exc is None:
+            self.catalog_refreshed_at["sites"] = started
 
-        if exc is not None:
-            self.site_handler(None, exc)  # pylint: disable=not-callable
+        sites = self.site_list
+        if not sites:
+            self.site_handler(None, last_exc)  # pylint: disable=not-callable
             return
 
-        try:
-            organism = "snct"
-            sites = {(organism, fixed(x["name"].lower())): x["id"] for x in payload}
-        except Exception as exc:  # pylint: disable=broad-except
-            self.logger.exception("Got exception while formatting site payload: %s: %s", exc.__class__.__name__, exc)
-            self.site_handler(None, exc)  # pylint: disable=not-callable
-        else:
-            self.site_list = sites
-            self.logger.info("Following sites will be sent to handler: %s", sites)
-            self.site_handler(sites, exc)  # pylint: disable=not-callable
+        self.logger.info("Following sites will be sent to handler: %s", sites)
+        self.site_handler(sites, None)  # pylint: disable=not-callable
+
+    def is_catalog_due(self, name):
+        """ Tell if sites or vehicles lists must be fetched, never fetched or failed ones being retried every cycle """
+
+        refreshed_at = self.catalog_refreshed_at[name]
+        return refreshed_at is None or self.clock.monotonic() - refreshed_at >= self.catalog_refresh_interval
 
     async def refresh_vehicles(self):
-        """ Refresh vehicles list """
-
-        def fixed(name):
-            """
-            Attempt to normalize vehicules types
-            Useless at the moment but can help to support Dekra for example
-            """
-
-            name = name.replace("voiture", "car")
-            name = name.replace("tracteur", "tractor")
-            name = name.replace("camionnette", "van")
-            name = name.replace("camion", "truck")
-            name = name.replace("remorque", "trailer")
-            name = name.replace("autobus / autocar", "bus")
-            name = name.replace("trailer < 3,5 t", "small_trailer")
-            name = name.replace("trailer > 3,5 t", "large_trailer")
-            name = name.replace(" ", "_")
-            return unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode()
-
-        payload, exc = await self._request(self.vehicle_list_url)
-        if exc is not None:
-            self.vehicle_handler(payload, exc)  # pylint: disable=not-callable
+        """ Refresh vehicles list of all providers, a provider failing keeps its previous list """
+
+        started = self.clock.monotonic()
+        last_exc = None
+        for provider in self.providers.values():
+            try:
+                vehicles = await provider.fetch_vehicles()
+                if vehicles != provider.vehicle_list:
+                    provider.vehicle_list = vehicles
+                    provider.catalog_version += 1
+            except Exception as exc:  # pylint: disable=broad-except
+                self.logger.exception("Got exception while refreshing %s vehicles: %s: %s", provider.organism, exc.__class__.__name__, exc)
+                last_exc = exc
+
+        if last_exc is None:
+            self.catalog_refreshed_at["vehicles"] = started
+
+        vehicles = self.vehicle_list
+        if not vehicles:
+            self.vehicle_handler(None, last_exc)  # pylint: disable=not-callable
             return
 
-        try:
-            vehicles = {fixed(x["name"].lower()): x["id"] for x in payload}
-        except Exception as exc:  # pylint: disable=broad-except
-            self.logger.exception("Got exception while formatting vehicle payload: %s: %s", exc.__class__.__name__, exc)
-            self.vehicle_handler(None, exc)  # pylint: disable=not-callable
-        else:
-            self.vehicle_list = vehicles
-            self.logger.info("Following vehicles will be sent to handler: %s", vehicles)
-            self.vehicle_handler(vehicles, exc)  # pylint: disable=not-callable
+        self.logger.info("Following vehicles will be sent to handler: %s", vehicles)
+        self.vehicle_handler(vehicles, None)  # pylint: disable=not-callable
+
+    def appointment_keys(self):
+        """ Return list of all (request_type, control_type, vehicle_type, site) keys to poll, only those of our shard if sharded """
+
+        if self.shard_filter is None:
+            return list(self.query_plan())
+        return [x for x in self.query_plan() if self.shard_filter(x)]  # pylint: disable=not-callable
 
-    async def refresh_appointments(self):  # pylint: disable=too-many-locals
-        """ Refresh appointments list """
+    def is_unsupported(self, key, now):
+        """ Tell if key was found unsupported by its provider and should not be re-checked yet """
 
-        inputs = {}
+        unsupported_at = self.unsupported.get(key, None)
+        return unsupported_at is not None and now - unsupported_at < self.unsupported_recheck_interval
+
+    @property
+    def unsupported_keys(self):
+        """ Return set of keys currently known as unsupported by their provider """
+
+        now = self.clock.monotonic()
+        return {x for x in self.unsupported if self.is_unsupported(x, now)}
+
+    def is_refresh_due(self, key, now):
+        """
+        Keys in demand are refreshed every cycle, idle ones only every idle_refresh_interval
+        Unsupported keys are only re-checked every unsupported_recheck_interval
+        """
+
+        if self.is_unsupported(key, now):
+            return False
+        if self.demand_handler is None or self.demand_handler(key):  # pylint: disable=not-callable
+            return True
+        last_refreshed = self.last_refreshed.get(key, None)
+        return last_refreshed is None or now - last_refreshed >= self.idle_refresh_interval
+
+    async def refresh_appointments(self, keys=None):  # pylint: disable=too-many-locals
+        """
+        Refresh appointments list
+        Only keys due for a refresh are polled unless an explicit list of keys is given
+        """
+
+        now = self.clock.monotonic()
+        all_keys = self.appointment_keys()
+        due_keys = [x for x in all_keys if self.is_refresh_due(x, now)]
+        if keys is None:
+            keys = due_keys
+            self.logger.info("%d keys out of %d are due for refresh", len(keys), len(all_keys))
+
+        # Pace requests before any is scheduled, including first and out-of-cycle refreshes
+        if not self.requests_per_second:
+            self.scheduler.set_rate(max(1.0, len(due_keys) / (self.refresh_interval * 0.8)))
+
+        plan = self.query_plan()
+        inputs = [(key,) + plan[key] for key in keys if key in plan]
         appointments = collections.defaultdict(lambda: collections.defaultdict(lambda: collections.defaultdict(lambda: collections.defaultdict(list))))
         count = 0
 
-        for request_type in ["PRIVATE", "PROFESSIONAL"]:
-            for control_type in ["REGULAR", "REJECTED"]:
-                for vehicule_type, vehicule_type_id in self.vehicle_list.items():
-                    for site, site_id in self.site_list.items():
-                        url = self.vehicle_appointment_url_template.format(
-                            start_dt=self.today_lux_date, end_dt=self.two_month_later_lux_date, vehicle_type=vehicule_type_id, site_id=site_id, request_type=request_type, control_type=control_type
-                        )
-                        inputs[(request_type, control_type, vehicule_type, site, url)] = None
+        # Concurrency and rate limited by request scheduler, shared by all providers
+        results = await asyncio.gather(*[provider.fetch_appointments(key, plan_entry) for key, provider, plan_entry in inputs], return_exceptions=True)
 
-        # Concurrency limited by asyncio session parameters
-        results = await asyncio.gather(*[self._request(x[4]) for x in inputs])
+        blocking_started = time.perf_counter()
+        to_parse = []
+        unsupported_changed = False
+        for (key, provider, _), result in zip(inputs, results):
 
-        for inp, result in zip(inputs, results):
+            request_type, control_type, vehicle_type, site = key
 
             if isinstance(result, Exception):
-                self.logger.error("Got exception when querying (1) %s: %s: %s", url, inp.__class__.__name__, inp[4])
-                appointments[inp[0]][inp[1]][inp[2]][inp[3]] = None
+                self.logger.error("Got exception when querying (1) %s/%s %s/%s/%s: %s: %s", site[0], site[1], request_type, control_type, vehicle_type, result.__class__.__name__, result)
+                appointments[request_type][control_type][vehicle_type][site] = None
                 continue
 
             payload, exc = result
 
+            # Site does not handle this kind of vehicle, remember it to stop polling it every cycle
+            if isinstance(exc, UnsupportedCombination):
+                if key not in self.unsupported:
+                    self.logger.info("%s/%s %s/%s/%s is not supported, re-checking it every %ds", site[0], site[1], request_type, control_type, vehicle_type, self.unsupported_recheck_interval)
+                    unsupported_changed = True
+                self.unsupported[key] = now
+                self.last_refreshed[key] = now
+                appointments[request_type][control_type][vehicle_type][site] = []
+                continue
+
             if exc is not None:
-                self.logger.error("Got exception when querying (2) %s: %s: %s", url, exc.__class__.__name__, exc)
-                appointments[inp[0]][inp[1]][inp[2]][inp[3]] = None
+                self.logger.error("Got exception when querying (2) %s/%s %s/%s/%s: %s: %s", site[0], site[1], request_type, control_type, vehicle_type, exc.__class__.__name__, exc)
+                appointments[request_type][control_type][vehicle_type][site] = None
                 continue
 
-            self.logger.debug("Refreshing available appointments at %s worked !", inp[4])
+            self.logger.debug("Refreshing available appointments for %s/%s %s/%s/%s worked !", site[0], site[1], request_type, control_type, vehicle_type)
+            self.last_refreshed[key] = now
+            if self.unsupported.pop(key, None) is not None:
+                unsupported_changed = True
+            to_parse.append((key, payload, provider.parser))
+        blocking = time.perf_counter() - blocking_started
+
+        # Parsing all slots with strptime is the expensive part, it can be sent to a worker pool
+        if self.executor is None:
+            blocking_started = time.perf_counter()
+            parsed = offload.parse_appointments_chunk(to_parse)
+        else:
+            parsed = await offload.map_chunks(self.executor, offload.parse_appointments_chunk, to_parse, chunk_size=self.offload_chunk_size)
+            blocking_started = time.perf_counter()
 
-            try:
-                for time in payload:
-                    for date in payload[time]:
-                        date_time_str = "%sT%s" % (date, time)
-                        date_time_dt = datetime.datetime.strptime(date_time_str, "%Y-%m-%dT%HH%M")
-                        appointments[inp[0]][inp[1]][inp[2]][inp[3]].append(date_time_dt)
-                        count += 1
-            except Exception as exc:  # pylint: disable=broad-except
-                self.logger.exception("Got exception while formatting vehicle payload: %s: %s", exc.__class__.__name__, exc)
+        for (request_type, control_type, vehicle_type, site), key_appointments, error in parsed:
+            if error is not None:
+                self.logger.error("Got exception while formatting appointments payload for %s/%s %s/%s/%s: %s", site[0], site[1], request_type, control_type, vehicle_type, error)
+            else:
+                count += len(key_appointments)
+            appointments[request_type][control_type][vehicle_type][site] = key_appointments
+        blocking += time.perf_counter() - blocking_started
+
+        if unsupported_changed:
+            self.capability_handler(self.unsupported_keys)  # pylint: disable=not-callable
 
-        self.logger.info("%d appointments will be sent to handler", count)
-        self.appointment_handler(appointments)  # pylint: disable=not-callable
+        self.logger.info("%d appointments will be sent to handler, parsing blocked event loop for %.3fs", count, blocking)
+        result = self.appointment_handler(appointments)  # pylint: disable=not-callable
+        # Handler may offload its own work and return a coroutine
+        if asyncio.iscoroutine(result):
+            await result
+
+    def request_refresh(self, keys):
+        """
+        Schedule an out of cycle refresh for given keys
+        Used by dispatcher when a key gets its first subscriber
+        """
+
+        now = self.clock.monotonic()
+        known_keys = [x for x in keys if self.provider_for(x) is not None and not self.is_unsupported(x, now)]
+        if self.closed or not known_keys:
+            return
+
+        self.logger.info("Out of cycle refresh requested for %d keys", len(known_keys))
+        task = asyncio.ensure_future(self.refresh_appointments(keys=known_keys))
+        self.out_of_cycle_tasks.add(task)
+        task.add_done_callback(self.out_of_cycle_tasks.discard)
+
+    def neighbour_keys(self, key):
+        """ Return given key and its configured neighbours """
+
+        request_type, control_type, vehicle_type, site = key
+        keys = [key]
+        if "site" in self.burst_neighbours:
+            keys.extend((request_type, control_type, x, site) for x in self.vehicle_list if x != vehicle_type)
+        if "vehicle" in self.burst_neighbours:
+            keys.extend((request_type, control_type, vehicle_type, x) for x in self.site_list if x != site)
+        now = self.clock.monotonic()
+        return [x for x in keys if self.provider_for(x) is not None and not self.is_unsupported(x, now)]
+
+    def change_listener(self, key, added, removed):  # pylint: disable=unused-argument
+        """
+        Attached to dispatcher, schedule a burst re-poll of a changed key and its neighbours
+        Number of extra requests is bounded by burst budget (per minute)
+        """
+
+        if self.burst_budget is None or self.closed:
+            return
+
+        keys = []
+        for neighbour in self.neighbour_keys(key):
+            if neighbour in self.burst_pending:
+                continue
+            if not self.burst_budget.consume():
+                self.logger.info("Burst budget exhausted, %s/%s %s/%s/%s neighbours will wait for next cycle", key[3][0], key[3][1], key[0], key[1], key[2])
+                break
+            keys.append(neighbour)
+
+        if keys:
+            self.burst_pending.update(keys)
+            asyncio.get_event_loop().call_later(self.burst_delay, self.run_burst, keys)
+
+    def run_burst(self, keys):
+        """ Re-poll keys scheduled by change_listener """
+
+        self.burst_pending.difference_update(keys)
+        self.logger.info("Burst re-polling %d keys", len(keys))
+        self.request_refresh(keys)
 
     async def refresh_appointments_every_minutes(self):  # pylint: disable=invalid-name
         """ Call refresh_appointments and sleep for 1 minute before doing it again """
 
         while not self.closed:
 
+            # Sites and vehicles rarely change, refresh them from time to time
+            if self.is_catalog_due("sites"):
+                await self.refresh_sites()
+            if self.is_catalog_due("vehicles"):
+                await self.refresh_vehicles()
+
             try:
-                await self.refresh_appointments()
+                if self.profiler is not None and self.profiler.cycle_requested:
+                    await self.profiler.profile_cycle(self.refresh_appointments)
+                else:
+                    await self.refresh_appointments()
             except Exception as exc:  # pylint: disable=broad-except
                 self.logger.exception("Got exception periodically refreshing appointments: %s: %s", exc.__class__.__name__, exc)
             finally:
-                self.logger.info("Sleeping 60s before refreshing again")
-                await asyncio.sleep(60)
+                self.logger.info("Sleeping %ds before refreshing again", self.refresh_interval)
+                await self.clock.sleep(self.refresh_interval)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,125 @@
+"""
+Swagger spec generated from handlers docstrings on first use instead of at startup,
+and kept in a JSON file keyed by a hash of its sources so other processes and next boots skip YAML parsing
+"""
+
+
+# pylint: disable=line-too-long
+
+
+import os
+import json
+import inspect
+import time
+import logging
+import hashlib
+import tempfile
+import aiohttp.web
+import aiohttp_swagger
+from aiohttp_swagger.helpers import generate_doc_from_each_end_point
+
+
+class SwaggerSpecCache:
+    """
+    Build Swagger JSON definition of an application lazily
+
+      * source hash covers routes methods and paths, handlers docstrings and generation parameters,
+        so cache file is regenerated as soon as one of them changes
+      * cache file is optional, spec is only kept in memory without it
+      * kwargs are those setup_swagger would have passed to the generator, schemes being set on the spec
+        afterwards when this aiohttp_swagger generator does not take them
+      * handler() returns an aiohttp_swagger swagger_def_decor serving the spec, built on first request
+    """
+
+    def __init__(self, app, path=None, **kwargs):
+
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.app = app
+        self.path = path
+        self.kwargs = kwargs
+        self.content = None
+
+    def source_hash(self):
+        """ Return hex digest of everything the generated spec depends on """
+
+        digest = hashlib.sha256()
+        digest.update(json.dumps([getattr(aiohttp_swagger, "__version__", None), self.kwargs], sort_keys=True, default=str).encode("utf-8"))
+        for route in self.app.router.routes():
+            route_info = route.get_info()
+            url = route_info.get("formatter", route_info.get("path", route_info.get("prefix", "")))
+            digest.update(("\n%s %s\n" % (route.method, url)).encode("utf-8"))
+            digest.update((getattr(route.handler, "__doc__", None) or "").encode("utf-8"))
+        return digest.hexdigest()
+
+    def load(self, source_hash):
+        """ Return spec JSON text from cache file, None if missing, unreadable or generated from other sources """
+
+        if self.path is None:
+            return None
+        try:
+            with open(self.path, "r", encoding="utf-8") as cache_fh:
+                cached = json.load(cache_fh)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as exc:
+            self.logger.warning("Unable to read Swagger spec cache %s: %s: %s", self.path, exc.__class__.__name__, exc)
+            return None
+        if not isinstance(cached, dict) or cached.get("source_hash") != source_hash:
+            self.logger.info("Swagger spec cache %s is outdated", self.path)
+            return None
+        return json.dumps(cached["spec"])
+
+    def save(self, source_hash, content):
+        """ Write spec to cache file atomically, so concurrent workers never read a partial file """
+
+        if self.path is None:
+            return
+        directory = os.path.dirname(os.path.abspath(self.path))
+        tmp_path = None
+        try:
+            with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=directory, prefix=".swagger-", suffix=".tmp", delete=False) as cache_fh:
+                tmp_path = cache_fh.name
+                json.dump({"source_hash": source_hash, "spec": json.loads(content)}, cache_fh)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, self.path)
+        except (OSError, ValueError) as exc:
+            self.logger.warning("Unable to write Swagger spec cache %s: %s: %s", self.path, exc.__class__.__name__, exc)
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+    def generate(self):
+        """ Return spec JSON text generated from handlers docstrings """
+
+        parameters = inspect.signature(generate_doc_from_each_end_point).parameters
+        content = generate_doc_from_each_end_point(self.app, **{x: y for x, y in self.kwargs.items() if x in parameters})
+        if "schemes" in self.kwargs and "schemes" not in parameters:
+            spec = json.loads(content)
+            spec["schemes"] = list(self.kwargs["schemes"])
+            content = json.dumps(spec)
+        return content
+
+    def get(self):
+        """ Return spec JSON text, loading it from cache file or generating it the first time """
+
+        if self.content is not None:
+            return self.content
+
+        started = time.monotonic()
+        source_hash = self.source_hash()
+        content = self.load(source_hash)
+        origin = "loaded from %s" % self.path
+        if content is None:
+            content = self.generate()
+            self.save(source_hash, content)
+            origin = "generated from handlers docstrings"
+        self.content = content
+        self.logger.info("Swagger spec %s in %.1f ms", origin, (time.monotonic() - started) * 1000)
+        return self.content
+
+    def handler(self, _):
+        """ Replace aiohttp_swagger definition handler by one serving lazily built spec """
+
+        async def swagger_def(_):
+            return aiohttp.web.json_response(text=self.get())
+
+        return swagger_def
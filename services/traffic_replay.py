@@ -0,0 +1,245 @@
+"""
+Record provider traffic seen by SnctAppointmentScrapper and replay it from a local stand-in
+Used to reproduce and benchmark a refresh pipeline offline, see replay_benchmark.py
+"""
+
+
+# pylint: disable=line-too-long
+
+
+import re
+import gzip
+import time
+import bisect
+import asyncio
+import logging
+import datetime
+import urllib.parse
+import aiohttp.web
+import json_codec
+
+from .clock import SystemClock, VirtualClock
+
+
+CAPTURE_VERSION = 1
+
+# Dates in URLs change every day, captures are matched without them
+DATE_RE = re.compile(r"\d{4}-\d{2}-\d{2}")
+
+
+def path_qs(url):
+    """ Return path and query of an URL, captures do not depend on provider host """
+
+    parts = urllib.parse.urlsplit(url)
+    return parts.path + ("?" + parts.query if parts.query else "")
+
+
+def capture_key(url):
+    """ Return URL path and query with dates removed """
+
+    return DATE_RE.sub("*", path_qs(url))
+
+
+class TrafficRecorder:
+    """
+    Write every response seen by scrapper to a gzipped NDJSON capture
+
+      * first line is a header holding capture start as an UTC ISO datetime
+      * other lines are {"t": seconds since start when request was sent, "url": path and query, "status", "type": content type, "elapsed": seconds, "body": text}
+      * status is null and body holds exception class name when request failed without response
+      * body is null when identical to previous body of same URL, which is the case of most of them
+    Lines are buffered and written flush_size at a time from an executor
+    """
+
+    def __init__(self, path, clock=None, flush_size=200):
+
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.path = path
+        self.clock = clock if clock is not None else SystemClock()
+        self.flush_size = flush_size
+        self.started_at = self.clock.monotonic()
+        self.buffer = [json_codec.dumps_bytes({"version": CAPTURE_VERSION, "started_at": self.clock.now(datetime.timezone.utc).isoformat()})]
+        self.last_bodies = {}
+        self.created = False
+        self.count = 0
+        self.lock = asyncio.Lock()
+
+    def wrap(self, session):
+        """ Return a session recording responses of given aiohttp.ClientSession """
+        return RecordingSession(session, self)
+
+    async def record(self, url, status, content_type, body, elapsed, sent_at=None):
+        """
+        Buffer a capture line, body being text
+        sent_at is clock time the request was sent, replays look captures up by request time and pacing
+        on a virtual clock may move it between request and response
+        """
+
+        url = path_qs(url)
+        if status is not None and self.last_bodies.get(url, None) == body:
+            stored_body = None
+        else:
+            stored_body = body
+            self.last_bodies[url] = body
+
+        if sent_at is None:
+            sent_at = self.clock.monotonic()
+        line = {"t": round(sent_at - self.started_at, 3), "url": url, "status": status, "type": content_type, "elapsed": round(elapsed, 4), "body": stored_body}
+        self.buffer.append(json_codec.dumps_bytes(line))
+        self.count += 1
+        if len(self.buffer) >= self.flush_size:
+            await self.flush()
+
+    def _write(self, lines):
+        """ Append lines to capture, creating it on first call """
+
+        with gzip.open(self.path, "ab" if self.created else "wb") as fileobj:
+            fileobj.write(b"".join(x + b"\n" for x in lines))
+        self.created = True
+
+    async def flush(self):
+        """ Write buffered lines """
+
+        async with self.lock:
+            lines, self.buffer = self.buffer, []
+            if lines:
+                await asyncio.get_event_loop().run_in_executor(None, self._write, lines)
+
+    async def close(self):
+        """ Write remaining lines """
+
+        await self.flush()
+        self.logger.info("%d responses recorded to %s", self.count, self.path)
+
+
+class RecordingSession:
+    """ Wrap an aiohttp.ClientSession, responses bodies are read at once and recorded """
+
+    def __init__(self, session, recorder):
+        self.session = session
+        self.recorder = recorder
+
+    async def get(self, url, **kwargs):
+        """ Perform and record a GET request """
+
+        sent_at = self.recorder.clock.monotonic()
+        started = time.perf_counter()
+        try:
+            resp = await self.session.get(url, **kwargs)
+            body = await resp.read()
+        except Exception as exc:
+            await self.recorder.record(url, None, None, exc.__class__.__name__, time.perf_counter() - started, sent_at=sent_at)
+            raise
+        await self.recorder.record(url, resp.status, resp.content_type, body.decode("utf-8", "replace"), time.perf_counter() - started, sent_at=sent_at)
+        return resp
+
+    async def close(self):
+        """ Close session and flush recorder """
+
+        await self.session.close()
+        await self.recorder.close()
+
+
+def read_capture(path):
+    """ Return (header, records) of a capture, records bodies being filled back """
+
+    with gzip.open(path, "rb") as fileobj:
+        lines = [json_codec.loads(x) for x in fileobj if x.strip()]
+    assert lines and lines[0].get("version", None) == CAPTURE_VERSION, "%s is not a version %d traffic capture" % (path, CAPTURE_VERSION)
+
+    header, records = lines[0], lines[1:]
+    last_bodies = {}
+    for record in records:
+        if record["status"] is not None and record["body"] is None:
+            record["body"] = last_bodies[record["url"]]
+        last_bodies[record["url"]] = record["body"]
+    return header, records
+
+
+def capture_start(header):
+    """ Return capture start as an aware datetime """
+
+    return datetime.datetime.strptime(header["started_at"][:19], "%Y-%m-%dT%H:%M:%S").replace(tzinfo=datetime.timezone.utc)
+
+
+class ReplayServer:
+    """
+    Local aiohttp stand-in serving a capture, point a provider URL to its url attribute
+
+      * a request gets the last capture of its URL recorded at or before current clock offset, the first one if none yet
+      * clock offset wraps around capture period (duration plus usual gap between two captures of an URL)
+        so a short capture can feed a long replay
+      * dates are ignored when matching URLs, so captures keep being served after virtual day changes
+      * unknown URLs get 404, captured failures 504, recorded latency is reproduced times latency_scale
+    """
+
+    def __init__(self, path, clock=None, latency_scale=0.0):
+
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.latency_scale = latency_scale
+        self.header, records = read_capture(path)
+        # Clock of replayed scrapper, defaults to a virtual one starting when capture started
+        self.clock = clock if clock is not None else VirtualClock(start=capture_start(self.header))
+        self.duration = records[-1]["t"] if records else 0
+
+        # {capture_key: ([offsets], [records])}
+        self.captures = {}
+        for record in records:
+            offsets, url_records = self.captures.setdefault(capture_key(record["url"]), ([], []))
+            offsets.append(record["t"])
+            url_records.append(record)
+
+        gaps = sorted(y - x for offsets, _ in self.captures.values() for x, y in zip(offsets, offsets[1:]) if y > x)
+        self.period = self.duration + (gaps[len(gaps) // 2] if gaps else 1)
+
+        self.started_at = None
+        self.runner = None
+        self.url = None
+        self.served = 0
+        self.missed = 0
+        self.logger.info("%d responses to %d URLs loaded from %s, lasting %.0fs", len(records), len(self.captures), path, self.duration)
+
+    def lookup(self, url, offset):
+        """ Return capture to serve for given URL at given offset, None if unknown """
+
+        try:
+            offsets, records = self.captures[capture_key(url)]
+        except KeyError:
+            return None
+        offset = offset % self.period
+        return records[max(0, bisect.bisect_right(offsets, offset) - 1)]
+
+    async def handle(self, request):
+        """ Serve a captured response """
+
+        record = self.lookup(request.path_qs, self.clock.monotonic() - self.started_at)
+        if record is None:
+            self.missed += 1
+            return aiohttp.web.Response(status=404)
+
+        self.served += 1
+        if self.latency_scale > 0:
+            await asyncio.sleep(record["elapsed"] * self.latency_scale)
+        if record["status"] is None:
+            return aiohttp.web.Response(status=504, text=record["body"])
+        return aiohttp.web.Response(status=record["status"], text=record["body"], content_type=record["type"])
+
+    async def start_server(self, host="127.0.0.1", port=0):
+        """ Listen on given address, a random port by default """
+
+        app = aiohttp.web.Application()
+        app.router.add_route("GET", "/{tail:.*}", self.handle)
+        self.runner = aiohttp.web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = aiohttp.web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]  # pylint: disable=protected-access
+        self.url = "http://%s:%d" % (host, port)
+        self.started_at = self.clock.monotonic()
+        self.logger.info("Replaying capture on %s", self.url)
+
+    async def close(self):
+        """ Stop serving """
+
+        if self.runner is not None:
+            await self.runner.cleanup()
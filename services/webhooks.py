@@ -0,0 +1,334 @@
+"""
+Deliver appointments updates to webhooks, for subscribers not holding a WebSocket open
+Subscriptions are persisted in a JSON file, deliveries are batched per endpoint and retried with backoff
+"""
+
+
+# pylint: disable=line-too-long
+
+
+import os
+import uuid
+import socket
+import tempfile
+import ipaddress
+import random
+import asyncio
+import logging
+import datetime
+import collections
+import aiohttp
+import aiohttp.abc
+import aiohttp.resolver
+import yarl
+import json_codec
+
+
+def is_public_address(address):
+    """ Return True if IP address is globally routable, False for loopback, link-local, private and reserved ones """
+
+    address = ipaddress.ip_address(address.split("%", 1)[0])
+    if isinstance(address, ipaddress.IPv6Address) and address.ipv4_mapped is not None:
+        address = address.ipv4_mapped
+    return address.is_global
+
+
+def is_non_public_literal(host):
+    """ Return True if host is an IP address (never passed to resolver) which is not public """
+
+    try:
+        return not is_public_address(host)
+    except ValueError:
+        return False
+
+
+class PublicResolver(aiohttp.abc.AbstractResolver):
+    """ Resolver refusing hosts having a non public address, so webhooks cannot reach internal services """
+
+    def __init__(self):
+        self.resolver = aiohttp.resolver.DefaultResolver()
+
+    async def resolve(self, host, port=0, family=socket.AF_INET):
+        hosts = await self.resolver.resolve(host, port, family)
+        if not all(is_public_address(x["host"]) for x in hosts):
+            raise OSError("%s resolves to a non public address" % host)
+        return hosts
+
+    async def close(self):
+        await self.resolver.close()
+
+
+class WebhookSubscription:
+    """
+    A webhook registered to AppointmentDispatcher as a client
+    Updates are only queued here, network happens in WebhookDelivery workers
+    """
+
+    def __init__(self, delivery, url, criterias, webhook_id=None):
+        self.delivery = delivery
+        self.url = url
+        self.criterias = criterias
+        self.id = webhook_id if webhook_id is not None else uuid.uuid4().hex  # pylint: disable=invalid-name
+
+    def queue_appointments(self, added=None, removed=None, seq=None):
+        """ Called by AppointmentDispatcher when appointments match criterias """
+
+        self.delivery.enqueue(self, added or [], removed or [], seq)
+
+    def to_dict(self):
+        """ Return JSON serializable representation, also used for persistence """
+
+        return {"id": self.id, "url": self.url, "criterias": self.criterias}
+
+
+class WebhookDelivery:  # pylint: disable=too-many-instance-attributes
+    """
+    Own webhooks subscriptions and deliver their updates
+
+      * all updates of a cycle going to the same URL are sent in a single POST
+      * at most concurrency POST are in flight, using a pooled session
+      * failed deliveries are retried with exponential backoff up to max_attempts times
+      * endpoints answering 410 Gone are unsubscribed
+      * unless allow_private is set, URLs whose host has a loopback, link-local or private address are refused,
+        both when subscribing and when connecting
+    """
+
+    def __init__(self, dispatcher, path=None, concurrency=20, timeout=10, max_attempts=5, retry_delay=5.0, max_retry_delay=300.0, max_queue=10000, max_subscriptions=1000, max_criterias=100, allow_private=False):  # pylint: disable=too-many-arguments
+
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.dispatcher = dispatcher
+        self.path = path
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.max_subscriptions = max_subscriptions
+        self.max_criterias = max_criterias
+        self.allow_private = allow_private
+
+        self.subscriptions = {}
+        # {url: [delivery dict, ...]} waiting for end of current cycle
+        self.pending = collections.OrderedDict()
+        self.flush_handle = None
+        # (url, deliveries, attempt) tuples ready to be sent
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.retry_handles = set()
+        self.workers = []
+        self.session = None
+        # Saves are serialized, each one writing subscriptions as they are when it gets the lock
+        self.save_lock = asyncio.Lock()
+
+    async def start(self):
+        """ Load persisted subscriptions and start delivery workers """
+
+        resolver = None if self.allow_private else PublicResolver()
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.concurrency, resolver=resolver))
+        for item in await self.load():
+            self.register(WebhookSubscription(self, item["url"], item["criterias"], webhook_id=item["id"]))
+        self.workers = [asyncio.ensure_future(self.deliver_forever()) for _ in range(self.concurrency)]
+        self.logger.info("%d webhooks loaded, delivering with %d workers", len(self.subscriptions), self.concurrency)
+
+    async def close(self):
+        """ Stop workers and retries, pending deliveries are lost """
+
+        for worker in self.workers:
+            worker.cancel()
+        for handle in self.retry_handles:
+            handle.cancel()
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+        if self.session is not None:
+            await self.session.close()
+
+    @staticmethod
+    def parse_criterias(criterias):
+        """ Turn start_dt and end_dt of persisted criterias back into datetime """
+
+        for criteria in criterias:
+            for field in ["start_dt", "end_dt"]:
+                criteria[field] = datetime.datetime.strptime(criteria[field][:19], "%Y-%m-%dT%H:%M:%S")
+        return criterias
+
+    def _read(self):
+        """ Read persisted subscriptions file """
+
+        if self.path is None or not os.path.exists(self.path):
+            return []
+        with open(self.path, "rb") as fileobj:
+            return json_codec.loads(fileobj.read())
+
+    async def load(self):
+        """ Return list of persisted subscriptions with parsed criterias """
+
+        items = await asyncio.get_event_loop().run_in_executor(None, self._read)
+        for item in items:
+            self.parse_criterias(item["criterias"])
+        return items
+
+    def _write(self, data):
+        """ Atomically replace persisted subscriptions file, through a temporary file of its own """
+
+        tmp_path = None
+        try:
+            with tempfile.NamedTemporaryFile("wb", dir=os.path.dirname(os.path.abspath(self.path)), prefix=".webhooks-", suffix=".tmp", delete=False) as fileobj:
+                tmp_path = fileobj.name
+                fileobj.write(data)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+    async def save(self):
+        """ Persist subscriptions, if a file has been configured, raise OSError if writing failed """
+
+        if self.path is None:
+            return
+        async with self.save_lock:
+            data = json_codec.dumps_bytes([x.to_dict() for x in self.subscriptions.values()])
+            await asyncio.get_event_loop().run_in_executor(None, self._write, data)
+
+    def register(self, subscription):
+        """ Register subscription to dispatcher """
+
+        self.subscriptions[subscription.id] = subscription
+        self.dispatcher.register_webhook_client(subscription, subscription.criterias)
+
+    def unregister(self, subscription):
+        """ Forget subscription and unregister it from dispatcher """
+
+        self.subscriptions.pop(subscription.id, None)
+        self.dispatcher.unregister_webhook_client(subscription)
+
+    async def check_url(self, url):
+        """ Assert url is an http or https URL allowed to receive deliveries """
+
+        assert isinstance(url, str) and url.startswith(("http://", "https://")), "url must be an http or https URL"
+        try:
+            host = yarl.URL(url).host
+        except ValueError:
+            host = None
+        assert host, "url must have a host"
+        if self.allow_private:
+            return
+        try:
+            infos = await asyncio.get_event_loop().getaddrinfo(host, None, proto=socket.IPPROTO_TCP)
+        except (OSError, UnicodeError):
+            raise AssertionError("url host %s cannot be resolved" % host)
+        assert infos and all(is_public_address(x[4][0]) for x in infos), "url host must not have a loopback, link-local or private address"
+
+    async def add(self, url, criterias):
+        """ Create and persist a new webhook subscription, url and criterias must already be validated """
+
+        assert len(self.subscriptions) < self.max_subscriptions, "maximum number of webhooks (%d) reached" % self.max_subscriptions
+        subscription = WebhookSubscription(self, url, criterias)
+        self.register(subscription)
+        try:
+            await self.save()
+        except OSError as exc:
+            self.logger.error("Unable to persist webhook %s for %s, not subscribing it: %s: %s", subscription.id, url, exc.__class__.__name__, exc)
+            self.unregister(subscription)
+            raise
+        self.logger.info("Webhook %s subscribed for %s", subscription.id, url)
+        return subscription
+
+    async def remove(self, webhook_id):
+        """ Unsubscribe and forget a webhook, return False if unknown """
+
+        subscription = self.subscriptions.get(webhook_id, None)
+        if subscription is None:
+            return False
+        self.unregister(subscription)
+        try:
+            await self.save()
+        except OSError as exc:
+            self.logger.error("Unable to persist removal of webhook %s for %s, keeping it: %s: %s", subscription.id, subscription.url, exc.__class__.__name__, exc)
+            self.register(subscription)
+            raise
+        self.logger.info("Webhook %s for %s unsubscribed", subscription.id, subscription.url)
+        return True
+
+    def enqueue(self, subscription, added, removed, seq):
+        """ Add update to current cycle batch of subscription URL, batches are flushed once dispatcher is done publishing """
+
+        self.pending.setdefault(subscription.url, []).append({"id": subscription.id, "seq": seq, "added": added, "removed": removed})
+        if self.flush_handle is None:
+            self.flush_handle = asyncio.get_event_loop().call_soon(self.flush)
+
+    def flush(self):
+        """ Move batches of the cycle to delivery queue """
+
+        self.flush_handle = None
+        pending, self.pending = self.pending, collections.OrderedDict()
+        for url, deliveries in pending.items():
+            self.put(url, deliveries, 1)
+
+    def put(self, url, deliveries, attempt):
+        """ Queue a batch for delivery, dropping it if queue is full """
+
+        try:
+            self.queue.put_nowait((url, deliveries, attempt))
+        except asyncio.QueueFull:
+            self.logger.warning("Webhook delivery queue is full, dropping %d updates for %s", len(deliveries), url)
+
+    def retry(self, url, deliveries, attempt):
+        """ Schedule another delivery attempt with exponential backoff and jitter """
+
+        if attempt >= self.max_attempts:
+            self.logger.warning("Giving up delivering %d updates to %s after %d attempts", len(deliveries), url, attempt)
+            return
+
+        delay = min(self.retry_delay * 2 ** (attempt - 1), self.max_retry_delay) * random.uniform(0.8, 1.2)
+
+        def requeue():
+            """ Timer callback """
+            self.retry_handles.discard(handle)
+            self.put(url, deliveries, attempt + 1)
+
+        handle = asyncio.get_event_loop().call_later(delay, requeue)
+        self.retry_handles.add(handle)
+        self.logger.info("Retrying delivery of %d updates to %s in %.1fs", len(deliveries), url, delay)
+
+    async def deliver(self, url, deliveries, attempt):
+        """ POST a batch, return True if it has been delivered or must not be retried """
+
+        if not self.allow_private and is_non_public_literal(yarl.URL(url).host):
+            self.logger.warning("Not delivering %d updates to non public address %s", len(deliveries), url)
+            return True
+
+        body = json_codec.dumps_bytes({"stream_id": self.dispatcher.stream_id, "deliveries": deliveries})
+        try:
+            resp = await self.session.post(url, data=body, headers={"Content-Type": "application/json"}, timeout=self.timeout)
+            await resp.release()
+        except (asyncio.TimeoutError, aiohttp.ClientError) as exc:
+            self.logger.warning("Delivery attempt %d to %s failed: %s: %s", attempt, url, exc.__class__.__name__, exc)
+            return False
+
+        if resp.status == 410:
+            self.logger.info("%s answered 410 Gone, unsubscribing its webhooks", url)
+            for webhook_id in [x.id for x in self.subscriptions.values() if x.url == url]:
+                await self.remove(webhook_id)
+            return True
+        if 200 <= resp.status < 300:
+            self.logger.debug("Delivered %d updates to %s", len(deliveries), url)
+            return True
+        if 400 <= resp.status < 500 and resp.status not in [408, 429]:
+            self.logger.warning("%s answered %d, dropping %d updates", url, resp.status, len(deliveries))
+            return True
+        self.logger.warning("Delivery attempt %d to %s failed with status %d", attempt, url, resp.status)
+        return False
+
+    async def deliver_forever(self):
+        """ Worker sending queued batches, one at a time """
+
+        while True:
+            url, deliveries, attempt = await self.queue.get()
+            try:
+                if not await self.deliver(url, deliveries, attempt):
+                    self.retry(url, deliveries, attempt)
+            except asyncio.CancelledError:  # pylint: disable=try-except-raise
+                raise
+            except Exception as exc:  # pylint: disable=broad-except
+                self.logger.exception("Unexpected error delivering to %s: %s: %s", url, exc.__class__.__name__, exc)
@@ -0,0 +1 @@
+""" Tests of self-contained services, run with python -m pytest tests from repository root """
@@ -0,0 +1,128 @@
+"""
+HashRing membership moves and ShardCoordinator partitioning between ShardNode scrappers backed by fake providers
+"""
+
+
+# pylint: disable=line-too-long,redefined-outer-name
+
+
+import pytest
+
+from services.appointment_dispatcher import AppointmentDispatcher
+from services.providers import FakeProvider
+from services.sharding import HashRing, ShardCoordinator, ShardCoordinatorServer, ShardNode, LocalCoordinatorClient, UnixCoordinatorClient
+
+
+SITES = ["site%02d" % x for x in range(10)]
+KEYS = [("PRIVATE", "REGULAR%d" % x, "car", ("fake", SITES[x % len(SITES)])) for x in range(500)]
+
+
+def owners(ring):
+    """ Return {key: node} for all test keys """
+
+    return {x: ring.node_for(x) for x in KEYS}
+
+
+def test_ring_is_deterministic():
+    assert owners(HashRing(["a", "b", "c"])) == owners(HashRing(["c", "a", "b"]))
+    assert set(owners(HashRing(["a", "b", "c"])).values()) == {"a", "b", "c"}
+    assert HashRing().node_for(KEYS[0]) is None
+
+
+def test_joining_node_only_takes_keys():
+    ring = HashRing(["a", "b", "c"])
+    before = owners(ring)
+    ring.add("d")
+    after = owners(ring)
+    moved = [x for x in KEYS if before[x] != after[x]]
+    assert moved and all(after[x] == "d" for x in moved)
+
+
+def test_leaving_node_only_gives_its_keys():
+    ring = HashRing(["a", "b", "c"])
+    before = owners(ring)
+    ring.remove("b")
+    after = owners(ring)
+    assert [x for x in KEYS if before[x] != after[x]] == [x for x in KEYS if before[x] == "b"]
+    assert "b" not in after.values()
+
+
+@pytest.fixture
+def cluster(run, tmp_path):
+    """ Return a function starting a coordinator and three nodes, in process or through a Unix socket, all closed on teardown """
+
+    started = []
+
+    async def start(unix=False):
+        dispatcher = AppointmentDispatcher()
+        coordinator = ShardCoordinator(dispatcher)
+        server = None
+        if unix:
+            server = ShardCoordinatorServer(coordinator, str(tmp_path / "shard.sock"))
+            await server.start()
+        nodes = []
+        for idx in range(3):
+            client = UnixCoordinatorClient(server.path) if unix else LocalCoordinatorClient(coordinator)
+            nodes.append(ShardNode(client, node_id="node%d" % idx, providers=[FakeProvider(sites=SITES, seed=idx)]))
+        for node in nodes:
+            await node.start()
+        started.append((server, nodes))
+        return coordinator, nodes
+
+    yield lambda unix=False: run(start(unix))
+
+    async def close():
+        for server, nodes in started:
+            for node in nodes:
+                if not node.scrapper.closed:
+                    await node.close()
+            if server is not None:
+                await server.close()
+
+    run(close())
+
+
+@pytest.mark.parametrize("unix", [False, True])
+def test_nodes_partition_keys_and_leaver_keys_move(run, cluster, unix):
+    coordinator, nodes = cluster(unix)
+
+    async def cycle():
+        for node in nodes:
+            await node.scrapper.refresh_appointments()
+
+    run(cycle())
+    shards = {x.node_id: set(x.scrapper.appointment_keys()) for x in nodes}
+    all_keys = set(nodes[0].scrapper.query_plan())
+    assert all(shards.values())
+    assert set.union(*shards.values()) == all_keys
+    assert sum(len(x) for x in shards.values()) == len(all_keys)
+
+    async def leave():
+        await nodes[2].close()
+        for node in nodes[:2]:
+            await node.publish()
+
+    run(leave())
+    assert coordinator.members() == ["node0", "node1"]
+    moved = {x.node_id: set(x.scrapper.appointment_keys()) - shards[x.node_id] for x in nodes[:2]}
+    assert set.union(*moved.values()) == shards["node2"]
+    assert all(shards[x.node_id] <= set(x.scrapper.appointment_keys()) for x in nodes[:2])
+    assert coordinator.dispatcher.key_versions and set(coordinator.dispatcher.key_versions) <= all_keys
+
+
+def test_refresh_reaches_owner_once(run, cluster):
+    coordinator, nodes = cluster()
+    requested = {x.node_id: [] for x in nodes}
+    for node in nodes:
+        node.scrapper.request_refresh = requested[node.node_id].extend
+    key = sorted(nodes[1].scrapper.appointment_keys())[0]
+
+    async def heartbeats():
+        coordinator.dispatcher.refresh_requester([key])
+        for _ in range(2):
+            for node in nodes:
+                node.update(await node.client.request({"op": "heartbeat", "node_id": node.node_id}))
+
+    coordinator.dispatcher.refresh_requester = coordinator.request_refresh
+    run(heartbeats())
+    assert requested == {"node0": [], "node1": [key], "node2": []}
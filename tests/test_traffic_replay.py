@@ -0,0 +1,162 @@
+"""
+VirtualClock ordering, capture round trip and ReplayServer lookup, plus a recorded then replayed SNCT stand-in
+"""
+
+
+# pylint: disable=line-too-long,redefined-outer-name
+
+
+import asyncio
+import datetime
+import aiohttp.web
+import pytest
+
+from services.clock import VirtualClock
+from services.providers import SnctProvider, FakeProvider
+from services.snct_appointment_scrapper import SnctAppointmentScrapper
+from services.traffic_replay import TrafficRecorder, ReplayServer, read_capture, capture_start
+
+
+START = datetime.datetime(2030, 1, 1, 8, tzinfo=datetime.timezone.utc)
+
+
+def test_virtual_clock_only_moves_when_slept_on(run):
+    clock = VirtualClock(START)
+    seen = []
+
+    async def watcher():
+        for _ in range(3):
+            seen.append(clock.monotonic())
+            await asyncio.sleep(0)
+
+    async def sleeper():
+        for seconds in [60, 30]:
+            await clock.sleep(seconds)
+
+    async def scenario():
+        await asyncio.gather(watcher(), sleeper())
+        clock.advance(10)
+
+    run(scenario())
+    assert seen == [0, 60, 90]
+    assert clock.monotonic() == 100
+    assert clock.now(datetime.timezone.utc) == START + datetime.timedelta(seconds=100)
+    assert clock.now().tzinfo is None
+    with pytest.raises(AssertionError):
+        clock.advance(-1)
+    with pytest.raises(AssertionError):
+        VirtualClock(datetime.datetime(2030, 1, 1))
+
+
+@pytest.fixture
+def capture(run, tmp_path):
+    """ Record responses of two URLs under a virtual clock, return capture path """
+
+    path = str(tmp_path / "capture.ndjson.gz")
+    clock = VirtualClock(START)
+
+    async def record():
+        recorder = TrafficRecorder(path, clock=clock, flush_size=2)
+        for body in ["a", "a", "b"]:
+            await recorder.record("http://snct/list?from=2030-01-01", 200, "application/json", body, 0.1)
+            await recorder.record("http://snct/other", 200, "application/json", "x", 0.1)
+            await clock.sleep(60)
+        await recorder.record("http://snct/list?from=2030-01-04", None, None, "TimeoutError", 5)
+        await recorder.close()
+
+    run(record())
+    return path
+
+
+def test_capture_round_trip(capture):
+    header, records = read_capture(capture)
+    assert capture_start(header) == START
+    assert [(x["t"], x["url"], x["status"], x["body"]) for x in records] == [
+        (0, "/list?from=2030-01-01", 200, "a"), (0, "/other", 200, "x"),
+        (60, "/list?from=2030-01-01", 200, "a"), (60, "/other", 200, "x"),
+        (120, "/list?from=2030-01-01", 200, "b"), (120, "/other", 200, "x"),
+        (180, "/list?from=2030-01-04", None, "TimeoutError"),
+    ]
+
+
+def test_replay_lookup_follows_clock_and_ignores_dates(capture):
+    server = ReplayServer(capture)
+    assert server.clock.now(datetime.timezone.utc) == START
+    assert server.period == 240
+    assert server.lookup("/list?from=2031-05-05", 0)["body"] == "a"
+    assert server.lookup("/list?from=2031-05-05", 119)["body"] == "a"
+    assert server.lookup("/list?from=2031-05-05", 120)["body"] == "b"
+    assert server.lookup("/list?from=2031-05-05", 180)["status"] is None
+    assert server.lookup("/list?from=2031-05-05", 240 + 130)["body"] == "b"
+    assert server.lookup("/list?from=2031-05-05", 240 + 10)["body"] == "a"
+    assert server.lookup("/unknown", 0) is None
+
+
+async def serve_fake_snct():
+    """ Serve FakeProvider appointments with SNCT routes and payloads, return runner and URL """
+
+    fake = FakeProvider(seed=0)
+
+    async def sites(_):
+        return aiohttp.web.json_response([{"id": idx, "name": x} for idx, x in enumerate(fake.sites, start=1)])
+
+    async def vehicles(_):
+        return aiohttp.web.json_response([{"id": idx, "name": x} for idx, x in enumerate(fake.vehicles, start=1)])
+
+    async def appointments(request):
+        info = request.match_info
+        key = (info["request_type"], info["control_type"], fake.vehicles[int(info["vehicle_type"]) - 1], ("fake", fake.sites[int(info["site_id"]) - 1]))
+        payload, exc = await fake.fetch_appointments(key, (info["start_dt"], info["end_dt"]))
+        if exc is not None:
+            return aiohttp.web.json_response({"code": "1", "type": "TECHNICAL"}, status=400)
+        return aiohttp.web.json_response(payload)
+
+    app = aiohttp.web.Application()
+    app.router.add_route("GET", "/rdvct/secure/admin/site/list", sites)
+    app.router.add_route("GET", "/rdvct/secure/admin/vehicle/type/list", vehicles)
+    app.router.add_route("GET", "/rdvct/appointment/betweenDates/{start_dt}/{end_dt}/{vehicle_type}/{site_id}/{request_type}/{control_type}", appointments)
+    runner = aiohttp.web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = aiohttp.web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    return runner, "http://127.0.0.1:%d" % site._server.sockets[0].getsockname()[1]  # pylint: disable=protected-access
+
+
+async def run_cycles(url, clock, cycles, recorder=None):
+    """ Run refresh cycles against given URL, return appointments counts of each cycle """
+
+    counts = []
+
+    def count_appointments(payload):
+        counts.append(sum(len(z or []) for w in payload.values() for x in w.values() for y in x.values() for z in y.values()))
+
+    scrapper = SnctAppointmentScrapper(appointment_handler=count_appointments, providers=[SnctProvider(url=url)], clock=clock, recorder=recorder)
+    await scrapper.refresh_sites()
+    await scrapper.refresh_vehicles()
+    for _ in range(cycles):
+        await scrapper.refresh_appointments()
+        await clock.sleep(scrapper.refresh_interval)
+    await scrapper.close()
+    return counts
+
+
+def test_replay_reproduces_recording(run, tmp_path):
+    path = str(tmp_path / "capture.ndjson.gz")
+
+    async def scenario():
+        runner, url = await serve_fake_snct()
+        clock = VirtualClock(START)
+        recorded = await run_cycles(url, clock, 10, recorder=TrafficRecorder(path, clock=clock))
+        await runner.cleanup()
+
+        server = ReplayServer(path)
+        await server.start_server()
+        replayed = await run_cycles(server.url, server.clock, 20)
+        await server.close()
+        return recorded, replayed, server
+
+    recorded, replayed, server = run(scenario())
+    assert len(recorded) == 10 and any(recorded)
+    assert replayed[:10] == recorded
+    assert len(replayed) == 20
+    assert server.served > 0 and server.missed == 0
@@ -0,0 +1,214 @@
+"""
+WebhookDelivery batching, retries, unsubscription, persistence and URL restrictions, against a stub HTTP session
+"""
+
+
+# pylint: disable=line-too-long,redefined-outer-name
+
+
+import os
+import json
+import asyncio
+import datetime
+import pytest
+
+from services.appointment_dispatcher import AppointmentDispatcher
+from services.webhooks import WebhookDelivery, is_public_address
+
+
+CRITERIA = {"user_type": "PRIVATE", "control_type": "REGULAR", "vehicle_type": "car", "organism": "snct", "site": "sandweiler", "start_dt": datetime.datetime(2000, 1, 1), "end_dt": datetime.datetime(2100, 1, 1)}
+APPOINTMENT = {"user_type": "PRIVATE", "control_type": "REGULAR", "vehicle_type": "car", "organism": "snct", "site": "sandweiler", "timestamp": datetime.datetime(2030, 1, 1, 8)}
+
+
+class StubResponse:  # pylint: disable=too-few-public-methods
+    """ Response of StubSession """
+
+    def __init__(self, status):
+        self.status = status
+
+    async def release(self):
+        """ Nothing to release """
+
+
+class StubSession:
+    """ Record POSTed batches and answer with given statuses, last one being repeated """
+
+    def __init__(self, statuses):
+        self.statuses = list(statuses)
+        self.calls = []
+
+    async def post(self, url, data=None, headers=None, timeout=None):  # pylint: disable=unused-argument
+        """ Record a delivery """
+        self.calls.append((url, json.loads(data)))
+        status = self.statuses.pop(0) if len(self.statuses) > 1 else self.statuses[0]
+        return StubResponse(status)
+
+    async def close(self):
+        """ Nothing to close """
+
+
+@pytest.fixture
+def delivery_factory():
+    """ Return a function creating a WebhookDelivery delivering through a StubSession with one worker """
+
+    deliveries = []
+
+    def factory(statuses=(204,), **kwargs):
+        delivery = WebhookDelivery(AppointmentDispatcher(), retry_delay=0.01, max_retry_delay=0.05, **kwargs)
+        delivery.session = StubSession(statuses)
+        delivery.workers = [asyncio.ensure_future(delivery.deliver_forever())]
+        deliveries.append(delivery)
+        return delivery
+
+    yield factory
+    for delivery in deliveries:
+        for worker in delivery.workers:
+            worker.cancel()
+
+
+async def settle(delivery, seconds=0.3):
+    """ Let workers and retries run """
+
+    await asyncio.sleep(seconds)
+    return delivery.session.calls
+
+
+def test_updates_of_a_cycle_are_batched_per_url(run, delivery_factory):
+    async def scenario():
+        delivery = delivery_factory()
+        first = await delivery.add("https://example.com/hook", [dict(CRITERIA)])
+        second = await delivery.add("https://example.com/hook", [dict(CRITERIA)])
+        await delivery.add("https://example.org/hook", [dict(CRITERIA, site="other")])
+        delivery.dispatcher.publish_delta([APPOINTMENT], [])
+        return first, second, await settle(delivery)
+
+    first, second, calls = run(scenario())
+    assert len(calls) == 1
+    url, body = calls[0]
+    assert url == "https://example.com/hook"
+    assert sorted(x["id"] for x in body["deliveries"]) == sorted([first.id, second.id])
+    assert all(x["seq"] == 1 and len(x["added"]) == 1 and x["removed"] == [] for x in body["deliveries"])
+
+
+def test_failed_delivery_is_retried_with_same_batch(run, delivery_factory):
+    async def scenario():
+        delivery = delivery_factory(statuses=(503, 429, 204))
+        await delivery.add("https://example.com/hook", [dict(CRITERIA)])
+        delivery.dispatcher.publish_delta([APPOINTMENT], [])
+        return await settle(delivery)
+
+    calls = run(scenario())
+    assert len(calls) == 3
+    assert calls[0] == calls[1] == calls[2]
+
+
+def test_delivery_gives_up_after_max_attempts(run, delivery_factory):
+    async def scenario():
+        delivery = delivery_factory(statuses=(500,), max_attempts=3)
+        await delivery.add("https://example.com/hook", [dict(CRITERIA)])
+        delivery.dispatcher.publish_delta([APPOINTMENT], [])
+        return await settle(delivery, 0.5)
+
+    assert len(run(scenario())) == 3
+
+
+def test_client_errors_are_not_retried(run, delivery_factory):
+    async def scenario():
+        delivery = delivery_factory(statuses=(400,))
+        await delivery.add("https://example.com/hook", [dict(CRITERIA)])
+        delivery.dispatcher.publish_delta([APPOINTMENT], [])
+        return await settle(delivery)
+
+    assert len(run(scenario())) == 1
+
+
+def test_gone_unsubscribes_all_webhooks_of_url(run, delivery_factory):
+    async def scenario():
+        delivery = delivery_factory(statuses=(410,))
+        await delivery.add("https://example.com/hook", [dict(CRITERIA)])
+        await delivery.add("https://example.com/hook", [dict(CRITERIA)])
+        kept = await delivery.add("https://example.org/hook", [dict(CRITERIA, site="other")])
+        delivery.dispatcher.publish_delta([APPOINTMENT], [])
+        await settle(delivery)
+        return delivery, kept
+
+    delivery, kept = run(scenario())
+    assert list(delivery.subscriptions) == [kept.id]
+    assert list(delivery.dispatcher.webhook_clients) == [kept]
+
+
+def test_concurrent_saves_leave_a_valid_file(run, tmp_path, delivery_factory):
+    path = str(tmp_path / "webhooks.json")
+
+    async def scenario():
+        delivery = delivery_factory(path=path)
+        added = await asyncio.gather(*[delivery.add("https://example.com/%d" % x, [dict(CRITERIA)]) for x in range(20)])
+        await asyncio.gather(*[delivery.remove(x.id) for x in added[:5]])
+        return delivery
+
+    delivery = run(scenario())
+    with open(path, "r") as fileobj:
+        persisted = json.load(fileobj)
+    assert sorted(x["id"] for x in persisted) == sorted(delivery.subscriptions)
+    assert os.listdir(str(tmp_path)) == ["webhooks.json"]
+
+
+def test_failed_save_rolls_back_subscription(run, tmp_path, delivery_factory):
+    async def scenario():
+        delivery = delivery_factory(path=str(tmp_path / "missing" / "webhooks.json"))
+        with pytest.raises(OSError):
+            await delivery.add("https://example.com/hook", [dict(CRITERIA)])
+        return delivery
+
+    delivery = run(scenario())
+    assert delivery.subscriptions == {}
+    assert delivery.dispatcher.webhook_clients == {}
+
+
+def test_subscriptions_are_limited(run, delivery_factory):
+    async def scenario():
+        delivery = delivery_factory(max_subscriptions=2)
+        await delivery.add("https://example.com/1", [dict(CRITERIA)])
+        await delivery.add("https://example.com/2", [dict(CRITERIA)])
+        with pytest.raises(AssertionError):
+            await delivery.add("https://example.com/3", [dict(CRITERIA)])
+        return delivery
+
+    assert len(run(scenario()).subscriptions) == 2
+
+
+@pytest.mark.parametrize("url", ["http://127.0.0.1/hook", "http://localhost:8080/hook", "http://[::1]/hook", "http://10.1.2.3/hook", "http://192.168.0.1/hook", "http://169.254.169.254/latest/meta-data"])
+def test_non_public_urls_are_refused(run, delivery_factory, url):
+    async def scenario():
+        delivery = delivery_factory()
+        with pytest.raises(AssertionError):
+            await delivery.check_url(url)
+        await delivery_factory(allow_private=True).check_url(url)
+
+    run(scenario())
+
+
+@pytest.mark.parametrize("url", ["ftp://example.com/hook", "https://", None])
+def test_malformed_urls_are_refused(run, delivery_factory, url):
+    async def scenario():
+        with pytest.raises(AssertionError):
+            await delivery_factory(allow_private=True).check_url(url)
+
+    run(scenario())
+
+
+def test_public_addresses():
+    assert is_public_address("93.184.215.14")
+    assert not is_public_address("::ffff:127.0.0.1")
+    assert not is_public_address("fe80::1%eth0")
+    assert not is_public_address("100.64.0.1")
+
+
+def test_non_public_literal_is_not_delivered(run, delivery_factory):
+    async def scenario():
+        delivery = delivery_factory()
+        delivered = await delivery.deliver("http://127.0.0.1/hook", [{"id": "x"}], 1)
+        return delivered, delivery.session.calls
+
+    delivered, calls = run(scenario())
+    assert delivered and calls == []
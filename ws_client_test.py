@@ -15,11 +15,14 @@ import asyncio
 import datetime
 import pytz
 import aiohttp
+import binary_codec
 
 
 HOST = os.getenv("HOST", "127.0.0.1")
 PORT = int(os.getenv("PORT", "5000"))
 SSL = int(os.getenv("SSL", "0"))
+# Negotiate msgpack subprotocol instead of JSON
+BINARY = int(os.getenv("BINARY", "0"))
 
 URL = "%s://%s:%s/appointments/ws" % ("wss" if SSL else "ws", HOST, PORT)
 
@@ -27,21 +30,39 @@ LOGGER = logging.getLogger("ws_client_test")
 
 
 async def connect_and_listen(name, criterias):
-    """ Connect Websocket, send criteria and wait for responses """
+    """
+    Connect Websocket, send criteria and wait for responses
+    Reconnect and resume session when connection is lost
+    """
 
     session = aiohttp.ClientSession()
-    websocket = await session.ws_connect(URL)
-    LOGGER.info("Client %s connected with criterias: %s", name, criterias)
-
-    await websocket.send_json(criterias)
+    subscription = {"criterias": criterias}
 
     while True:
-        msg = await websocket.receive()
-        LOGGER.info("Message received on client %s from server: %s", name, msg)
-
-        if msg.type in (aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
-            LOGGER.info("Client %s closed", name)
-            break
+        websocket = await session.ws_connect(URL, protocols=("appointments.msgpack.v1",) if BINARY else ())
+        LOGGER.info("Client %s connected with subscription: %s", name, subscription)
+
+        await websocket.send_json(subscription)
+
+        while True:
+            msg = await websocket.receive()
+            LOGGER.info("Message received on client %s from server: %s", name, msg)
+
+            if msg.type in (aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+                LOGGER.info("Client %s closed, reconnecting in 5s", name)
+                break
+
+            payload = None
+            if msg.type == aiohttp.WSMsgType.TEXT:
+                payload = msg.json()
+            elif msg.type == aiohttp.WSMsgType.BINARY:
+                payload = binary_codec.unpack(msg.data)
+                LOGGER.info("Decoded binary message on client %s: %s", name, payload)
+            if payload is not None:
+                if "seq" in payload:
+                    subscription = {"criterias": criterias, "stream_id": payload["stream_id"], "last_seq": payload["seq"]}
+
+        await asyncio.sleep(5)
 
 
 if __name__ == "__main__":